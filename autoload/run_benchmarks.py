@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import sys, os
+import argparse
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+from tsurf.tests import benchmarks
+
+parser = argparse.ArgumentParser(description="Run the Tag Surfer benchmarks.")
+parser.add_argument("--engine", action="store_true",
+                    help="run only the search engine benchmarks")
+parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")],
+                    default=benchmarks.ENGINE_SIZES,
+                    help="comma-separated sizes of the tag corpora searched "
+                         "by the search engine benchmarks")
+parser.add_argument("--json", metavar="FILE", type=argparse.FileType("w"),
+                    help="write the search engine results as JSON to FILE")
+args = parser.parse_args()
+
+if args.engine:
+    benchmarks.bench_engine(args.sizes, out=args.json)
+else:
+    benchmarks.run(args.sizes, out=args.json)
@@ -25,6 +25,10 @@ fu! tsurf#UnsetProjectRoot()
     py tag_surfer.UnsetProjectRoot()
 endfu
 
+fu! tsurf#ReloadSettings()
+    py tag_surfer.ReloadSettings()
+endfu
+
 
 " Autocommands
 " ----------------------------------------------------------------------------
@@ -32,12 +36,8 @@ endfu
 augroup tag_surfer
     au!
 
-    au BufWritePost .vimrc py tag_surfer.ui.renderer.setup_colors()
-    au Colorscheme * py tag_surfer.ui.renderer.setup_colors()
+    au BufWritePost .vimrc py tag_surfer.ReloadSettings()
+    au Colorscheme * py tag_surfer.ReloadSettings()
     au VimLeave * py tag_surfer.close()
 
-    " Invalidate the cache
-    au BufEnter,BufWrite * py tag_surfer.services.curr_project.files_cache = []
-    au BufEnter * py tag_surfer.services.curr_project.root_cache = ""
-
 augroup END
@@ -17,6 +17,7 @@ from tsurf import ui
 from tsurf import finder
 from tsurf import services
 from tsurf.utils import v
+from tsurf.utils import settings
 
 
 class TagSurfer:
@@ -29,6 +30,7 @@ class TagSurfer:
     def close(self):
         """To performs cleanup actions."""
         self.finder.close()
+        v.flush()
 
     def Open(self):
         """To open the Tag Surfer user interface."""
@@ -47,3 +49,9 @@ class TagSurfer:
     def UnsetProjectRoot(self):
         """To unset the current project root."""
         self.services.curr_project.set_root("")
+
+    def ReloadSettings(self):
+        """To reload all Tag Surfer settings from the `g:tsurf_*`
+        variables."""
+        settings.load()
+        self.ui.renderer.setup_colors()
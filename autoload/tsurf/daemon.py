@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.daemon
+~~~~~~~~~~~~
+
+This module defines the tag server. The server owns the tag index of every
+project it's asked about, keeps it up to date and answers searches over a
+Unix domain socket, so that all vim instances working on the same project
+share a single index and ctags runs only once for each change.
+
+The server is started with:
+
+    python autoload/tsurf/daemon.py [socket]
+
+Each connection carries a single request and its response, both JSON
+objects written on a single line. A request has the form:
+
+    {"root": project root, "settings": {...}, "query": query,
+     "smart_case": 0 or 1, "max_results": number}
+
+where settings are the `ctags.SETTINGS` plus `ctags_jobs`, `index_dir`,
+`wildignore` and `use_git`. The response has the form:
+
+    {"tags": [[name, file, excmd, kind, extras, similarity, positions], ...],
+     "tagfile": path or "", "generating": true or false}
+
+or {"error": message}. Tags are ordered as the finder displays them, the
+best match last.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import threading
+import SocketServer
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsurf import index
+from tsurf import store
+from tsurf.utils import fs
+from tsurf.utils import misc
+from tsurf.utils import ctags
+from tsurf.utils import tagfile
+from tsurf import exceptions as ex
+
+try:
+    from tsurf.ext import search
+except ImportError:
+    from tsurf.utils import search
+
+
+# Seconds between two checks for changes in a project
+REFRESH_INTERVAL = 2.0
+
+# Seconds a client waits for the server to answer
+TIMEOUT = 5.0
+
+# Seconds vim waits for the answer to a search. Vim is blocked meanwhile,
+# and searches are answered right away even while tags are generated.
+SEARCH_TIMEOUT = 0.5
+
+# Where the server listens when no socket is given
+DEFAULT_SOCKET = os.path.expanduser("~/.cache/tsurf/daemon.sock")
+
+
+def request(path, req, timeout=TIMEOUT):
+    """To send the request `req` to the server listening at `path` and
+    return its response. None is returned if there is no server or it does
+    not answer in time."""
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(req) + "\n")
+        f = sock.makefile("rb")
+        try:
+            return json.loads(f.readline())
+        finally:
+            f.close()
+    except (socket.error, ValueError):
+        return
+    finally:
+        sock.close()
+
+
+class Project:
+    """To keep the tags of a project up to date."""
+
+    def __init__(self, root, conf):
+        # The root is a byte string, as it is in vim, so that the index is
+        # saved to the same file and has the same file names
+        if isinstance(root, unicode):
+            root = root.encode("utf-8")
+        self.root = root
+        self.conf = conf
+        self.files = fs.ProjectFiles(root, conf["wildignore"], conf["use_git"])
+        self.config = ctags.fingerprint(conf)
+        self.path = index.path_for(conf["index_dir"], root, self.config)
+        # The index is loaded in the background by the first refresh, since
+        # large indexes take a while to load
+        self.tindex = None
+        # `self.tags` is replaced (never changed) every time the index
+        # changes, so that searches never see a store being filled.
+        self.tags = store.TagStore()
+        self.built = False
+        # `self.tagfile` holds all tag lines, for vim tag commands
+        self.tagfile = self.path[:-len(".idx")] + ".tags" if self.path else ""
+        self.error = None
+        self.last_refresh = 0
+        self.refresher = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """To look for changes in the background, unless it's been done
+        very recently or it's being done right now."""
+        with self.lock:
+            if self.generating() or time.time() - self.last_refresh < REFRESH_INTERVAL:
+                return
+            self.refresher = threading.Thread(target=self._refresh)
+            self.refresher.daemon = True
+            self.refresher.start()
+
+    def configure(self, conf):
+        """To use the settings `conf` from now on. The settings that tell
+        how tags are generated can't change (see `Server.answer`)."""
+        if conf == self.conf:
+            return
+        if (conf["wildignore"], conf["use_git"]) != (self.conf["wildignore"],
+                                                     self.conf["use_git"]):
+            self.files = fs.ProjectFiles(self.root, conf["wildignore"],
+                                         conf["use_git"])
+        self.conf = conf
+        self.last_refresh = 0
+
+    def generating(self):
+        """To check whether tags are being generated."""
+        return self.refresher is not None and self.refresher.is_alive()
+
+    def search(self, query, smart_case, max_results):
+        """To return the best matches for `query` as rows of the response
+        (see the module documentation)."""
+        tags = self.tags
+        if query:
+            _, best = search.search_batch(query, tags.names, smart_case,
+                                          max_results, None, tags.charmasks())
+            matches = reversed(best)
+        else:
+            # Sort by tag name (case-insensitive)
+            if max_results < 0:
+                max_results = len(tags)
+            matches = ((i, -1, []) for i in misc.best(
+                xrange(len(tags)), max_results, tags.lowers.__getitem__))
+        rows = []
+        for i, similarity, positions in matches:
+            tag = tags[i]
+            rows.append([tag.name, tag.file, tag.excmd, tag.kind,
+                         tags.extras[i].decode("utf-8", "replace"),
+                         similarity, list(positions)])
+        return rows
+
+    def _refresh(self):
+        try:
+            if self.tindex is None:
+                self.tindex = index.TagIndex.load(self.root, self.path, self.config)
+            files = self.files.get()
+            self.tindex.prune(files)
+            stale = self.tindex.stale(files)
+            groups = ctags.group_files(files, self.conf["custom_languages"])
+
+            # Tags of files that did not change are available right away
+            if not self.built and self.tindex.entries:
+                self._build(groups)
+
+            version = self.tindex.version
+            jobs = ctags.workers(int(self.conf["ctags_jobs"]))
+            for ft, file_group in groups.items():
+                stale_group = [f for f in file_group if f in stale]
+                if not stale_group:
+                    continue
+                opts = ctags.group_options(ft, self.conf)
+                if not os.path.exists(opts["bin"]):
+                    raise ex.TagSurferException("Error: The program '{}' does "
+                        "not exists or cannot be found in your $PATH".format(opts["bin"]))
+                cmd = ctags.command(opts["bin"], opts["args"], opts["custom_args"])
+                lines = list(ctags.stream(cmd, stale_group, jobs, ft == "*"))
+                self.tindex.merge(dict((f, stale[f]) for f in stale_group), lines)
+
+            if not self.built or self.tindex.version != version:
+                self._build(groups)
+            self.tindex.save()
+            self.error = None
+        except ex.TagSurferException as e:
+            self.error = e.message
+        except Exception as e:
+            self.error = "Unexpected error: " + str(e)
+        finally:
+            self.last_refresh = time.time()
+
+    def _build(self, groups):
+        """To build a new tag store (and tag file) from the index."""
+        tags = store.TagStore()
+        lines = []
+        for ft, file_group in groups.items():
+            opts = ctags.group_options(ft, self.conf)
+            for f in file_group:
+                for line in self.tindex.lines(f):
+                    lines.append(line)
+                    tag = store.parse(line, opts["kinds"])
+                    if tag and tag[3] not in opts["exclude_kinds"]:
+                        tags.append(*tag)
+        if self.tagfile:
+            try:
+                tagfile.write(self.tagfile, lines)
+            except (IOError, OSError):
+                self.tagfile = ""
+        # Masks are computed before the store is shared between threads
+        tags.charmasks()
+        self.tags = tags
+        self.built = True
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """To answer requests coming from vim instances."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        # A socket left behind by a server that is no longer running
+        if os.path.exists(path) and request(path, {}, timeout=1) is None:
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.path = path
+        # `self.projects` has the form {(root, fingerprint, index dir):
+        # Project(..), ...}, that is, there is a project for each index file
+        # (see `index.path_for`). Other settings (e.g. `wildignore`) are
+        # the ones of the latest request.
+        self.projects = {}
+        self.lock = threading.Lock()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def answer(self, req):
+        """To return the response to the request `req`."""
+        if not req:
+            return {}
+        conf = req["settings"]
+        key = (req["root"], ctags.fingerprint(conf), conf["index_dir"])
+        with self.lock:
+            project = self.projects.get(key)
+            if project is None:
+                project = self.projects[key] = Project(req["root"], conf)
+            else:
+                project.configure(conf)
+        project.refresh()
+        if project.error:
+            return {"error": project.error}
+        return {
+            "tags": project.search(req["query"], req["smart_case"],
+                                   req["max_results"]),
+            "tagfile": project.tagfile if project.built else "",
+            "generating": project.generating(),
+        }
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            resp = self.server.answer(json.loads(self.rfile.readline()))
+        except Exception as e:
+            resp = {"error": "Unexpected error: " + str(e)}
+        try:
+            self.wfile.write(json.dumps(resp) + "\n")
+        except socket.error as e:
+            if e.errno != errno.EPIPE:
+                raise
+
+
+def main(argv):
+    server = Server(argv[1] if len(argv) > 1 else DEFAULT_SOCKET)
+    # Remove the socket when killed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
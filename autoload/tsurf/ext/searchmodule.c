@@ -1,5 +1,5 @@
-/* 
- * searchmodule.c 
+/*
+ * searchmodule.c
  *
  * C version of `tsurf.utils.search`.
  *
@@ -14,223 +14,634 @@ static char py_search_doc[] = "To search for `needle` in `haystack`.\n"
     "`haystack`, whereas the other tuple contains the positions where "
     "the match occurs in `haystack`.";
 
-static PyObject *
-py_search(PyObject *self, PyObject *args)
+static char py_search_batch_doc[] = "To search for `needle` in each string "
+    "of the sequence `haystacks` (or only in those at the given `indices`).\n"
+    "Returns a tuple of two lists. The first one contains the indices of all "
+    "matching haystacks, whereas the second one contains at most "
+    "`max_results` tuples (index, similarity, positions) for the best "
+    "matches, ordered from the best to the worst. Among matches with the "
+    "same similarity, later haystacks come first. If the character masks "
+    "of all haystacks are given with `masks` (an array of unsigned longs, "
+    "see `charmask`), haystacks that lack some character of `needle` are "
+    "skipped.";
+
+static char py_charmask_doc[] = "To return the mask of the characters of "
+    "`s` (case-insensitive).";
+
+
+// To make sure the buffer `*buf` has room for `needed` items
+static int
+grow(void **buf, size_t *size, size_t needed, size_t item_size)
 {
-    const char *needle;
-    const int needle_len;
-    const char *haystack;
-    const int haystack_len;
-    const int smart_case;
+    if (*size >= needed)
+        return 0;
+    void *p = realloc(*buf, needed * item_size);
+    if (p == NULL)
+        return -1;
+    *buf = p;
+    *size = needed;
+    return 0;
+}
 
-    if (!PyArg_ParseTuple(args, "s#s#i", 
-            &needle, &needle_len, &haystack, &haystack_len, &smart_case))
-        return NULL;
 
-    if (needle_len == 0) {
-        return Py_BuildValue("(i,())", -1);        
+static void
+workspace_free(workspace_t *ws)
+{
+    free(ws->states);
+    free(ws->columns);
+    free(ws->tmp);
+}
+
+
+static int
+char_eq(Py_UNICODE h, Py_UNICODE n, int smart_case)
+{
+    if (smart_case && Py_UNICODE_ISUPPER(n))
+        return h == n;
+    return Py_UNICODE_TOLOWER(h) == Py_UNICODE_TOLOWER(n);
+}
+
+
+// To return the bit of the character `c` in a character mask. Same as
+// `tsurf.utils.search._char_mask`.
+static unsigned long
+char_mask(Py_UNICODE c)
+{
+    int bit;
+    c = Py_UNICODE_TOLOWER(c);
+    if (c >= 'a' && c <= 'z')
+        bit = c - 'a';
+    else if (c >= '0' && c <= '9')
+        bit = c - '0' + 26;
+    else if (c < 128)
+        bit = 36 + c % 27;
+    else
+        bit = 63;
+    return 1UL << (bit % (8 * sizeof(unsigned long)));
+}
+
+
+static unsigned long
+string_mask(const Py_UNICODE *s, Py_ssize_t len)
+{
+    unsigned long mask = 0;
+    for (Py_ssize_t i = 0; i < len; i++)
+        mask |= char_mask(s[i]);
+    return mask;
+}
+
+
+// Same as `unicode.isupper()`
+static int
+is_upper(const Py_UNICODE *s, Py_ssize_t len)
+{
+    int cased = 0;
+    for (Py_ssize_t i = 0; i < len; i++) {
+        if (Py_UNICODE_ISLOWER(s[i]) || Py_UNICODE_ISTITLE(s[i]))
+            return 0;
+        if (Py_UNICODE_ISUPPER(s[i]))
+            cased = 1;
+    }
+    return cased;
+}
+
+
+#define IS_BOUNDARY(i) ((i) == 0 || \
+    (uppercase_is_word_boundary && Py_UNICODE_ISUPPER(haystack[i])) || \
+    haystack[(i)-1] == '-' || haystack[(i)-1] == '_')
+
+
+int
+match(const Py_UNICODE *needle, Py_ssize_t needle_len,
+      const Py_UNICODE *haystack, Py_ssize_t haystack_len,
+      int smart_case, workspace_t *ws, double *similarity, int *positions)
+{
+    Py_ssize_t i, j, c, k;
+
+    if (needle_len == 0 || needle_len > haystack_len)
+        return 0;
+
+    if (grow((void **)&ws->tmp, &ws->tmp_size, 6 * needle_len, sizeof(int)) < 0)
+        return -1;
+
+    int *left = ws->tmp;
+    int *right = left + needle_len;
+    int *col_start = right + needle_len;
+    int *col_len = col_start + needle_len;
+    int *offset = col_len + needle_len;
+    int *other = offset + needle_len;
+
+    // Each needle character can be matched only between its leftmost and
+    // rightmost positions among all complete matches
+    i = 0;
+    for (j = 0; j < needle_len; j++) {
+        while (i < haystack_len && !char_eq(haystack[i], needle[j], smart_case))
+            i++;
+        if (i == haystack_len)
+            return 0;
+        left[j] = i++;
+    }
+    i = haystack_len - 1;
+    for (j = needle_len - 1; j >= 0; j--) {
+        while (i >= 0 && !char_eq(haystack[i], needle[j], smart_case))
+            i--;
+        right[j] = i--;
     }
 
+    // Collect all positions where each needle character can be matched
+    size_t columns_size = 0;
+    for (j = 0; j < needle_len; j++)
+        columns_size += right[j] - left[j] + 1;
+    if (grow((void **)&ws->columns, &ws->columns_size, columns_size, sizeof(int)) < 0)
+        return -1;
+
+    // For the column `j` we keep a state for each (gaps, boundaries) pair with
+    // gaps in [0, j] and boundaries in [0, j+1]. The extra room at the end is
+    // used for the best partial matches of the previous column.
+    size_t states_size = 0;
+    int n = 0;
+    for (j = 0; j < needle_len; j++) {
+        col_start[j] = n;
+        for (i = left[j]; i <= right[j]; i++) {
+            if (char_eq(haystack[i], needle[j], smart_case))
+                ws->columns[n++] = i;
+        }
+        col_len[j] = n - col_start[j];
+        offset[j] = states_size;
+        states_size += col_len[j] * (j + 1) * (j + 2);
+    }
+    if (grow((void **)&ws->states, &ws->states_size,
+             states_size + needle_len * (needle_len + 1), sizeof(state_t)) < 0)
+        return -1;
+
+    state_t *best = ws->states + states_size;
+
     // If `haystack` has only uppercase characters then it makes no sense
     // to treat an uppercase letter as a word-boundary character
-    int uppercase_is_word_boundary = 0;
-    for (int i = 0; i < haystack_len; i++) {
-        if (haystack[i] >= 97 && haystack[i] <= 122)
-            // non-uppercase letter is found
-            uppercase_is_word_boundary = 1;
-    }
-
-    // Initialize the return values
-    PyObject *best_positions = Py_BuildValue("()");
-    float best_similarity = -1;    
-
-    // Utilities variables
-    PyObject *needle_pyobj = Py_BuildValue("s", needle);  // new ref    
-    Py_ssize_t needle_pyobj_len = PySequence_Length(needle_pyobj);
-
-    // Declarations
-    PyObject *matcher, *fork;
-    PyObject *consumed, *positions, *boundaries;
-    int needle_idx;
-
-    // `matchers` keeps track of all possible matches of `needle` in `haystack`
-    PyObject *matchers = PyList_New(1);  // new ref
-
-    // Add the first matcher
-    matcher = PyDict_New();  // new ref
-    PyDict_SetItemString(matcher, "needle_idx", Py_BuildValue("i", 0));
-    PyDict_SetItemString(matcher, "consumed", PyList_New(0));
-    PyDict_SetItemString(matcher, "boundaries", PyList_New(0));
-    PyDict_SetItemString(matcher, "positions", PyList_New(0));
-    // Note: PyList_SetItem don't increment the reference count
-    PyList_SetItem(matchers, 0, matcher);
-
-    for (int i = 0; i < haystack_len; i++) {
-
-        // create forks of current matches if needed
-
-        Py_ssize_t matchers_len = PyList_Size(matchers);
-        for (int j = 0; j < matchers_len; j++) {
-
-            // get matchers[j] and its values
-            matcher = PyList_GetItem(matchers, j);
-            /*assert(PyDict_Check(matcher));*/
-            consumed = PyDict_GetItemString(matcher, "consumed");
-            /*assert(PyList_Check(consumed));*/
-            positions = PyDict_GetItemString(matcher, "positions");
-            /*assert(PyList_Check(positions));*/
-            boundaries = PyDict_GetItemString(matcher, "boundaries");
-            /*assert(PyList_Check(boundaries));*/
-
-            // Check if the current character in `haystack` has been matched 
-            // before by matchers[j]. If so, we crate a fork of matcher[j].
-            int c;
-            int idx = -1;
-            for (int k = 0; k < PyList_Size(consumed); k++) {
-                c = PyInt_AsLong(PyList_GetItem(consumed, k));
-                if (tolower(haystack[i]) == c) { 
-                    idx = k;
-                    break;
+    int uppercase_is_word_boundary = !is_upper(haystack, haystack_len);
+
+    int weight = 1 - needle_len;
+    for (c = 0; c < col_len[0]; c++) {
+        state_t *block = ws->states + offset[0] + c * 2;
+        i = ws->columns[col_start[0] + c];
+        block[0].dsum = block[1].dsum = INT_MAX;
+        block[IS_BOUNDARY(i)].dsum = weight * i;
+        block[IS_BOUNDARY(i)].prev = -1;
+    }
+
+    for (j = 1; j < needle_len; j++) {
+
+        int prev_keys = j * (j + 1);
+        int prev_width = j + 1;
+        int keys = (j + 1) * (j + 2);
+        int width = j + 2;
+        int *prev_column = ws->columns + col_start[j-1];
+        int *column = ws->columns + col_start[j];
+        state_t *prev_states = ws->states + offset[j-1];
+        state_t *states = ws->states + offset[j];
+        int p = 0;
+
+        weight = 2 * j - needle_len + 1;
+
+        // `best` holds, for each (gaps, boundaries) pair, the best partial
+        // match of the previous characters ending before `i - 1`
+        for (k = 0; k < prev_keys; k++)
+            best[k].dsum = INT_MAX;
+
+        for (c = 0; c < col_len[j]; c++) {
+
+            i = column[c];
+
+            while (p < col_len[j-1] && prev_column[p] < i - 1) {
+                state_t *block = prev_states + p * prev_keys;
+                for (k = 0; k < prev_keys; k++) {
+                    if (block[k].dsum < best[k].dsum) {
+                        best[k].dsum = block[k].dsum;
+                        best[k].prev = p;
+                    }
                 }
+                p++;
             }
-            if (idx >= 0) {           
-                PyObject *slice = PySequence_GetSlice(needle_pyobj, idx, needle_pyobj_len);  // new ref
-                // The slice contains all characters that remains to be matched
-                // by this possible fork in `haystack`. If there is room for
-                // this remaining characters to be matched in `haystack` then
-                // we create a fork, otherwise there is no need to since the
-                // match won't certainly succeed.
-                if (PySequence_Length(slice) <= haystack_len - i) {
-                    // create a new fork
-                    fork = PyDict_New();  // new ref
-                    PyDict_SetItemString(fork, "needle_idx", Py_BuildValue("i", idx));
-                    PyDict_SetItemString(fork, "consumed", PySequence_GetSlice(consumed, 0, idx));
-                    PyDict_SetItemString(fork, "boundaries", PySequence_GetSlice(boundaries, 0, idx));
-                    PyDict_SetItemString(fork, "positions", PySequence_GetSlice(positions, 0, idx));
-                    // append the new fork to matchers pool
-                    PyList_Append(matchers, fork);  // PyList_append increment the ref counter
-                    Py_DECREF(fork);
+
+            int boundary = IS_BOUNDARY(i);
+            state_t *block = states + c * keys;
+            for (k = 0; k < keys; k++)
+                block[k].dsum = INT_MAX;
+
+            for (k = 0; k < prev_keys; k++) {
+                if (best[k].dsum == INT_MAX)
+                    continue;
+                int key = (k / prev_width + 1) * width + k % prev_width + boundary;
+                int dsum = best[k].dsum + weight * i;
+                if (dsum < block[key].dsum) {
+                    block[key].dsum = dsum;
+                    block[key].prev = best[k].prev;
                 }
-                Py_DECREF(slice);
             }
-        }
 
-        // update each matcher
-        
-        int cond;
-        PyObject *pos, *c;
-
-        for (int j = 0; j < PyList_Size(matchers); j++) {
-            
-            matcher = PyList_GetItem(matchers, j);  // borrowed ref
-            /*assert(PyDict_Check(matcher));*/
-            needle_idx = PyInt_AsLong(PyDict_GetItemString(matcher, "needle_idx"));
-            consumed = PyDict_GetItemString(matcher, "consumed");
-            /*assert(PyList_Check(consumed));*/
-            positions = PyDict_GetItemString(matcher, "positions");
-            /*assert(PyList_Check(positions));*/
-            boundaries = PyDict_GetItemString(matcher, "boundaries");
-            /*assert(PyList_Check(boundaries));*/
-
-            if (needle_idx == needle_len)
-                continue;
+            // The previous needle character matched right before `i`
+            if (p < col_len[j-1] && prev_column[p] == i - 1) {
+                state_t *adjacent = prev_states + p * prev_keys;
+                for (k = 0; k < prev_keys; k++) {
+                    if (adjacent[k].dsum == INT_MAX)
+                        continue;
+                    int key = (k / prev_width) * width + k % prev_width + boundary;
+                    int dsum = adjacent[k].dsum + weight * i;
+                    if (dsum < block[key].dsum) {
+                        block[key].dsum = dsum;
+                        block[key].prev = p;
+                    }
+                }
+            }
+        }
+    }
 
-            if (smart_case && isupper(needle[needle_idx]))
-                cond = haystack[i] == needle[needle_idx];
-            else
-                cond = tolower(haystack[i]) == tolower(needle[needle_idx]);           
+    // Pick the best complete match. Note that this must give the same value
+    // as `tsurf.utils.search.similarity`.
+    j = needle_len - 1;
+    int keys = (j + 1) * (j + 2);
+    int width = j + 2;
+    long pairs = (long)needle_len * (needle_len - 1) / 2;
+    int found = 0;
 
-            if (cond) {
+    for (c = 0; c < col_len[j]; c++) {
+        state_t *block = ws->states + offset[j] + c * keys;
+        for (k = 0; k < keys; k++) {
 
-                if ((uppercase_is_word_boundary && isupper(haystack[i])) || i == 0 || 
-                    (i > 0 && (haystack[i-1] == '-' || haystack[i-1] == '_'))) {
-                    pos = Py_BuildValue("i", 1);  // new ref
-                    PyList_Append(boundaries, pos);
-                } else {
-                    pos = Py_BuildValue("i", 0);  // new ref
-                    PyList_Append(boundaries, pos);
-                }
-                Py_DECREF(pos);
+            if (block[k].dsum == INT_MAX)
+                continue;
 
-                pos = Py_BuildValue("i", i);  // new ref
-                PyList_Append(positions, pos);
-                Py_DECREF(pos);
+            int gaps = k / width;
+            int boundaries = k % width;
+            double s;
+            if (pairs > 0)
+                s = (double)block[k].dsum / pairs * (gaps + 1) / (boundaries + 1);
+            else
+                s = (double)ws->columns[col_start[j] + c] / (boundaries + 1);
 
-                c = Py_BuildValue("i", tolower(needle[needle_idx]));  // new ref
-                PyList_Append(consumed, c);
-                Py_DECREF(c);
+            if (found && s > *similarity)
+                continue;
 
-                needle_idx++;
-                PyDict_SetItemString(matcher, "needle_idx", Py_BuildValue("i", needle_idx));
+            // Walk the match backward
+            int *out = (found && s == *similarity) ? other : positions;
+            Py_ssize_t cc = c, kk = k, jj;
+            for (jj = j; jj >= 0; jj--) {
+                int pos = ws->columns[col_start[jj] + cc];
+                out[jj] = pos;
+                if (jj == 0)
+                    break;
+                state_t *st = ws->states + offset[jj] + cc * (jj + 1) * (jj + 2) + kk;
+                int prev_pos = ws->columns[col_start[jj-1] + st->prev];
+                int g = kk / (jj + 2);
+                int b = kk % (jj + 2) - IS_BOUNDARY(pos);
+                if (prev_pos != pos - 1)
+                    g--;
+                kk = g * (jj + 1) + b;
+                cc = st->prev;
+            }
 
-                if (needle_idx == needle_len) {
-                    int boundaries_count = 0;
-                    for (int k = 0; k < PyList_Size(boundaries); k++) {
-                        if (PyInt_AsLong(PyList_GetItem(boundaries, k)))
-                            boundaries_count++;
-                    }
-                    float s = similarity(haystack_len, positions, boundaries_count);
-                    if (best_similarity < 0 || s < best_similarity) {
-                        best_similarity = s;
-                        Py_DECREF(best_positions);  // TODO: correct right ??
-                        best_positions = PySequence_Tuple(positions);
+            if (out == other) {
+                // Same similarity: keep the leftmost match
+                for (jj = 0; jj < needle_len; jj++) {
+                    if (other[jj] != positions[jj]) {
+                        if (other[jj] < positions[jj])
+                            memcpy(positions, other, needle_len * sizeof(int));
+                        break;
                     }
                 }
+            } else {
+                found = 1;
+                *similarity = s;
             }
         }
     }
-    Py_DECREF(needle_pyobj);
-    Py_DECREF(matchers);
-    return Py_BuildValue("(f,N)", best_similarity, best_positions);
+
+    return found;
+}
+
+
+// To return a new reference to a unicode version of `obj`. Byte strings are
+// decoded byte by byte so that match positions are byte positions.
+static PyObject *
+as_unicode(PyObject *obj)
+{
+    if (PyUnicode_Check(obj)) {
+        Py_INCREF(obj);
+        return obj;
+    }
+    if (PyString_Check(obj))
+        return PyUnicode_DecodeLatin1(PyString_AS_STRING(obj),
+                                      PyString_GET_SIZE(obj), NULL);
+    PyErr_SetString(PyExc_TypeError, "expected a string");
+    return NULL;
 }
 
 
-float 
-similarity(int haystack_len, PyObject *positions, int boundaries_count) 
+static PyObject *
+positions_tuple(int *positions, Py_ssize_t len)
 {
-    /*assert(PyList_Check(positions));*/
+    PyObject *t = PyTuple_New(len);
+    if (t == NULL)
+        return NULL;
+    for (Py_ssize_t i = 0; i < len; i++)
+        PyTuple_SET_ITEM(t, i, PyInt_FromLong(positions[i]));
+    return t;
+}
+
+
+static PyObject *
+py_search(PyObject *self, PyObject *args)
+{
+    PyObject *needle_obj, *haystack_obj;
+    int smart_case;
+
+    if (!PyArg_ParseTuple(args, "OOi", &needle_obj, &haystack_obj, &smart_case))
+        return NULL;
+
+    PyObject *needle = as_unicode(needle_obj);
+    if (needle == NULL)
+        return NULL;
+    PyObject *haystack = as_unicode(haystack_obj);
+    if (haystack == NULL) {
+        Py_DECREF(needle);
+        return NULL;
+    }
 
-    Py_ssize_t positions_len = PyList_Size(positions);
-    if (positions_len == 0)
+    PyObject *result = NULL;
+    Py_ssize_t needle_len = PyUnicode_GET_SIZE(needle);
+    int *positions = malloc((needle_len + 1) * sizeof(int));
+    workspace_t ws = {NULL, 0, NULL, 0, NULL, 0};
+    double similarity;
+
+    int r = -1;
+    if (positions != NULL)
+        r = match(PyUnicode_AS_UNICODE(needle), needle_len,
+                  PyUnicode_AS_UNICODE(haystack), PyUnicode_GET_SIZE(haystack),
+                  smart_case, &ws, &similarity, positions);
+
+    if (r < 0)
+        PyErr_NoMemory();
+    else if (r == 0)
+        result = Py_BuildValue("(i,())", -1);
+    else
+        result = Py_BuildValue("(d,N)", similarity,
+                               positions_tuple(positions, needle_len));
+
+    workspace_free(&ws);
+    free(positions);
+    Py_DECREF(needle);
+    Py_DECREF(haystack);
+    return result;
+}
+
+
+// `a` is a worse result than `b`
+static int
+worse(const result_t *a, const result_t *b)
+{
+    return a->similarity > b->similarity ||
+        (a->similarity == b->similarity && a->index < b->index);
+}
+
+
+static int
+compare_results(const void *a, const void *b)
+{
+    if (worse((const result_t *)a, (const result_t *)b))
+        return 1;
+    if (worse((const result_t *)b, (const result_t *)a))
         return -1;
+    return 0;
+}
 
-    int n = 0;
-    float diffs_sum = .0;
-    int contiguous_sets = 0;
 
-    // Generate all `positions` combinations for k = 2 and
-    // sum the absolute difference computed for each one.
-    float x1, x2, prev;
-    for (int i = 0; i < positions_len; i++) {
+// To restore the heap property of `heap` (the worst result on top)
+static void
+sift_down(result_t *heap, Py_ssize_t len, Py_ssize_t i)
+{
+    for (;;) {
+        Py_ssize_t l = 2 * i + 1, r = l + 1, top = i;
+        if (l < len && worse(&heap[l], &heap[top]))
+            top = l;
+        if (r < len && worse(&heap[r], &heap[top]))
+            top = r;
+        if (top == i)
+            return;
+        result_t t = heap[i];
+        heap[i] = heap[top];
+        heap[top] = t;
+        i = top;
+    }
+}
+
+
+static void
+sift_up(result_t *heap, Py_ssize_t i)
+{
+    while (i > 0) {
+        Py_ssize_t parent = (i - 1) / 2;
+        if (!worse(&heap[i], &heap[parent]))
+            return;
+        result_t t = heap[i];
+        heap[i] = heap[parent];
+        heap[parent] = t;
+        i = parent;
+    }
+}
 
-        x1 = PyFloat_AsDouble(PyList_GetItem(positions, i)); 
 
-        if (i > 0) {
-            prev = PyFloat_AsDouble(PyList_GetItem(positions, i-1)); 
-            if (prev != x1 - 1)
-                contiguous_sets++;
+static PyObject *
+py_charmask(PyObject *self, PyObject *args)
+{
+    PyObject *s_obj;
+
+    if (!PyArg_ParseTuple(args, "O", &s_obj))
+        return NULL;
+
+    PyObject *s = as_unicode(s_obj);
+    if (s == NULL)
+        return NULL;
+    unsigned long mask = string_mask(PyUnicode_AS_UNICODE(s), PyUnicode_GET_SIZE(s));
+    Py_DECREF(s);
+    return PyLong_FromUnsignedLong(mask);
+}
+
+
+static PyObject *
+py_search_batch(PyObject *self, PyObject *args)
+{
+    PyObject *needle_obj, *haystacks_obj, *indices_obj = Py_None;
+    PyObject *masks_obj = Py_None;
+    int smart_case, max_results = -1;
+
+    if (!PyArg_ParseTuple(args, "OOi|iOO", &needle_obj, &haystacks_obj,
+                          &smart_case, &max_results, &indices_obj, &masks_obj))
+        return NULL;
+
+    PyObject *result = NULL;
+    PyObject *needle = NULL, *haystacks = NULL, *indices = NULL;
+    PyObject **strings = NULL;
+    Py_ssize_t *selected = NULL, *matched = NULL;
+    result_t *heap = NULL;
+    int *pool = NULL, *positions = NULL;
+    workspace_t ws = {NULL, 0, NULL, 0, NULL, 0};
+    const unsigned long *masks = NULL;
+    unsigned long needle_mask = 0;
+    Py_ssize_t total = 0, count = 0, t;
+
+    needle = as_unicode(needle_obj);
+    if (needle == NULL)
+        goto done;
+    haystacks = PySequence_Fast(haystacks_obj, "haystacks must be a sequence");
+    if (haystacks == NULL)
+        goto done;
+
+    Py_ssize_t needle_len = PyUnicode_GET_SIZE(needle);
+    Py_ssize_t haystacks_len = PySequence_Fast_GET_SIZE(haystacks);
+
+    if (masks_obj != Py_None) {
+        const void *buf;
+        Py_ssize_t buf_len;
+        if (PyObject_AsReadBuffer(masks_obj, &buf, &buf_len) < 0)
+            goto done;
+        if (buf_len < haystacks_len * (Py_ssize_t) sizeof(unsigned long)) {
+            PyErr_SetString(PyExc_ValueError, "masks must have a mask for each haystack");
+            goto done;
         }
+        masks = buf;
+        needle_mask = string_mask(PyUnicode_AS_UNICODE(needle), needle_len);
+    }
+
+    // Determine which haystacks need to be searched
+    if (indices_obj != Py_None) {
+        indices = PySequence_Fast(indices_obj, "indices must be a sequence");
+        if (indices == NULL)
+            goto done;
+        total = PySequence_Fast_GET_SIZE(indices);
+    } else {
+        total = haystacks_len;
+    }
 
-        for (int j = i; j < positions_len; j++) {
-            if (j != i) {
-                x2 = PyFloat_AsDouble(PyList_GetItem(positions, j)); 
-                diffs_sum += abs(x1-x2);
-                n += 1;
+    selected = malloc((total + 1) * sizeof(Py_ssize_t));
+    matched = malloc((total + 1) * sizeof(Py_ssize_t));
+    strings = calloc(total + 1, sizeof(PyObject *));
+    if (selected == NULL || matched == NULL || strings == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    for (t = 0; t < total; t++) {
+        Py_ssize_t i = t;
+        if (indices != NULL) {
+            i = PyInt_AsSsize_t(PySequence_Fast_GET_ITEM(indices, t));
+            if (i == -1 && PyErr_Occurred())
+                goto done;
+            if (i < 0 || i >= haystacks_len) {
+                PyErr_SetString(PyExc_IndexError, "index out of range");
+                goto done;
             }
         }
-    }             
+        // Haystacks that lack some character of the needle can't match
+        if (masks != NULL && (masks[i] & needle_mask) != needle_mask)
+            continue;
+        selected[count] = i;
+        strings[count] = as_unicode(PySequence_Fast_GET_ITEM(haystacks, i));
+        if (strings[count++] == NULL)
+            goto done;
+    }
 
-    if (n > 0) {
-        return diffs_sum/n * ++contiguous_sets / ++boundaries_count;
-    } else {
-        // `positions_len == 1`
-        return PyFloat_AsDouble(PyList_GetItem(positions, 0)) / ++boundaries_count;
+    Py_ssize_t capacity = max_results < 0 || max_results > count ? count : max_results;
+    heap = malloc((capacity + 1) * sizeof(result_t));
+    pool = malloc((capacity * needle_len + 1) * sizeof(int));
+    positions = malloc((needle_len + 1) * sizeof(int));
+    if (heap == NULL || pool == NULL || positions == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    Py_ssize_t matched_len = 0, heap_len = 0;
+    int failed = 0;
+
+    // We own a reference to every string, so we can safely search them
+    // without holding the GIL
+    Py_BEGIN_ALLOW_THREADS
+
+    for (t = 0; t < count && needle_len > 0; t++) {
+
+        double similarity;
+        int r = match(PyUnicode_AS_UNICODE(needle), needle_len,
+                      PyUnicode_AS_UNICODE(strings[t]), PyUnicode_GET_SIZE(strings[t]),
+                      smart_case, &ws, &similarity, positions);
+        if (r < 0) {
+            failed = 1;
+            break;
+        }
+        if (r == 0)
+            continue;
+
+        matched[matched_len++] = selected[t];
+
+        result_t res = {selected[t], similarity, NULL};
+        if (heap_len < capacity) {
+            res.positions = pool + heap_len * needle_len;
+            memcpy(res.positions, positions, needle_len * sizeof(int));
+            heap[heap_len] = res;
+            sift_up(heap, heap_len++);
+        } else if (capacity > 0 && worse(&heap[0], &res)) {
+            res.positions = heap[0].positions;
+            memcpy(res.positions, positions, needle_len * sizeof(int));
+            heap[0] = res;
+            sift_down(heap, heap_len, 0);
+        }
+    }
+
+    qsort(heap, heap_len, sizeof(result_t), compare_results);
+
+    Py_END_ALLOW_THREADS
+
+    if (failed) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    PyObject *matched_list = PyList_New(matched_len);
+    PyObject *best_list = PyList_New(heap_len);
+    if (matched_list == NULL || best_list == NULL) {
+        Py_XDECREF(matched_list);
+        Py_XDECREF(best_list);
+        goto done;
+    }
+    for (t = 0; t < matched_len; t++)
+        PyList_SET_ITEM(matched_list, t, PyInt_FromSsize_t(matched[t]));
+    for (t = 0; t < heap_len; t++)
+        PyList_SET_ITEM(best_list, t, Py_BuildValue("(ndN)", heap[t].index,
+            heap[t].similarity, positions_tuple(heap[t].positions, needle_len)));
+
+    result = Py_BuildValue("(NN)", matched_list, best_list);
+
+done:
+    if (strings != NULL) {
+        for (t = 0; t < count; t++)
+            Py_XDECREF(strings[t]);
     }
+    free(strings);
+    free(selected);
+    free(matched);
+    free(heap);
+    free(pool);
+    free(positions);
+    workspace_free(&ws);
+    Py_XDECREF(needle);
+    Py_XDECREF(haystacks);
+    Py_XDECREF(indices);
+    return result;
 }
 
 
 static PyMethodDef searchMethods[] = {
     {"search", py_search, METH_VARARGS, py_search_doc},
+    {"search_batch", py_search_batch, METH_VARARGS, py_search_batch_doc},
+    {"charmask", py_charmask, METH_VARARGS, py_charmask_doc},
     {NULL, NULL, 0, NULL}
 };
 
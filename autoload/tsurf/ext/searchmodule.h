@@ -2,18 +2,63 @@
 #define SEARCHMODULE_H
 
 #include <Python.h>
-#include <ctype.h>
+#include <limits.h>
+#include <stdlib.h>
+#include <string.h>
 
 
 /*
- * To compute the similarity between two strings given the `haystack` length,
- * and the positions where `needle` matches in `haystack` and the positions
- * where matches fall on word boundaries.
+ * A partial match of the first `j+1` needle characters ending at a given
+ * haystack position, for a given (gaps, boundaries) pair.
  *
- * Returns a number that indicate the similarity between the two strings.
- * The lower it is, the more similar the two strings are.
+ * `dsum` is the lowest sum of the distances between all matched positions
+ * (INT_MAX if the state is unreachable) and `prev` is the index, in the
+ * previous column, of the position where the previous needle character
+ * has been matched.
+ */
+typedef struct {
+    int dsum;
+    int prev;
+} state_t;
+
+
+/*
+ * Memory used while matching. It is reused across matches and grows as
+ * needed.
+ */
+typedef struct {
+    state_t *states;
+    size_t states_size;
+    int *columns;
+    size_t columns_size;
+    int *tmp;
+    size_t tmp_size;
+} workspace_t;
+
+
+/*
+ * A search result: the index of the haystack, the similarity and the
+ * position (in a shared pool) of the match positions.
+ */
+typedef struct {
+    Py_ssize_t index;
+    double similarity;
+    int *positions;
+} result_t;
+
+
+/*
+ * To search for `needle` in `haystack` and find the match with the highest
+ * similarity (lowest value). The same algorithm as `tsurf.utils.search`
+ * is used.
+ *
+ * Returns 1 if `needle` matches, 0 if it doesn't and -1 if memory can't be
+ * allocated. If there is a match, `similarity` and `positions` (which must
+ * have room for `needle_len` positions) are set. No Python API is used, so
+ * it's safe to call this function without holding the GIL.
  *
  */
-float similarity(int, PyObject*, int);
+int match(const Py_UNICODE*, Py_ssize_t, const Py_UNICODE*, Py_ssize_t,
+          int, workspace_t*, double*, int*);
 
 #endif
@@ -8,18 +8,24 @@ generating and searching tags for the current file, open buffers or project.
 """
 
 import os
-import vim
-import shlex
+import sys
+import heapq
+import shutil
 import tempfile
+import threading
 import subprocess
-from itertools import imap
 from datetime import datetime
-from operator import itemgetter
-from collections import defaultdict
 
 from tsurf.utils import v
+from tsurf.utils import job
 from tsurf.utils import misc
+from tsurf.utils import shards
+from tsurf.utils import ctags
+from tsurf.utils import tagfile
 from tsurf.utils import settings
+from tsurf import index
+from tsurf import store
+from tsurf import daemon
 from tsurf import exceptions as ex
 
 try:
@@ -30,6 +36,10 @@ except ImportError:
     TSURF_SEARCH_EXT_LOADED = False
 
 
+# Maximum memory (in bytes) used to remember the results of recent searches
+RESULTS_CACHE_SIZE = 4 * 1024 * 1024
+
+
 class Finder:
 
     def __init__(self, plug):
@@ -37,25 +47,73 @@ class Finder:
 
         # `self.rebuild_tags` is True when tags need to be re-generated.
         # at the moment tags are regenerated everytime the user closes
-        # Tag Surfer or change the search scope.
+        # Tag Surfer or change the search scope. Note that ctags is executed
+        # only for files that changed since the last time (see `self.indexes`).
         self.rebuild_tags = True
         # `self.tags_cache` holds all parsed tags generated from the execution
         # of the ctags program. This attribute works in conjunction with the
         # attribute `self.rebuild_tags`
-        self.tags_cache = []
+        self.tags_cache = store.TagStore()
+        # `self.job` is the background job that is generating tags, if any.
+        # Tags are moved from the job to `self.tags_cache` every time a
+        # search is done.
+        self.job = None
+
+        # `self.indexes` holds a tag index for each project root. Indexes
+        # remember the tags generated for each file so that ctags is executed
+        # only for files that changed since the last time.
+        self.indexes = {}
 
         # `self.find_tags` is True when a new search needs to be done.
         # The only time this is set to `False` is when the user moves around
         # in the search results window.
         self.refind_tags = True
+        # `self.coalesced_keys` is the number of keys the user typed ahead
+        # since the last search. The search for these keys has been skipped
+        # since the query was going to change anyway.
+        self.coalesced_keys = 0
         # `self.last_search_results` holds the last search. This attribute
         # works in conjunction with the attribute `self.refind_tags`
         self.last_search_results = []
-
-        # `self.old_tagfiles` is needed to keep track of the temporary files
-        # created to store the output of ctags-compatible programs so
-        # that we can delete it when a new ones are generated.
-        self.old_tagfiles = []
+        # `self.results_cache` remembers the results of recent searches, so
+        # that when the user deletes some characters or types again a
+        # recent query results are returned without searching at all.
+        # Results are remembered for the set of tags they were found in
+        # (see `_tags_version`): `self.tags_origin` tells where the tags in
+        # `self.tags_cache` come from and `self.tags_index` is the tag
+        # index they come from, if any.
+        self.results_cache = misc.LRUCache(RESULTS_CACHE_SIZE)
+        self.tags_origin = None
+        self.tags_index = None
+
+        # `self.narrowing` is a stack of narrowing steps, one for each prefix
+        # of the current query. Each step has the form:
+        #   (query, number of tags searched, [index of matching tag, ...],
+        #    best matches)
+        # where best matches are (index, similarity, match positions) tuples.
+        # This way when the query grows only tags that matched the previous
+        # query are matched again, and when the user deletes a character the
+        # previous matches are restored without searching at all. While tags
+        # are generated, only tags added since a step was computed need to
+        # be searched to bring it up to date.
+        self.narrowing = []
+
+        # `self.remote_tagfile` is the tag file written by the tag server
+        # (see `tsurf.daemon`) for the current project, if any, and
+        # `self.remote_generating` is True while the server is generating
+        # tags.
+        self.remote_tagfile = ""
+        self.remote_generating = False
+        # `self.remote_failed` identifies the socket of a tag server that
+        # didn't answer (see `_find_tags_remote`), if any.
+        self.remote_failed = None
+
+        # `self.tagfile` is the tag file, added to the `tags` option, that
+        # holds the tags of the current search scope. There is a single tag
+        # file for each scope in the directory `self.tagfile_dir`, replaced
+        # every time tags are generated again.
+        self.tagfile = ""
+        self.tagfile_dir = ""
 
         # Some stuff required by Windows
         self.startupinfo = None
@@ -69,60 +127,160 @@ class Finder:
 
     def close(self):
         """To perform cleanup actions."""
-        self._remove_tagfiles()
+        self.cancel()
+        self._use_tagfile("")
+        self._use_remote_tagfile("")
+        if self.tagfile_dir:
+            shutil.rmtree(self.tagfile_dir, ignore_errors=True)
+            self.tagfile_dir = ""
+
+    def cancel(self):
+        """To stop generating tags, if tags are being generated. Running
+        ctags processes are killed and their partial output is discarded."""
+        if self.job:
+            self.job.cancel()
+            self.job = None
+            self.rebuild_tags = True
+
+    def generating(self):
+        """To check whether tags are being generated in the background."""
+        return self.job is not None or self.remote_generating
 
     def find_tags(self, query, max_results=-1, curr_buf=None):
-        """To find all matching tags for the given `query`."""
+        """To find all matching tags for the given `query`.
+
+        If tags need to be generated, generation starts in the background
+        and this method returns right away the best matches among tags
+        generated so far. Call it again (see `self.generating`) to get
+        updated results.
+        """
         # Do not perform a new search if the user is just moving around
-        # in the search results window.
-        if not self.refind_tags and self.last_search_results:
+        # in the search results window, unless new tags are coming.
+        if not self.refind_tags and self.last_search_results and not self.generating():
             return self.last_search_results
 
         # debug
         start_time_tags_gen = datetime.now()
 
+        # Searches in the current project are answered by the tag server
+        # shared by all vim instances, if it's running.
+        results = self._find_tags_remote(query, max_results)
+        if results is not None:
+            if settings.get("debug", bool):
+                self._show_debug_info("debug info => tag server | matches: {} | "
+                    "search: {}ms | coalesced keys: {}{}".format(
+                    len(results), misc.millis(datetime.now() - start_time_tags_gen),
+                    self.coalesced_keys,
+                    " | generating" if self.remote_generating else ""))
+            self.last_search_results = results
+            return self.last_search_results
+
         # Determine for which files tags need to be generated. `query` is
         # also retruned with any modifier removed. Th `query` is also cleaned
         # from the mofifier if present.
-        query, files = self._get_search_scope(query, curr_buf.name)
+        query, scope, files = self._get_search_scope(query, curr_buf.name)
 
         # Generate tags for all given `files` or return cached results if
         # possible.
-        if self.rebuild_tags or not self.tags_cache:
-            tags = self._generate_tags(files=files, curr_ft=curr_buf.ft)
-        else:
-            tags = self.tags_cache
+        if self.rebuild_tags or not (self.tags_cache or self.job):
+            self._start_generation(files, scope)
+        new_tags = self._collect_tags()
+        tags = self.tags_cache
 
         # debug
         delta_tags_gen = datetime.now() - start_time_tags_gen
 
+        if not self.refind_tags and self.last_search_results and not new_tags:
+            return self.last_search_results
+
         # debug
         start_time_tags_search = datetime.now()
         n = 0
 
-        # Match each tag against the give query
-        matches = []
-        for tag in tags:
-            # If `query == ""` then everything matches. Note that if `query == ""`
-            # the current search scope is just the current buffer.
-            similarity, positions = search.search(
-                    query, tag["name"], settings.get("smart_case", int))
-            if positions or not query:
-                if tag["excmd"].isdigit():
-                    context = tag["excmd"]
+        # With no query, results depend on the cursor position too
+        key = (self._tags_version(), query, settings.get("smart_case", int),
+               max_results, curr_buf.cursor[0] if not query else 0)
+        results = self.results_cache.get(key)
+        if results is not None:
+            if settings.get("debug", bool):
+                self._show_debug_info("debug info => recent search | "
+                    "results: {} | search: {}ms | coalesced keys: {}{}".format(
+                    len(results), misc.millis(datetime.now() - start_time_tags_search),
+                    self.coalesced_keys, " | generating" if self.job else ""))
+            self.last_search_results = results
+            return self.last_search_results
+
+        if query:
+
+            # Fuzzy matches are monotonic: a tag that does not match a query
+            # won't match any longer query that starts with it. Hence we drop
+            # all narrowing steps whose query is not a prefix of the current
+            # one and match only the tags that survived the longest prefix.
+            while self.narrowing and not query.startswith(self.narrowing[-1][0]):
+                self.narrowing.pop()
+
+            if self.narrowing and self.narrowing[-1][0] == query:
+                # The user deleted some characters and we already know the
+                # matches for the current query, at least among the tags
+                # that were available at the time.
+                _, searched, matched, best = self.narrowing.pop()
+                indices = xrange(searched, len(tags))
+            else:
+                searched, matched, best = 0, [], []
+                if self.narrowing:
+                    _, prev_searched, prev_matched, _ = self.narrowing[-1]
+                    indices = prev_matched + range(prev_searched, len(tags))
+                else:
+                    indices = xrange(len(tags))
+
+            # Match all tags (names) against the query at once. Only the
+            # best `max_results` matches are returned along with the
+            # indices of all matching tags.
+            if len(indices):
+                args = (query, tags.names, settings.get("smart_case", int),
+                        max_results, indices, tags.charmasks())
+                # Very large sets of tags are searched on all CPUs, but only
+                # the C extension can search in more threads at once
+                threshold = settings.get("parallel_search_threshold", int)
+                if TSURF_SEARCH_EXT_LOADED and 0 < threshold <= len(indices):
+                    new_matched, new_best = shards.search_batch(search, *args,
+                                                                workers=misc.cpus())
                 else:
-                    context = tag["excmd"][2:-2]
-                matches.append({
-                    "match_positions": positions,
-                    "similarity": similarity,
-                    "name": tag["name"],
-                    "file": tag["file"],
-                    "excmd": tag["excmd"],
-                    "context": context,
-                    "exts": tag["exts"]
-                })
-
-            n += 1
+                    new_matched, new_best = search.search_batch(*args)
+                matched = matched + new_matched
+                best = self._merge_best(best, new_best, max_results)
+            n = len(indices)
+            self.narrowing.append((query, len(tags), matched, best))
+
+            # Best matches are sorted from the best to the worst one, but the
+            # best one needs to be displayed at the bottom
+            matches = matched
+            results = [store.Match(tags, i, similarity, positions)
+                       for i, similarity, positions in reversed(best)]
+
+        else:
+
+            # If `query == ""` then everything matches. Note that if
+            # `query == ""` the current search scope is just the current
+            # buffer. Search results are sorted by name or line number
+            # (if available).
+            n = len(tags)
+            matches = tags
+            if tags and tags.line(0):
+                # If a line number is available for locating the tags, then sort
+                # them according to their distance from the cursor.
+                curr_line = curr_buf.cursor[0]
+                keyf = lambda i: abs(curr_line - tags.line(i))
+            else:
+                # Sort by tag name (case-insensitive)
+                keyf = tags.lowers.__getitem__
+
+            # Only the best matches are selected, there is no need to sort
+            # all of them.
+            if max_results < 0:
+                max_results = len(tags)
+            results = [store.Match(tags, i, -1, tuple())
+                       for i in misc.best(xrange(len(tags)), max_results, keyf)]
 
         # debug
         delta_tags_search = datetime.now() - start_time_tags_search
@@ -132,193 +290,389 @@ class Finder:
             time_gen = misc.millis(delta_tags_gen)
             time_search = misc.millis(delta_tags_search)
             s = ("debug info => files: {} | tags: {} | matches: {} | "
-                "gen: {}ms | search: {}ms | C ext: {}".format(
+                "gen: {}ms | search: {}ms | C ext: {} | coalesced keys: {}{}".format(
                  len(files), n, len(matches), time_gen, time_search,
-                 TSURF_SEARCH_EXT_LOADED))
-            vim.command("setl stl={}".format(s.replace(" ", "\ ").replace("|", "\|")))
+                 TSURF_SEARCH_EXT_LOADED, self.coalesced_keys,
+                 " | generating" if self.job else ""))
+            self._show_debug_info(s)
 
-        # Sort the search results according to the similarity value if
-        # the `query` string is non-empty, otherwise sort the search results
-        # by name or line number (if available). Remember that if the query
-        # is epty the only tags for the curretn buffer are generate.
-        if query:
-            keyf = itemgetter("similarity")
-        else:
-            if len(matches) and (matches[0]["exts"].get("line") or matches[0]["excmd"].isdigit()):
-                # If a line number is available for locating the tags, then sort
-                # them according to their distance from the cursor.
-                curr_line = curr_buf.cursor[0]
-                if matches[0]["exts"].get("line"):
-                    keyf = lambda m: abs(curr_line - int(m["exts"]["line"]))
-                else:
-                    keyf = lambda m: abs(curr_line - int(m["excmd"]))
-            else:
-                # Sort by tag name (case-insensitive)
-                keyf = lambda m: m["name"].lower()
-
-        l = len(matches)
-        if max_results < 0 or max_results > l:
-            max_results = l
+        # Results are remembered only once all tags are available. They
+        # are copied along with their tags, since remembering them as they
+        # are would keep all tags in memory until they are evicted.
+        if not self.job:
+            remembered = self._detach(results)
+            self.results_cache.put(key, remembered, misc.deep_size(remembered))
 
         # Retrun only `max-results` search results.
-        self.last_search_results = sorted(matches, key=keyf, reverse=True)[l-max_results:]
+        self.last_search_results = results
         return self.last_search_results
 
-    def _remove_tagfiles(self):
-        """To delete all temporary tagfiles created previously."""
-        for tagfile in self.old_tagfiles:
-            # Don't forget to clean up the `tag` vim option
-            vim.command("set tags-={}".format(tagfile))
-            try:
-                os.remove(tagfile)
-            except OSError:
-                pass
+    def _tags_version(self):
+        """To return a key that changes whenever the set of tags generated
+        by `_start_generation` changes.
+
+        Tags generated again with the same tag index (and the same index
+        version) for the same files are the same tags. While tags are
+        generated, the key is the one of the tags that are being generated,
+        and it changes as soon as the index does.
+        """
+        if self.tags_index is None:
+            return self.tags_origin
+        return self.tags_origin + (self.tags_index.version,)
+
+    def _detach(self, results):
+        """To return a copy of the search results `results` whose tags are
+        held by a store of their own."""
+        tags = self.tags_cache.subset([m.index for m in results])
+        return [store.Match(tags, i, m.similarity, m.match_positions)
+                for i, m in enumerate(results)]
+
+    def _show_debug_info(self, s):
+        """To display `s` in the statusline."""
+        v.command("setl stl={}".format(s.replace(" ", "\ ").replace("|", "\|")))
+
+    def _find_tags_remote(self, query, max_results):
+        """To ask the tag server (see `tsurf.daemon`) for the tags of the
+        current project that match `query`.
+
+        None is returned if the search is not about the current project or
+        the server is not available, so that tags are searched in-process.
+        """
+        self.remote_generating = False
+        pmod = settings.get("project_search_modifier")
+        bmod = settings.get("buffer_search_modifier")
+        path = settings.get("daemon_socket")
+        if not (path and query.strip().startswith(pmod)):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        # A server that didn't answer is not asked again (vim would be
+        # blocked on every key), unless the socket is created again by a
+        # new server.
+        server = (st.st_ino, st.st_mtime)
+        if server == self.remote_failed:
+            return
+        root = self.plug.services.curr_project.get_root()
+        if not root:
+            return
+
+        conf = self._ctags_settings()
+        conf.update(ctags_jobs=settings.get("ctags_jobs", int),
+                    index_dir=settings.get("index_dir"),
+                    wildignore=v.eval("&wildignore"),
+                    use_git=settings.get("use_git", bool))
+        resp = daemon.request(path, {
+            "root": root, "settings": conf,
+            "query": query.strip(" " + bmod + pmod),
+            "smart_case": settings.get("smart_case", int),
+            "max_results": max_results}, timeout=daemon.SEARCH_TIMEOUT)
+
+        if resp is None:
+            # The server is gone: tags generated in-process before the
+            # server was available may be out of date.
+            self.remote_failed = server
+            if self.remote_tagfile:
+                self.rebuild_tags = True
+            self._use_remote_tagfile("")
+            return
+        if "error" in resp:
+            raise ex.TagSurferException(resp["error"])
+
+        self.remote_generating = resp["generating"]
+        self._use_remote_tagfile(resp["tagfile"])
+        tags = store.TagStore()
+        results = []
+        for i, row in enumerate(resp["tags"]):
+            name, file, excmd, kind, extras, similarity, positions = row
+            tags.append(name, file.encode("utf-8"), excmd, kind,
+                        extras.encode("utf-8"))
+            results.append(store.Match(tags, i, similarity, tuple(positions)))
+        return results
+
+    def _use_remote_tagfile(self, tagfile):
+        """To replace the tag file of the tag server in the vim `tags`
+        option."""
+        if tagfile == self.remote_tagfile:
+            return
+        if self.remote_tagfile:
+            v.command("set tags-={}".format(v.escape_tagfile(self.remote_tagfile)))
+        if tagfile:
+            v.command("set tags+={}".format(v.escape_tagfile(tagfile)))
+        self.remote_tagfile = tagfile
+
+    def _merge_best(self, best, new, max_results):
+        """To merge two lists of best matches, each sorted from the best to
+        the worst one."""
+        if not best:
+            return new
+        if max_results < 0:
+            max_results = len(best) + len(new)
+        return heapq.nsmallest(max_results, best + new, key=lambda m: (m[1], -m[0]))
+
+    def _start_generation(self, files, scope):
+        """To start generating tags for `files` in the background. Tags
+        generated previously are thrown away."""
+        self.cancel()
+        self.tags_cache = store.TagStore()
+        self.narrowing = []
+        self.last_search_results = []
+
+        # Everything that needs vim is done here, in the main thread
+        cancelled = threading.Event()
+
+        # Tags files that already exist in the project are used as they are
+        tagfiles = self._project_tagfiles() if scope == "project" else []
+        conf = self._ctags_settings()
+        if tagfiles:
+            self._use_tagfile("")
+            options = ctags.group_options("*", conf)
+            gen = self._read_tagfiles(tagfiles, options, cancelled)
+            self.tags_origin = (scope, tuple((path, index.signature(path))
+                                             for path in tagfiles))
+            self.tags_index = None
+        else:
+            tindex = self._get_index()
+            self.tags_origin = (scope, hash(tuple(files)), tindex.root)
+            self.tags_index = tindex
+            groups = ctags.group_files(files, conf["custom_languages"])
+            options = dict((ft, ctags.group_options(ft, conf)) for ft in groups)
+            jobs = ctags.workers(settings.get("ctags_jobs", int))
+            path = self._scope_tagfile(scope)
+            self._use_tagfile(path)
+            gen = self._generate_tags(files, scope, tindex, groups, options,
+                                      jobs, path, cancelled)
+
+        self.job = job.Job(gen, cancelled)
+        self.job.start()
+
+    def _collect_tags(self):
+        """To move all tags generated in the background since the last call
+        into `self.tags_cache`. Returns the number of new tags."""
+        if not self.job:
+            return 0
+        try:
+            tags = self.job.take()
+        except ex.TagSurferException:
+            self.job = None
+            raise
+        for tag in tags:
+            self.tags_cache.append(*tag)
+        if self.job.done():
+            self.job = None
+        return len(tags)
+
+    def _scope_tagfile(self, scope):
+        """To return the path of the tag file for the search scope `scope`."""
+        if not self.tagfile_dir:
+            self.tagfile_dir = tempfile.mkdtemp(prefix="tsurf")
+        return os.path.join(self.tagfile_dir, scope + ".tags")
+
+    def _use_tagfile(self, tagfile):
+        """To replace the tag file of the search scope in the `tags` option.
+        The option is left untouched when the scope doesn't change."""
+        if tagfile == self.tagfile:
+            return
+        if self.tagfile:
+            v.command("set tags-={}".format(v.escape_tagfile(self.tagfile)))
+        if tagfile:
+            v.command("set tags+={}".format(v.escape_tagfile(tagfile)))
+        self.tagfile = tagfile
 
     def _get_search_scope(self, query, curr_buf_name):
-        """To return all files for which tags need to be generated."""
+        """To return all files for which tags need to be generated along
+        with the search scope ("buffer", "buffers" or "project")."""
         pmod = settings.get("project_search_modifier")
         bmod = settings.get("buffer_search_modifier")
         files = []
+        scope = ""
         if curr_buf_name and (not query or query.strip().startswith(bmod)):
             # Retrun only the current buffer
             files = [curr_buf_name]
+            scope = "buffer"
         elif query.strip().startswith(pmod):
             # Retrun all files of the current project. If the project root
             # cannot be located, the retruned list is empty.
-            files = self.plug.services.curr_project.get_files()
+            files = self.plug.services.curr_project.get_files(
+                refresh=self.rebuild_tags)
+            scope = "project"
         if not files:
             # Retrun all loaded buffers
             files = v.buffers()
+            scope = "buffers"
 
-        return query.strip(" " + bmod + pmod), files
+        return query.strip(" " + bmod + pmod), scope, files
 
-    def _generate_tags(self, files, curr_ft=None):
+    def _generate_tags(self, files, scope, tindex, groups, options, jobs,
+                       path, cancelled):
         """To generate tags for files in `files`.
 
+        Tags are taken from the tag index `tindex` and ctags is executed only
+        for files that have been added or changed since the last time tags
+        were generated for them.
+
         If a filetype isn't supported by Exuberant Ctags, then use the custom
         ctags executable provided via the `tsurf_custom_languages` option.
-        """
-        # Clean old tagfiles
-        self._remove_tagfiles()
-
-        custom_langs = settings.get("custom_languages")
-
-        # Create a map where each file extension points to
-        # a specific filetype.
-        extensions_map = {}
-        for ft, options in custom_langs.items():
-            for ext in options.get("extensions", []):
-                extensions_map[ext] = ft
-
-        # Group files according to their filetype. The filetype "*"
-        # groups all files that will be parsed by Exuberant Ctags.
-        # Note that filetype groups different from "*" are generated
-        # only for filetypes found in `tsurf_custom_languages`
-        groups = defaultdict(list)
-        for f in files:
-            ext = os.path.splitext(f)[1]
-            groups[extensions_map.get(ext, "*")].append(f)
-
-        self.tags_cache = []
-        # For each filetype group, generate tags according to the ctags
-        # program specified for that filetype. Doind so ensures that
-        # if the user is working with different filetypes at the same time,
-        # tags are generated transparently for each different (possibly
-        # not supported by Exuberant Ctags) filetype.
-        for ft, file_group in groups.items():
 
-            if ft == "*":
-                # use the official ctags
-                bin = settings.get("ctags_bin")
-                args = settings.get("ctags_args")
-                custom_args = settings.get("ctags_custom_args")
-                kinds = {}
-                exclude_kinds = {}
-            else:
-                bin = custom_langs[ft].get("bin", "")
-                args = custom_langs[ft].get("args", "")
-                custom_args = ""
-                kinds = custom_langs[ft].get("kinds_map", {})
-                exclude_kinds = dict((k, True) for k in custom_langs[ft].get("exclude_kinds", []))
-
-            out = ""
-            if os.path.exists(bin):
-                # We don't really want an error message when Tag Surfer is executed and no
-                # files are available
-                if file_group:
-                    files = imap(lambda f: '"{}"'.format(f) if " " in f else f, file_group)
-                    cmd = shlex.split("{} {} {} {}".format(self.sanitize(bin),
-                        self.sanitize(args), self.sanitize(custom_args),
-                        self.sanitize(" ".join(files))))
-
-                    try:
-                        out, err = subprocess.Popen(cmd, universal_newlines=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                startupinfo=self.startupinfo).communicate()
-                    except Exception as e:
-                        raise ex.TagSurferException("Unexpected error: " + str(e))
-
-                    if err:
-                        raise ex.TagSurferException("Error: '{}' failed to generate "
-                            "tags.\nCheck that it's an Exuberant Ctags "
-                            "compatible program or that the arguments provided "
-                            "are valid".format(bin))
-            else:
-                raise ex.TagSurferException("Error: The program '{}' does not exists "
-                    "or cannot be found in your $PATH".format(bin))
-
-            # Parse the ctags program output, rebuild the cache and write
-            # a copy of the output to a temporary file.  Why writing a copy of
-            # the output to a temporary file? We do this because the temporary
-            # file is appendend to the `tags` option (set tags+=tempfile) so
-            # that the user can still use vim tag-related commands for
-            # navigating tags, most notably the `CTRL+t` mapping.
-            tagfile = self._generate_temporary_tagfile()
-            with tagfile:
-                for line in out.split("\n"):
-                    tagfile.write(line + "\n")
-                    tag = self._parse_tag_line(line, kinds)
-                    if tag and tag["exts"].get("kind") not in exclude_kinds:
-                        self.tags_cache.append(tag)
-                        yield tag
-
-    def _generate_temporary_tagfile(self):
-        """To generate a new temporary tagfile and update the vim
-        `tags` option."""
-        tagfile = tempfile.NamedTemporaryFile(delete=False)
-        vim.command("set tags+={}".format(tagfile.name))
-        self.old_tagfiles.append(tagfile.name)
-        return tagfile
-
-    def _parse_tag_line(self, line, kinds):
-        """To parse a line from a tag file.
-
-        Valid tag line format:
-
-            tagName<TAB>tagFile<TAB>exCmd;"<TAB>extensions
-
-        Where `extensions` is a list of <TAB>-separated fields that can be:
-
-            1) a single letter
-            2) a string `attribute:value`
-
-        If the fields is a single letter, then the fields is interpreted as
-        the kind attribute.
-
-        NOTE: `kinds` is a dictionary of the form:
-
-            {"shortTypeName": "longTypeName", ...}
+        This generator runs in a background thread (see `_start_generation`),
+        hence it must not use vim: `groups` are the files grouped by
+        filetype, `options` the ctags options for each group and `jobs` the
+        number of concurrent ctags processes. If `cancelled` is set, ctags
+        processes are killed and the index is left untouched.
+
+        Once all tags have been generated, they replace the content of the
+        tag file `path`.
         """
+        # When the search scope is the whole project, files that are no
+        # longer part of the project have been deleted (or ignored).
+        if scope == "project":
+            tindex.prune(files, cancelled)
+
+        stale = tindex.stale(files, cancelled)
+        if cancelled.is_set():
+            return
+
+        # Keep a copy of all tag lines for the tag file. Why writing a copy
+        # of the tags to a tag file? We do this because the tag file is
+        # appendend to the `tags` option (set tags+=tagfile) so that the user
+        # can still use vim tag-related commands for navigating tags, most
+        # notably the `CTRL+t` mapping.
+        all_lines = []
+
+        # Tags for files that did not change are available right away
+        for ft, file_group in groups.items():
+            opts = options[ft]
+            for f in file_group:
+                if f not in stale:
+                    for line in tindex.lines(f):
+                        all_lines.append(line)
+                        tag = self._process_tag_line(line, opts)
+                        if tag:
+                            yield tag
+
+        # For each filetype group, generate tags for stale files according
+        # to the ctags program specified for that filetype. Doind so
+        # ensures that if the user is working with different filetypes at
+        # the same time, tags are generated transparently for each
+        # different (possibly not supported by Exuberant Ctags) filetype.
+        # Tags are yielded as soon as ctags outputs them.
+        for ft, file_group in groups.items():
+            stale_group = [f for f in file_group if f in stale]
+            if not stale_group:
+                continue
+            opts = options[ft]
+            lines = []
+            # Custom ctags programs may not support reading the list of
+            # files from the standard input.
+            for line in self._stream_ctags(opts["bin"], opts["args"],
+                    opts["custom_args"], stale_group, jobs, ft == "*",
+                    cancelled):
+                lines.append(line)
+                tag = self._process_tag_line(line, opts)
+                if tag:
+                    yield tag
+            if cancelled.is_set():
+                return
+            tindex.merge(dict((f, stale[f]) for f in stale_group), lines)
+            all_lines.extend(lines)
+
+        # Writing the tag file and saving the index may take a while:
+        # cancelling the job must not wait for them
+        if cancelled.is_set():
+            return
         try:
-            fields, rawexts = line.strip(" \n").split(';"', 1)
-            name, file, excmd = (f.decode("utf-8") for f in fields.split("\t"))
-            exts = {}
-            for ext in rawexts.strip("\t").split("\t"):
-                if (len(ext) == 1 and ext.isalpha()) or ":" not in ext:
-                    exts["kind"] = kinds.get(ext, ext).decode("utf-8")
-                else:
-                    t, val = ext.split(":", 1)
-                    exts[t] = val.decode("utf-8")
-            return {'name': name, 'file': file, 'excmd': excmd, 'exts': exts}
-        except ValueError:
+            tagfile.write(path, all_lines)
+        except (IOError, OSError) as e:
+            raise ex.TagSurferException(
+                "Error: Cannot write the tag file '{}': {}".format(path, e))
+        if cancelled.is_set():
             return
+        tindex.save()
+
+    def _project_tagfiles(self):
+        """To return the tags files found by vim (see the `tags` option)
+        inside the current project, if the user wants them to be used."""
+        if not settings.get("use_tagfiles", bool):
+            return []
+        root = self.plug.services.curr_project.get_root()
+        if not root:
+            return []
+        cwd = v.cwd()
+        tagfiles = []
+        for path in v.eval("tagfiles()"):
+            path = os.path.normpath(os.path.join(cwd, path))
+            if path.startswith(os.path.join(root, "")):
+                tagfiles.append(path)
+        return tagfiles
+
+    def _read_tagfiles(self, paths, opts, cancelled):
+        """To yield all tags found in the tags files `paths`, unless their
+        kind is excluded by the options `opts`.
+
+        Files are memory-mapped and tags are parsed one line at a time. File
+        names relative to the directory of the tags file are made absolute.
+        This generator runs in a background thread (see `_start_generation`),
+        hence it must not use vim.
+        """
+        for path in paths:
+            folder = os.path.dirname(path)
+            files = {}
+            with tagfile.TagFile(path) as tags:
+                for line in tags.lines():
+                    if cancelled.is_set():
+                        return
+                    tag = store.parse(line, opts["kinds"])
+                    if not tag or tag[3] in opts["exclude_kinds"]:
+                        continue
+                    name, file, excmd, kind, extras = tag
+                    f = files.get(file)
+                    if f is None:
+                        f = files[file] = os.path.join(folder, file)
+                    yield name, f, excmd, kind, extras
+
+    def _process_tag_line(self, line, opts):
+        """To return the parsed tag of `line`, unless its kind is excluded
+        for the filetype group options `opts`."""
+        tag = store.parse(line, opts["kinds"])
+        if tag and tag[3] not in opts["exclude_kinds"]:
+            return tag
+
+    def _get_index(self):
+        """To return the tag index for the current project.
+
+        The index is keyed by the project root. When no project root can be
+        located the index is kept only in memory.
+        """
+        root = self.plug.services.curr_project.get_root()
+        config = ctags.fingerprint(self._ctags_settings())
+        tindex = self.indexes.get(root)
+        if tindex is None or tindex.config != config:
+            path = index.path_for(settings.get("index_dir"), root, config)
+            tindex = index.TagIndex.load(root, path, config)
+            self.indexes[root] = tindex
+            # Versions of different indexes can't be compared
+            self.results_cache.clear()
+        return tindex
+
+    def _ctags_settings(self):
+        """To return the settings that tell how tags are generated (see
+        `ctags.SETTINGS`)."""
+        return dict((name, settings.get(name)) for name in ctags.SETTINGS)
+
+    def _stream_ctags(self, bin, args, custom_args, files, jobs,
+                      file_list=True, cancelled=None):
+        """To run the ctags program `bin` on `files` and yield its output
+        line by line.
+
+        Files are split into chunks handled by at most `jobs` concurrent
+        ctags processes (see the `tsurf_ctags_jobs` option).
+        """
+        if not os.path.exists(bin):
+            raise ex.TagSurferException("Error: The program '{}' does not exists "
+                "or cannot be found in your $PATH".format(bin))
+
+        cmd = ctags.command(bin, args, custom_args, self.sanitize)
+        return ctags.stream(cmd, files, jobs, file_list, self.startupinfo,
+                            cancelled)
+
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.index
+~~~~~~~~~~~
+
+This module defines the TagIndex class. A tag index keeps the raw ctags
+output for every file it knows about together with the file signature
+(mtime, size and inode) at the time tags were generated. This way ctags
+needs to be executed only for files that have been added or changed since
+the last build, and the index can be saved on disk and reused across vim
+sessions.
+"""
+
+import os
+import stat
+import hashlib
+import tempfile
+import cPickle as pickle
+
+
+class TagIndex:
+
+    # Bump this number whenever the format of the persisted index changes
+    FORMAT = 1
+
+    def __init__(self, root="", path="", config=""):
+        self.root = root
+        # `self.path` is the file where the index is persisted. If empty,
+        # the index lives only in memory.
+        self.path = path
+        # `self.config` is a fingerprint of the ctags settings used to
+        # generate the index. If settings change, the index is thrown away.
+        self.config = config
+        # `self.entries` has the form:
+        #   {file: ((mtime, size, inode), [tag line, ...]), ...}
+        self.entries = {}
+        # `self.version` is incremented every time the index changes
+        self.version = 0
+        self.dirty = False
+
+    @classmethod
+    def load(cls, root, path, config):
+        """To load the index persisted at `path`. An empty index is
+        returned if there is nothing to load or the persisted index has been
+        generated with different settings."""
+        tindex = cls(root, path, config)
+        if not path or not os.path.exists(path):
+            return tindex
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            return tindex
+        if (data.get("format") == cls.FORMAT and data.get("root") == root
+                and data.get("config") == config):
+            tindex.entries = data["entries"]
+        return tindex
+
+    def save(self):
+        """To persist the index on disk if something changed."""
+        if not self.path or not self.dirty:
+            return
+        data = {"format": self.FORMAT, "root": self.root,
+                "config": self.config, "entries": self.entries}
+        tmp = None
+        try:
+            folder = os.path.dirname(self.path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # Other vim instances (or the tag server) may be saving the same
+            # index right now: each one writes its own temporary file
+            fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            if os.name == "nt" and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+            tmp = None
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+        finally:
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    def stale(self, files, cancelled=None):
+        """To return a dictionary with the new signature of each file in
+        `files` that has been added or changed since tags were last generated
+        for it. Files that no longer exist are removed from the index.
+
+        If the event `cancelled` is set, files are no longer checked and the
+        dictionary is returned as it is.
+        """
+        stale = {}
+        for f in files:
+            if cancelled is not None and cancelled.is_set():
+                break
+            sig = signature(f)
+            if sig is None:
+                self.remove([f])
+            else:
+                entry = self.entries.get(f)
+                if entry is None or entry[0] != sig:
+                    stale[f] = sig
+        return stale
+
+    def merge(self, sigs, lines):
+        """To replace the tags of all files in `sigs` with the tag lines
+        found in `lines`. Files for which no tag line is found are still
+        recorded so that ctags won't run for them again.
+
+        Custom ctags programs may write file names relative to the project
+        root (or to the current directory) or not normalized, hence file
+        names are compared once normalized. If `lines` has tags but none of
+        them belongs to a file in `sigs`, file names can't be matched at all
+        and nothing is recorded.
+        """
+        by_file = dict((f, []) for f in sigs)
+        normalized = dict((os.path.normpath(f), f) for f in sigs)
+        found = 0
+        for line in lines:
+            f = line_file(line)
+            if f is None:
+                continue
+            found += 1
+            if f not in by_file:
+                f = (normalized.get(os.path.normpath(os.path.join(self.root, f)))
+                     or normalized.get(os.path.abspath(f)))
+            if f is not None:
+                by_file[f].append(line)
+        if found and not any(by_file.values()):
+            return
+        for f, file_lines in by_file.items():
+            self.entries[f] = (sigs[f], file_lines)
+        if by_file:
+            self._touch()
+
+    def remove(self, files, cancelled=None):
+        """To remove the given `files` from the index. If the event
+        `cancelled` is set, files are no longer removed."""
+        for f in files:
+            if cancelled is not None and cancelled.is_set():
+                break
+            if self.entries.pop(f, None) is not None:
+                self._touch()
+
+    def prune(self, files, cancelled=None):
+        """To remove every file that is not in `files` from the index (see
+        `remove` for `cancelled`)."""
+        keep = set(files)
+        self.remove([f for f in self.entries if f not in keep], cancelled)
+
+    def lines(self, file):
+        """To return all tag lines for the given `file`."""
+        entry = self.entries.get(file)
+        return entry[1] if entry else []
+
+    def _touch(self):
+        self.version += 1
+        self.dirty = True
+
+
+def signature(file):
+    """To return the signature of the given `file`. `None` is returned if
+    the file does not exist or it is not a regular file."""
+    try:
+        st = os.stat(file)
+    except OSError:
+        return
+    if not stat.S_ISREG(st.st_mode):
+        return
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def line_file(line):
+    """To return the file field of a tag line."""
+    fields = line.split("\t", 2)
+    return fields[1] if len(fields) > 2 else None
+
+
+def path_for(folder, root, config=""):
+    """To return the file where the index for the project `root`, generated
+    with the settings whose fingerprint is `config`, is persisted inside
+    `folder`."""
+    if not folder or not root:
+        return ""
+    name = hashlib.md5(root).hexdigest()
+    if config:
+        name += "-" + hashlib.md5(config).hexdigest()[:8]
+    return os.path.join(folder, name + ".idx")
@@ -7,9 +7,9 @@ This module defines services used by any of the Tag Surfer components.
 """
 
 import os
-import vim
 
 from tsurf.utils import v
+from tsurf.utils import fs
 from tsurf.utils import settings
 
 
@@ -24,60 +24,111 @@ class CurrentProjectService:
 
     def __init__(self):
         self.custom_root = ""
-        self.root_cache = ""
-        self.files_cache = []
-
-    def get_files(self):
+        # `self.roots_cache` has the form {directory: (root, marker), ...}
+        # and remembers the project root of every directory visited while
+        # looking for a root, along with the marker found in the root, for
+        # the markers in `self.root_markers`. The root is "" (and the marker
+        # None) for directories that are not in any project.
+        self.roots_cache = {}
+        self.root_markers = ()
+        # `self.files_cache` has the form {root: fs.ProjectFiles(..), ...}
+        self.files_cache = {}
+
+    def get_files(self, refresh=True):
         """To get all files in the current project.
 
         The current working directory is derived from the path of
         the current open buffer. If `autochdir` is off this may differ
         from the output of the `:pwd` command.
+
+        The file list of each project is cached and kept up to date as files
+        are added or removed. If `refresh` is False, the cached list is
+        returned without checking for changes.
         """
-        files = []
         root = self.get_root()
-        if root:
-            cond1 = self.files_cache
-            cond2 = cond1 and not self.files_cache[0].startswith(root)
-            if not cond1 or cond2:
-                # Get all files for the current project. Note that the `glob()`
-                # function ignore everything that matches with any of the
-                # wildcards listed in the `wildignore` option.
-                # Note: the `glob()` function wants forward slashes even on
-                # Windows
-                expr = os.path.join(root, "**").replace("\\", "/")
-                files = vim.eval('glob("{}")'.format(expr)).split("\n")
-                self.files_cache = files
-            else:
-                files = self.files_cache
-
-        return files
+        if not root:
+            return []
+
+        # Everything that matches with any of the wildcards listed in the
+        # `wildignore` option or with any `.gitignore` pattern is ignored.
+        wildignore = v.eval("&wildignore")
+        use_git = settings.get("use_git", bool)
+        files = self.files_cache.get(root)
+        if (files is None or files.wildignore != wildignore
+                or files.use_git != use_git):
+            files = fs.ProjectFiles(root, wildignore, use_git)
+            self.files_cache[root] = files
+        elif not refresh and files.files is not None:
+            return files.files
+
+        return files.get()
 
     def get_root(self):
         """To return the current project root."""
         if self.custom_root:
             return self.custom_root
 
-        if not self.root_cache:
-            root = self._find_project_root(v.cwd(),
-                settings.get("root_markers"))
-            self.root_cache = root
-
-        return self.root_cache
+        return self._find_project_root(v.cwd(), settings.get("root_markers"))
 
     def set_root(self, root):
         """To set a custom root for the current project."""
         self.custom_root = root
+        self.forget_roots()
+
+    def forget_roots(self, found=True):
+        """To forget the project roots found so far, since markers may have
+        been added or removed in the meantime. If `found` is False, only
+        directories for which no root was found are forgotten."""
+        if found:
+            self.roots_cache = {}
+        else:
+            self.roots_cache = dict((path, entry) for path, entry
+                                    in self.roots_cache.items() if entry[0])
 
     def _find_project_root(self, path, root_markers):
         """To find the the root of the current project.
 
         `markers` is a list of file/directory names the can be found
         in a project root directory.
+
+        The root found (or not found) is remembered for `path` and for each
+        directory visited on the way up, so that looking for the root of any
+        of them again costs just a dictionary lookup and a check that the
+        marker found in the root is still there.
         """
-        if path == "/" or path.endswith(":\\"):
-            return ""
-        elif any(m in os.listdir(path) for m in root_markers):
-            return path
-        else:
-            return self._find_project_root(os.path.dirname(path), root_markers)
+        markers = tuple(root_markers)
+        if markers != self.root_markers:
+            self.roots_cache = {}
+            self.root_markers = markers
+
+        start = path
+        found = ("", None)
+        visited = []
+        while not (path == "/" or path.endswith(":\\")):
+            entry = self.roots_cache.get(path)
+            if entry is not None:
+                root, marker = entry
+                if root and not os.path.exists(os.path.join(root, marker)):
+                    # The root is no longer a root: start over
+                    self.roots_cache = {}
+                    path, visited = start, []
+                    continue
+                found = entry
+                break
+            visited.append(path)
+            marker = self._root_marker(path, markers)
+            if marker:
+                found = (path, marker)
+                break
+            path = os.path.dirname(path)
+
+        for path in visited:
+            self.roots_cache[path] = found
+        return found[0]
+
+    def _root_marker(self, path, markers):
+        """To return the first of the `markers` found in the directory
+        `path`, if any."""
+        for m in markers:
+            if os.path.exists(os.path.join(path, m)):
+                return m
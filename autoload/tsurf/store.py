@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.store
+~~~~~~~~~~~
+
+This module defines the TagStore class and the views used to access its
+tags. Projects may have hundreds of thousands of tags, hence tags are not
+stored as dictionaries but column by column in parallel lists and arrays:
+file paths and kinds are interned and stored as integer ids and the
+lowercase variant of each name is computed only once, when the tag is added.
+Extension fields other than the kind are kept as they are found in the tag
+line and parsed only when they are needed, that is, for the few tags that
+are actually displayed.
+"""
+
+from array import array
+from itertools import imap, islice
+
+try:
+    from tsurf.ext import search
+except ImportError:
+    from tsurf.utils import search
+
+
+class TagStore:
+
+    def __init__(self):
+        # `self.names[i]` is the name of the i-th tag. This list is given
+        # as it is to the search functions.
+        self.names = []
+        # `self.lowers[i]` is the lowercase name of the i-th tag. When the
+        # name is already lowercase, the same string object is reused.
+        self.lowers = []
+        self.excmds = []
+        # `self.files[i]` and `self.kinds[i]` are ids into `self.file_names`
+        # and `self.kind_names`. The kind id 0 means that the tag has no
+        # kind.
+        self.files = array("i")
+        self.file_names = []
+        self.file_ids = {}
+        self.kinds = array("i")
+        self.kind_names = [None]
+        self.kind_ids = {}
+        # `self.extras[i]` holds the raw (not decoded) extension fields of
+        # the i-th tag, as found in the tag line.
+        self.extras = []
+        # `self.masks[i]` is the character mask of the name of the i-th tag
+        # (see `search.charmask`). Masks are computed only when tags are
+        # searched, see `charmasks`.
+        self.masks = array("L")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return Tag(self, i)
+
+    def append(self, name, file, excmd, kind, extras):
+        """To add a tag to the store. `file` and `extras` (the raw
+        extension fields) are utf-8 encoded strings, the other arguments are
+        unicode strings. `kind` may be None."""
+        lower = name.lower()
+        self.names.append(name)
+        self.lowers.append(name if lower == name else lower)
+        self.excmds.append(excmd)
+        self.extras.append(extras)
+
+        # File paths are decoded only the first time they are seen
+        i = self.file_ids.get(file)
+        if i is None:
+            i = self.file_ids[file] = len(self.file_names)
+            self.file_names.append(file.decode("utf-8"))
+        self.files.append(i)
+
+        if kind is None:
+            self.kinds.append(0)
+        else:
+            i = self.kind_ids.get(kind)
+            if i is None:
+                i = self.kind_ids[kind] = len(self.kind_names)
+                self.kind_names.append(kind)
+            self.kinds.append(i)
+
+    def subset(self, indices):
+        """To return a new store that holds only the tags at `indices`, in
+        the given order."""
+        tags = TagStore()
+        for i in indices:
+            tags.append(self.names[i], self.file_names[self.files[i]].encode("utf-8"),
+                        self.excmds[i], self.kind_names[self.kinds[i]],
+                        self.extras[i])
+        return tags
+
+    def charmasks(self):
+        """To return the character masks of all tags. Masks of the tags
+        added since the last call are computed now."""
+        if len(self.masks) < len(self.lowers):
+            self.masks.extend(imap(search.charmask,
+                                   islice(self.lowers, len(self.masks), None)))
+        return self.masks
+
+    def exts(self, i):
+        """To return all extension fields of the i-th tag as a dictionary."""
+        exts = {}
+        for ext in self.extras[i].split("\t"):
+            if ":" in ext:
+                t, val = ext.split(":", 1)
+                exts[t] = val.decode("utf-8")
+        kind = self.kind_names[self.kinds[i]]
+        if kind is not None:
+            exts["kind"] = kind
+        return exts
+
+    def line(self, i):
+        """To return the line number of the i-th tag, taken either from the
+        `line` extension field or from the ex command. 0 is returned if no
+        line number is available."""
+        extras = self.extras[i]
+        start = ("\t" + extras).find("\tline:")
+        if start >= 0:
+            line = extras[start+5:].split("\t", 1)[0]
+        else:
+            line = self.excmds[i]
+        return int(line) if line.isdigit() else 0
+
+
+def parse(line, kinds):
+    """To parse a line from a tag file.
+
+    Valid tag line format:
+
+        tagName<TAB>tagFile<TAB>exCmd;"<TAB>extensions
+
+    Where `extensions` is a list of <TAB>-separated fields that can be:
+
+        1) a single letter
+        2) a string `attribute:value`
+
+    If the fields is a single letter, then the fields is interpreted as
+    the kind attribute.
+
+    Only the name, the ex command and the kind are decoded. The tag is
+    returned as a tuple (name, file, excmd, kind, extensions) that can be
+    given as it is to `TagStore.append`. None is returned if the line is
+    not valid.
+
+    NOTE: `kinds` is a dictionary of the form:
+
+        {"shortTypeName": "longTypeName", ...}
+    """
+    try:
+        fields, extras = line.strip(" \n").split(';"', 1)
+        name, file, excmd = fields.split("\t")
+    except ValueError:
+        return
+    kind = None
+    for ext in extras.split("\t"):
+        if not ext:
+            continue
+        if ":" not in ext:
+            kind = ext
+            break
+        if ext.startswith("kind:"):
+            kind = ext[5:]
+            break
+    if kind is not None:
+        kind = kinds.get(kind, kind).decode("utf-8")
+    return name.decode("utf-8"), file, excmd.decode("utf-8"), kind, extras
+
+
+class Tag(object):
+    """A lightweight view of a single tag in a TagStore."""
+
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def name(self):
+        return self.store.names[self.index]
+
+    @property
+    def file(self):
+        return self.store.file_names[self.store.files[self.index]]
+
+    @property
+    def excmd(self):
+        return self.store.excmds[self.index]
+
+    @property
+    def kind(self):
+        return self.store.kind_names[self.store.kinds[self.index]]
+
+    @property
+    def line(self):
+        """The line number of the tag (as a string) if available."""
+        line = self.store.line(self.index)
+        return unicode(line) if line else u""
+
+    @property
+    def context(self):
+        excmd = self.excmd
+        return excmd if excmd.isdigit() else excmd[2:-2]
+
+    @property
+    def exts(self):
+        return self.store.exts(self.index)
+
+
+class Match(Tag):
+    """A view of a tag matching a search query."""
+
+    __slots__ = ("similarity", "match_positions")
+
+    def __init__(self, store, index, similarity, match_positions):
+        Tag.__init__(self, store, index)
+        self.similarity = similarity
+        self.match_positions = match_positions
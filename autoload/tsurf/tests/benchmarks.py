@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks.py
+~~~~~~~~~~~~~
+
+Benchmarks for tsurf.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import timeit
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+from tsurf import store
+from tsurf.utils import fs
+from tsurf.utils import misc
+from tsurf.utils import search
+from tsurf.utils import shards
+from tsurf.tests import vimstub
+from tsurf.ext import search as _search
+
+
+def timeit_best(fn, number, repeat=3):
+    """To return the best time in microseconds of a single call to `fn`."""
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+# benchmarks for the module 'tsurf.utils.search'
+# ===========================================================================
+
+# (needle, haystack) pairs. The last ones are worst cases for a matcher that
+# explores every possible match since repeated characters can be matched in
+# many different ways.
+SEARCH_CASES = [
+    ("cls", "clusterSendMessage"),
+    ("send", "clusterSendMessage"),
+    ("gtn", "get_tag_name_for_buffer"),
+    ("xyz", "clusterSendMessage"),
+    ("aaaa", "aaaa_bbbb_aaaa"),
+    ("aaaaaa", "aaaa_bbbb_aaaa_aaaa"),
+    ("abab", "abababababababab"),
+    ("aaaaaaaa", "a" * 24),
+    ("abababab", "ab" * 20),
+]
+
+
+def bench_search():
+    for module in (search, _search):
+        print module.__name__ + ".search"
+        for needle, haystack in SEARCH_CASES:
+            t = timeit_best(lambda: module.search(needle, haystack, True), 100)
+            print "  {:<10} {:<42} {:>10.1f}us".format(needle, haystack, t)
+
+
+def names(n, seed=0):
+    """To generate `n` random camelCase and snake_case tag names."""
+    rand = random.Random(seed)
+    words = ["get", "set", "tag", "name", "buffer", "file", "search", "send",
+             "message", "cluster", "index", "cache", "render", "line", "query",
+             "update", "result", "window", "scope", "parse", "open", "close"]
+    out = []
+    for _ in range(n):
+        parts = [rand.choice(words) for _ in range(rand.randint(1, 4))]
+        if rand.random() < 0.5:
+            out.append(u"_".join(parts))
+        else:
+            out.append(parts[0] + u"".join(p.capitalize() for p in parts[1:]))
+    return out
+
+
+def bench_search_batch():
+    haystacks = names(100000)
+    print "search 100000 tag names, 15 best results"
+    for query in ("s", "gtn", "sendMsg"):
+        loop = lambda: [_search.search(query, h, True) for h in haystacks]
+        batch = lambda: _search.search_batch(query, haystacks, True, 15)
+        print "  {:<10} per-tag calls: {:>8.1f}ms   search_batch: {:>8.1f}ms".format(
+            query, timeit_best(loop, 1) / 1000, timeit_best(batch, 1) / 1000)
+
+
+# benchmarks for the module 'tsurf.store'
+# ===========================================================================
+
+def tag_lines(n, seed=0):
+    """To generate `n` random tag lines."""
+    rand = random.Random(seed)
+    files = ["/home/user/project/src/module{}/file{}.py".format(i % 40, i)
+             for i in range(max(1, n // 50))]
+    out = []
+    for name in names(n, seed):
+        exts = "\t{}\tline:{}".format(rand.choice("fcmv"), rand.randint(1, 2000))
+        if rand.random() < 0.5:
+            exts += "\tclass:Class{}\taccess:public".format(rand.randint(0, 100))
+        if rand.random() < 0.5:
+            exts += "\tsignature:(self, *args, **kwargs)"
+        out.append('{0}\t{1}\t/^    def {0}(self, *args):$/;"{2}'.format(
+            name, rand.choice(files), exts))
+    return out
+
+
+def parse_dict(line, kinds):
+    """To parse a tag line into a dictionary, decoding every extension
+    field (the representation used before `tsurf.store`)."""
+    fields, rawexts = line.strip(" \n").split(';"', 1)
+    name, file, excmd = (f.decode("utf-8") for f in fields.split("\t"))
+    exts = {}
+    for ext in rawexts.strip("\t").split("\t"):
+        if (len(ext) == 1 and ext.isalpha()) or ":" not in ext:
+            exts["kind"] = kinds.get(ext, ext).decode("utf-8")
+        else:
+            t, val = ext.split(":", 1)
+            exts[t] = val.decode("utf-8")
+    return {"name": name, "file": file, "excmd": excmd, "exts": exts}
+
+
+def bench_store():
+    print "parse tag lines: time and memory"
+    for n in (10000, 100000, 300000):
+        lines = tag_lines(n)
+
+        def build_dicts():
+            return [parse_dict(line, {}) for line in lines]
+
+        def build_store():
+            tag_store = store.TagStore()
+            for line in lines:
+                tag_store.append(*store.parse(line, {}))
+            return tag_store
+
+        print "  {:>7} tags   dicts: {:>7.0f}ms {:>7.1f}MB   TagStore: {:>7.0f}ms {:>7.1f}MB".format(
+            n, timeit_best(build_dicts, 1) / 1000, misc.deep_size(build_dicts()) / 2.0**20,
+            timeit_best(build_store, 1) / 1000, misc.deep_size(build_store()) / 2.0**20)
+
+
+# benchmarks for the module 'tsurf.utils.fs'
+# ===========================================================================
+
+def make_tree(root, n):
+    """To create a project with about `n` files under `root`, plus an
+    ignored `node_modules` directory with `n // 10` more files."""
+    for i in range(n):
+        folder = os.path.join(root, "src", "pkg{}".format(i // 1000),
+                              "mod{}".format(i // 100 % 10))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        open(os.path.join(folder, "file{}.py".format(i)), "w").close()
+    for i in range(n // 10):
+        folder = os.path.join(root, "node_modules", "lib{}".format(i // 100))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        open(os.path.join(folder, "index{}.js".format(i)), "w").close()
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("node_modules/\n")
+
+
+def vim_glob(root):
+    """To list all files under `root` the way Tag Surfer used to do it,
+    with the vim function `glob()` (vim startup time included)."""
+    cmd = ["vim", "-N", "-u", "NONE", "-i", "NONE", "-es", "-c",
+           "let g:files = split(glob('{}/**'), '\\n')".format(root), "-c", "qa!"]
+    with open(os.devnull, "w") as devnull:
+        subprocess.call(cmd, stdout=devnull, stderr=devnull)
+
+
+def bench_project_files(n=100000):
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root, n)
+        print "list all files of a project with {} files".format(n)
+        cases = [("fs.walk", lambda: fs.project_files(root, "", False))]
+        # Files are tracked, as they usually are in real projects
+        if subprocess.call("git init -q {0} && git -C {0} add -A".format(root), shell=True) == 0:
+            cases.append(("git ls-files", lambda: fs.project_files(root, "", True)))
+        if subprocess.call("vim --version >{}".format(os.devnull), shell=True) == 0:
+            cases.append(("vim glob()", lambda: vim_glob(root)))
+        for name, fn in cases:
+            print "  {:<26} {:>8.0f}ms".format(name, timeit_best(fn, 1) / 1000)
+
+        # Checking for changes when nothing changed (modification times are
+        # moved back so that nothing looks recently changed)
+        past = time.time() - 60
+        for folder, _, _ in os.walk(root):
+            os.utime(folder, (past, past))
+        files = fs.ProjectFiles(root, "", False)
+        files.get()
+        print "  {:<26} {:>8.0f}ms".format("ProjectFiles (no changes)",
+                                            timeit_best(files.get, 1) / 1000)
+    finally:
+        shutil.rmtree(root)
+
+
+# benchmarks for the rendering of search results
+# ===========================================================================
+
+def bench_render(rows=30, query_len=8):
+    print "render a frame of {} results for a query of {} characters".format(
+        rows, query_len)
+    vim = vimstub.install()
+    if not isinstance(vim, vimstub.Vim):
+        print "  skipped: it can't be run inside vim"
+        return
+    from tsurf import core
+    from tsurf.utils import v
+    from tsurf.utils import settings
+
+    # The user interface displays the results of a search in the project
+    rand = random.Random(0)
+    tags = store.TagStore()
+    for line in tag_lines(rows):
+        tags.append(*store.parse(line, {}))
+    matches = []
+    for i, name in enumerate(tags.names):
+        positions = rand.sample(range(len(name)), min(query_len, len(name)))
+        matches.append(store.Match(tags, i, 1.0, tuple(sorted(positions))))
+    plug = core.TagSurfer()
+    plug.finder.find_tags = lambda *args: matches
+    interface, renderer = plug.ui, plug.ui.renderer
+    interface.finder_win = 1
+    interface.input_so_far = u"#" + u"x" * query_len
+    settings.load()
+
+    def frame():
+        interface.curr_line_idx = -1
+        interface._update()
+
+    def highlight_per_char(error=False):
+        # One `syn match` for each matching character, as `_highlight` did
+        # before `matchaddpos`
+        v.command("syntax clear")
+        if error:
+            v.highlight("TagSurferError", ".*")
+            return
+        v.highlight("TagSurferShade", "@.*")
+        offset = len(settings.get("current_line_indicator")) + 1
+        for i, match_positions in enumerate(renderer.last_matches):
+            for pos in match_positions:
+                v.highlight("TagSurferMatches",
+                            "\c\%{}l\%{}c.".format(i+1, pos+offset))
+
+    def old_path():
+        # Before commands were batched and settings were loaded once, every
+        # command was sent to vim on its own and every setting was read
+        # from vim
+        command, get = v.command, settings.get
+
+        def command_now(cmd):
+            command(cmd)
+            v.flush()
+
+        def get_from_vim(name, type=None):
+            vim.eval(settings.prefix + name)
+            return get(name, type)
+
+        def undo():
+            v.command, settings.get = command, get
+            del renderer._highlight
+
+        v.command, settings.get = command_now, get_from_vim
+        renderer._highlight = highlight_per_char
+        return undo
+
+    def syn_match_per_line():
+        renderer.matchaddpos = False
+        return lambda: setattr(renderer, "matchaddpos", True)
+
+    # Calls to vim (commands and expressions) made for a whole frame, the
+    # search aside
+    for name, setup in [("syn match per character", old_path),
+                        ("syn match per line", syn_match_per_line),
+                        ("matchaddpos", lambda: lambda: None)]:
+        undo = setup()
+        try:
+            frame()
+            del vim.calls[:]
+            frame()
+            calls = len(vim.calls)
+            getcwd = vim.calls.count("getcwd()")
+            t = timeit_best(frame, 100)
+        finally:
+            undo()
+        print "  {:<26} {:>5} calls {:>3} getcwd() {:>10.1f}us".format(
+            name, calls, getcwd, t)
+
+
+# benchmarks for the whole search engine
+# ===========================================================================
+
+# Number of tags of each corpus
+ENGINE_SIZES = [1000, 10000, 100000, 1000000]
+
+# The same queries are searched in every corpus: a single character, short
+# abbreviations, full words, camelCase and a query that never matches.
+ENGINE_QUERIES = ["s", "gt", "gtn", "send", "sendMsg", "tagName", "zzz"]
+
+# The pure Python scorer is too slow for bigger corpora
+PY_SEARCH_MAX_TAGS = 100000
+
+
+def bench_engine(sizes=ENGINE_SIZES, queries=ENGINE_QUERIES, out=None):
+    """To time every step of a search (parsing, scoring, sorting and
+    rendering) with the real Tag Surfer components, running outside vim
+    against a stub vim module. Results are written as JSON to the file
+    object `out`, if given."""
+    print "search engine (corpora of {} tags)".format(
+        ", ".join(str(n) for n in sizes))
+    vim = vimstub.install(cwd="/home/user/project")
+    if not isinstance(vim, vimstub.Vim):
+        print "  skipped: it can't be run inside vim"
+        return
+    from tsurf import core
+
+    plug = core.TagSurfer()
+    finder, renderer = plug.finder, plug.ui.renderer
+    root = plug.services.curr_project.get_root()
+    max_results = 15
+    cpus = misc.cpus()
+    results = []
+
+    def record(bench, n, ms, **info):
+        info.update(bench=bench, tags=n, ms=round(ms, 3))
+        results.append(info)
+        details = " ".join("{}={}".format(k, info[k]) for k in sorted(info)
+                           if k not in ("bench", "tags", "ms"))
+        print "  {:<7} {:>8} tags {:<52} {:>10.2f}ms".format(bench, n, details, ms)
+
+    for n in sizes:
+        lines = tag_lines(n)
+        repeat = 3 if n <= 100000 else 1
+        opts = {"kinds": {}, "exclude_kinds": []}
+
+        def parse():
+            tags = store.TagStore()
+            for line in lines:
+                tag = finder._process_tag_line(line, opts)
+                if tag:
+                    tags.append(*tag)
+            return tags
+
+        record("parse", n, timeit_best(parse, 1, repeat) / 1000)
+        tags = parse()
+        lines = None  # free memory before the next corpus
+
+        # Character masks are computed once, the first time tags are searched
+        def charmasks():
+            del tags.masks[:]
+            return tags.charmasks()
+        record("masks", n, timeit_best(charmasks, 1, repeat) / 1000)
+        masks = charmasks()
+
+        for query in queries:
+            for module in (search, _search):
+                if module is search and n > PY_SEARCH_MAX_TAGS:
+                    continue
+                batch = lambda: module.search_batch(query, tags.names, True,
+                                                    max_results)
+                matched, best = batch()
+                ms = timeit_best(batch, 1, repeat) / 1000
+                record("score", n, ms, module=module.__name__, query=query,
+                       matches=len(matched), prefilter=0)
+                # Tags that lack some character of the query are rejected
+                # before searching them
+                batch = lambda: module.search_batch(query, tags.names, True,
+                                                    max_results, None, masks)
+                masked_ms = timeit_best(batch, 1, repeat) / 1000
+                record("score", n, masked_ms, module=module.__name__,
+                       query=query, matches=len(matched), prefilter=1,
+                       speedup=round(ms / masked_ms, 1) if masked_ms else 0)
+
+            # Tags split across all CPUs (see `tsurf.utils.shards`)
+            if cpus > 1:
+                batch = lambda: shards.search_batch(_search, query, tags.names,
+                    True, max_results, None, masks, workers=cpus)
+                sharded_ms = timeit_best(batch, 1, repeat) / 1000
+                record("score", n, sharded_ms, module=_search.__name__,
+                       query=query, matches=len(matched), prefilter=1,
+                       shards=cpus, speedup=round(masked_ms / sharded_ms, 1)
+                       if sharded_ms else 0)
+
+            # Results are rendered the way the finder returns them
+            matches = [store.Match(tags, i, sim, pos)
+                       for i, sim, pos in reversed(best)]
+            render = lambda: [renderer._render_line(m, query, {}, root) for m in matches]
+            record("render", n, timeit_best(render, 10, repeat) / 1000,
+                   query=query, rows=len(matches))
+
+        # With no query, tags are sorted by name or by distance from the
+        # cursor (when searching in the current buffer)
+        for name, keyf in [("name", tags.lowers.__getitem__),
+                           ("line", lambda i: abs(1000 - tags.line(i)))]:
+            sort = lambda: misc.best(xrange(len(tags)), max_results, keyf)
+            record("sort", n, timeit_best(sort, 1, repeat) / 1000, key=name)
+        tags = None
+
+    if out is not None:
+        json.dump({
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "queries": queries,
+            "results": results,
+        }, out, indent=2, sort_keys=True)
+        out.write("\n")
+
+
+def run(sizes=ENGINE_SIZES, out=None):
+    bench_search()
+    bench_search_batch()
+    bench_store()
+    bench_project_files()
+    bench_render()
+    bench_engine(sizes, out=out)
@@ -6,11 +6,43 @@ tests.py
 Tests for tsurf.
 """
 
+import os
+import gc
+import json
+import time
+import weakref
+import random
+import shutil
+import socket
+import tempfile
+import subprocess
 import unittest
+import threading
+import itertools
+from array import array
 
+from tsurf import index
+from tsurf import store
+from tsurf import daemon
+from tsurf import exceptions as ex
+from tsurf.utils import fs
+from tsurf.utils import job
+from tsurf.utils import misc
+from tsurf.utils import ctags
 from tsurf.utils import search
+from tsurf.utils import shards
+from tsurf.utils import tagfile
 from tsurf.ext import search as _search
 
+# Modules that depend on vim are tested with a fake vim module
+from tsurf.tests import vimstub
+vim = vimstub.install()
+from tsurf import ui
+from tsurf import finder
+from tsurf import services
+from tsurf.utils import v
+from tsurf.utils import settings
+
 
 # tests for the modules 'tsurf.utils.search' and 'tsurf.ext.search'
 # ===========================================================================
@@ -58,6 +90,104 @@ class TestSearch(unittest.TestCase):
             self.assertAlmostEqual(score, expected[0], 4)
             self.assertEqual(positions, expected[1])
 
+    def test__search_best_match(self):
+        # compare against all possible matches
+        def brute_search(needle, haystack, smart_case):
+            best = (-1, tuple())
+            upper = not haystack.isupper()
+            for positions in itertools.combinations(range(len(haystack)), len(needle)):
+                chars = [haystack[i] for i in positions]
+                if smart_case:
+                    needle_chars = [c if c.isupper() else c.lower() for c in needle]
+                    chars = [c if n.isupper() else c.lower() for c, n in zip(chars, needle)]
+                else:
+                    needle_chars = list(needle.lower())
+                    chars = [c.lower() for c in chars]
+                if chars != needle_chars:
+                    continue
+                boundaries = len([i for i in positions if i == 0 or
+                    (upper and haystack[i].isupper()) or haystack[i-1] in "-_"])
+                s = search.similarity(len(haystack), positions, boundaries)
+                if best[0] < 0 or s < best[0]:
+                    best = (s, positions)
+            return best
+
+        rand = random.Random(0)
+        for _ in range(1000):
+            haystack = "".join(rand.choice("aAbB_c") for _ in range(rand.randint(0, 9)))
+            needle = "".join(rand.choice("abAB_") for _ in range(rand.randint(1, 4)))
+            smart_case = rand.choice((True, False))
+            score, positions = search.search(needle, haystack, smart_case)
+            expected = brute_search(needle, haystack, smart_case)
+            self.assertAlmostEqual(score, expected[0], 4)
+            self.assertEqual(bool(positions), bool(expected[1]))
+
+    def test__search_repeated_chars(self):
+        score, positions = search.search("aaaaaaaa", "a" * 40, False)
+        self.assertEqual(positions, tuple(range(8)))
+
+    def test__search_batch(self):
+        haystacks = ["clusterSendMessage", "class", "send", "cls", "clutter"]
+        matched, best = search.search_batch("cls", haystacks, False, 2)
+        self.assertEqual(matched, [0, 1, 3])
+        self.assertEqual([i for i, _, _ in best], [3, 1])
+        self.assertEqual(best[0], (3,) + search.search("cls", "cls", False))
+        matched, best = search.search_batch("cls", haystacks, False, -1, [1, 2, 4])
+        self.assertEqual(matched, [1])
+        self.assertEqual(len(best), 1)
+
+    def test__search_batch_ext(self):
+        rand = random.Random(0)
+        for _ in range(200):
+            haystacks = ["".join(rand.choice("aAbB_c") for _ in range(rand.randint(0, 10)))
+                         for _ in range(rand.randint(0, 40))]
+            needle = "".join(rand.choice("abAB") for _ in range(rand.randint(1, 3)))
+            indices = sorted(rand.sample(range(len(haystacks)), len(haystacks) // 2))
+            for args in ((needle, haystacks, True, 5), (needle, haystacks, False, -1, indices)):
+                self.assertEqual(_search.search_batch(*args), search.search_batch(*args))
+
+    def test__charmask(self):
+        for s in [u"getTagName", u"a_b-c9", "caf\xe9", u"\xc9t\xe9", u"~!@#", u""]:
+            self.assertEqual(_search.charmask(s), search.charmask(s))
+        self.assertEqual(search.charmask("aBa"), search.charmask("ab"))
+        self.assertEqual(search.charmask(""), 0)
+
+    def test__search_batch_masks(self):
+        rand = random.Random(0)
+        haystacks = ["".join(rand.choice("aAbBcxyz_0\xe9") for _ in range(rand.randint(0, 10)))
+                     for _ in range(300)]
+        masks = array("L", map(search.charmask, haystacks))
+        indices = range(0, len(haystacks), 3)
+        for needle in ["ab", "Ab", "x0", "\xe9a", "_z", "q"]:
+            for module in (search, _search):
+                for args in ((needle, haystacks, True, 5), (needle, haystacks, False, -1, indices)):
+                    self.assertEqual(module.search_batch(*args),
+                                     module.search_batch(*(args + (None,) * (5 - len(args)) + (masks,))))
+
+    def test__search_batch_shards(self):
+        rand = random.Random(0)
+        haystacks = ["".join(rand.choice("aAbBcxyz_") for _ in range(rand.randint(0, 10)))
+                     for _ in range(300)]
+        masks = array("L", map(search.charmask, haystacks))
+        for needle in ["ab", "Ab", "x_", "q"]:
+            for module in (search, _search):
+                for args in ((needle, haystacks, True, 5, None, None),
+                             (needle, haystacks, False, -1, xrange(7, 250), masks),
+                             (needle, haystacks, True, 0, range(0, 300, 3), masks),
+                             (needle, haystacks, False, 3, [], None)):
+                    for workers in (1, 2, 7, 1000):
+                        self.assertEqual(shards.search_batch(module, *args, workers=workers),
+                                         module.search_batch(*args))
+
+    def test__search_ext_same_as_python(self):
+        rand = random.Random(0)
+        for _ in range(2000):
+            haystack = "".join(rand.choice("aAbB_c-") for _ in range(rand.randint(0, 12)))
+            needle = "".join(rand.choice("abAB_") for _ in range(rand.randint(0, 4)))
+            smart_case = rand.choice((True, False))
+            self.assertEqual(_search.search(needle, haystack, smart_case),
+                             search.search(needle, haystack, smart_case))
+
     def test__search_ext(self):
         for (needle, haystack), expected in self.search_tests.items():
             score, positions = _search.search(needle, haystack, False)
@@ -71,5 +201,768 @@ class TestSearch(unittest.TestCase):
             self.assertEqual(positions, expected[1])
 
 
+# tests for the module 'tsurf.index'
+# ===========================================================================
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.a = self._write("a.py", "def a(): pass\n")
+        self.b = self._write("b.py", "def b(): pass\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def _line(self, name, file):
+        return '{}\t{}\t/^def {}():$/;"\tf'.format(name, file, name)
+
+    def test__stale(self):
+        tindex = index.TagIndex()
+        stale = tindex.stale([self.a, self.b])
+        self.assertEqual(sorted(stale), sorted([self.a, self.b]))
+        tindex.merge(stale, [self._line("a", self.a), self._line("b", self.b), ""])
+        self.assertEqual(tindex.stale([self.a, self.b]), {})
+        self.assertEqual(tindex.lines(self.a), [self._line("a", self.a)])
+        self._write("b.py", "def b(): pass\ndef c(): pass\n")
+        self.assertEqual(list(tindex.stale([self.a, self.b])), [self.b])
+
+    def test__file_names(self):
+        tindex = index.TagIndex(self.folder)
+        # File names relative to the root or not normalized
+        tindex.merge(tindex.stale([self.a, self.b]),
+                     [self._line("a", "a.py"), self._line("b", "./sub/../b.py")])
+        self.assertEqual(tindex.lines(self.a), [self._line("a", "a.py")])
+        self.assertEqual(tindex.lines(self.b), [self._line("b", "./sub/../b.py")])
+        # Files are not recorded when no file name can be matched
+        tindex = index.TagIndex(self.folder)
+        tindex.merge(tindex.stale([self.a, self.b]), [self._line("a", "/elsewhere/a.py")])
+        self.assertEqual((tindex.entries, tindex.version), ({}, 0))
+        tindex.merge(tindex.stale([self.a, self.b]), [])
+        self.assertEqual(sorted(tindex.entries), sorted([self.a, self.b]))
+
+    def test__cancelled(self):
+        tindex = index.TagIndex()
+        tindex.merge(tindex.stale([self.a]), [self._line("a", self.a)])
+        cancelled = threading.Event()
+        cancelled.set()
+        self.assertEqual(tindex.stale([self.b], cancelled), {})
+        tindex.prune([], cancelled)
+        self.assertEqual(list(tindex.entries), [self.a])
+
+    def test__remove_deleted(self):
+        tindex = index.TagIndex()
+        tindex.merge(tindex.stale([self.a, self.b]), [self._line("a", self.a)])
+        version = tindex.version
+        os.remove(self.b)
+        self.assertEqual(tindex.stale([self.a, self.b]), {})
+        self.assertEqual(sorted(tindex.entries), [self.a])
+        self.assertTrue(tindex.version > version)
+        tindex.prune([])
+        self.assertEqual(tindex.entries, {})
+
+    def test__persistence(self):
+        path = index.path_for(os.path.join(self.folder, "idx"), self.folder)
+        tindex = index.TagIndex(self.folder, path, "config")
+        tindex.merge(tindex.stale([self.a]), [self._line("a", self.a)])
+        tindex.save()
+        self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+        loaded = index.TagIndex.load(self.folder, path, "config")
+        self.assertEqual(loaded.entries, tindex.entries)
+        loaded = index.TagIndex.load(self.folder, path, "other config")
+        self.assertEqual(loaded.entries, {})
+
+
+# tests for the module 'tsurf.store'
+# ===========================================================================
+
+class TestTagStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.TagStore()
+        lines = ['TagName\ta.py\t/^def f():$/;"\tf\tline:12\tclass:Foo',
+                 'other\ta.py\t42;"\tkind:f',
+                 'third\tb.py\t/^x$/;"',
+                 'invalid line']
+        for line in lines:
+            tag = store.parse(line, {"f": "function"})
+            if tag:
+                self.store.append(*tag)
+
+    def test__append(self):
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.store.lowers, [u"tagname", u"other", u"third"])
+        self.assertTrue(self.store.lowers[1] is self.store.names[1])
+        self.assertEqual(self.store.file_names, [u"a.py", u"b.py"])
+        self.assertEqual(list(self.store.files), [0, 0, 1])
+        self.assertEqual(list(self.store.kinds), [1, 1, 0])
+        self.assertEqual([self.store.line(i) for i in range(3)], [12, 42, 0])
+
+    def test__charmasks(self):
+        tags = store.TagStore()
+        tags.append(u"getTagName", "a.py", u"1", u"f", "")
+        self.assertEqual(list(tags.charmasks()), [search.charmask(u"gettagname")])
+        tags.append(u"send", "a.py", u"2", u"f", "")
+        self.assertEqual(len(tags.charmasks()), 2)
+
+    def test__views(self):
+        tag = self.store[0]
+        self.assertEqual((tag.name, tag.file, tag.kind, tag.line, tag.context),
+                         (u"TagName", u"a.py", u"function", u"12", u"def f():"))
+        self.assertEqual(tag.exts, {u"kind": u"function", u"line": u"12", u"class": u"Foo"})
+        tag = self.store[1]
+        self.assertEqual((tag.line, tag.context, tag.exts), (u"42", u"42", {u"kind": u"function"}))
+        tag = self.store[2]
+        self.assertEqual((tag.kind, tag.line, tag.exts), (None, u"", {}))
+        match = store.Match(self.store, 2, 0.5, (0,))
+        self.assertEqual((match.name, match.similarity, match.match_positions),
+                         (u"third", 0.5, (0,)))
+
+
+# tests for the module 'tsurf.utils.misc'
+# ===========================================================================
+
+class TestMisc(unittest.TestCase):
+
+    def test__best(self):
+        rand = random.Random(0)
+        for _ in range(200):
+            items = [(rand.randint(0, 5), i) for i in range(rand.randint(0, 30))]
+            key = lambda item: item[0]
+            for n in (0, 1, 3, 15, 50):
+                expected = sorted(items, key=key, reverse=True)[len(items)-min(n, len(items)):]
+                self.assertEqual(misc.best(items, n, key), expected)
+
+    def test__lru_cache(self):
+        cache = misc.LRUCache(10)
+        cache.put("a", 1, 4)
+        cache.put("b", 2, 4)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3, 4)  # "b" is the least recently used
+        self.assertEqual((cache.get("b"), cache.get("a"), cache.get("c")), (None, 1, 3))
+        cache.put("a", 4, 6)
+        self.assertEqual((len(cache), cache.size, cache.get("a")), (2, 10, 4))
+        cache.put("d", 5, 11)  # too big
+        self.assertEqual((len(cache), cache.get("d")), (2, None))
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+# tests for the module 'tsurf.utils.ctags'
+# ===========================================================================
+
+class TestCtags(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = ctags.CHUNK_SIZE
+        ctags.CHUNK_SIZE = 3
+        # A fake ctags program that outputs a tag for every file it reads
+        # from the standard input or the command line.
+        self.cmd = ["sh", "-c", 'if [ "$1" = "-L" ]; then cat; '
+                    'else for f in "$@"; do echo "$f"; done; fi', "sh"]
+
+    def tearDown(self):
+        ctags.CHUNK_SIZE = self.chunk_size
+
+    def test__chunks(self):
+        files = [str(i) for i in range(10)]
+        self.assertEqual(ctags.chunks([], 4), [])
+        self.assertEqual(ctags.chunks(files[:2], 4), [["0"], ["1"]])
+        parts = ctags.chunks(files, 2)
+        self.assertEqual(sum(parts, []), files)
+        self.assertTrue(all(len(p) <= 3 for p in parts))
+
+    def test__stream(self):
+        files = ["file {}".format(i) for i in range(20)]
+        self.assertEqual(list(ctags.stream(self.cmd, files, jobs=4)), files)
+        self.assertEqual(list(ctags.stream(self.cmd, files, jobs=1)), files)
+        self.assertEqual(list(ctags.stream(self.cmd, files, jobs=4, file_list=False)), files)
+
+    def test__stream_error(self):
+        cmd = ["sh", "-c", "echo oops >&2", "sh"]
+        self.assertRaises(ex.TagSurferException, list, ctags.stream(cmd, ["a"]))
+
+    def test__stream_close(self):
+        cmd = ["sh", "-c", "echo tag; exec sleep 30", "sh"]
+        lines = ctags.stream(cmd, ["a"])
+        start = time.time()
+        self.assertEqual(next(lines), "tag")
+        lines.close()
+        self.assertTrue(time.time() - start < 5)
+
+    def test__stream_cancelled(self):
+        cmd = ["sh", "-c", "exec sleep 30", "sh"]
+        cancelled = threading.Event()
+        lines = ctags.stream(cmd, ["a"], cancelled=cancelled)
+        threading.Timer(0.1, cancelled.set).start()
+        start = time.time()
+        self.assertEqual(list(lines), [])
+        self.assertTrue(time.time() - start < 5)
+
+
+# tests for the module 'tsurf.utils.job'
+# ===========================================================================
+
+class TestJob(unittest.TestCase):
+
+    def _take_all(self, j):
+        items = []
+        while not j.done():
+            items.extend(j.take())
+        return items
+
+    def test__take(self):
+        j = job.Job(i for i in xrange(1000))
+        j.start()
+        self.assertEqual(self._take_all(j), range(1000))
+
+    def test__error(self):
+        def gen():
+            yield 1
+            raise ex.TagSurferException("oops")
+        j = job.Job(gen())
+        j.start()
+        j.join()
+        self.assertEqual(j.take(), [1])
+        self.assertRaises(ex.TagSurferException, j.take)
+        self.assertTrue(j.done())
+
+    def test__cancel(self):
+        closed = []
+        def gen():
+            try:
+                while True:
+                    yield 1
+                    time.sleep(0.001)
+            finally:
+                closed.append(True)
+        j = job.Job(gen())
+        j.start()
+        j.cancel()
+        self.assertFalse(j.is_alive())
+        self.assertEqual(j.take(), [])
+        self.assertEqual(closed, [True])
+
+
+
+# tests for the module 'tsurf.utils.fs'
+# ===========================================================================
+
+class TestFs(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ["a.py", "b.pyc", ".hidden/c.py", "src/d.py", "src/e.log",
+                     "src/keep.log", "build/f.py", "src/build/g.py",
+                     "node_modules/h.js", "docs/i.txt", "docs/sub/j.txt"]:
+            self._write(path)
+        self._write(".gitignore", "*.log\n!keep.log\n/build/\n# comment\n")
+        self._write("docs/.gitignore", "sub/\n")
+        os.symlink(os.path.join(self.root, "src"), os.path.join(self.root, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, path, content=""):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _rel(self, files):
+        return sorted(os.path.relpath(f, self.root) for f in files)
+
+    def test__walk(self):
+        files = fs.walk(self.root, fs.WildIgnore("*.pyc,node_modules"))
+        self.assertEqual(self._rel(files), ["a.py", "docs/i.txt", "src/build/g.py",
+                                            "src/d.py", "src/keep.log"])
+
+    def test__gitignore(self):
+        gitignore = fs.GitIgnore(["**/tmp", "/doc/*.txt", "lib/**", "!x.txt"], self.root)
+        path = lambda p: os.path.join(self.root, p)
+        self.assertTrue(gitignore.ignored(path("a/b/tmp"), True))
+        self.assertTrue(gitignore.ignored(path("doc/a.txt")))
+        self.assertFalse(gitignore.ignored(path("doc/x.txt")))
+        self.assertFalse(gitignore.ignored(path("src/doc/a.txt")))
+        self.assertTrue(gitignore.ignored(path("lib/a/b.py")))
+
+    def test__project_files_git(self):
+        try:
+            subprocess.check_call(["git", "init", "-q", self.root])
+        except (OSError, subprocess.CalledProcessError):
+            return
+        files = fs.project_files(self.root, "*.pyc,node_modules")
+        self.assertEqual(self._rel(files), ["a.py", "docs/i.txt", "src/build/g.py",
+                                            "src/d.py", "src/keep.log"])
+
+
+    def _age(self):
+        """To make everything in the project look like it has been
+        modified a while ago."""
+        past = time.time() - 60
+        for folder, _, files in os.walk(self.root):
+            for path in [folder] + [os.path.join(folder, f) for f in files]:
+                os.utime(path, (past, past))
+
+    def test__project_files_cache(self):
+        self._age()
+        files = fs.ProjectFiles(self.root, "*.pyc,node_modules", False)
+        expected = lambda: sorted(fs.walk(self.root, fs.WildIgnore("*.pyc,node_modules")))
+        self.assertEqual(sorted(files.get()), expected())
+
+        # Nothing changed, nothing is listed again
+        scanned = []
+        scan = files._scan
+        files._scan = lambda *args: scanned.append(args) or scan(*args)
+        self.assertEqual(sorted(files.get()), expected())
+        self.assertEqual(scanned, [])
+
+        self._write("src/new.py")
+        self._write("src/pkg/sub/x.py")
+        os.remove(os.path.join(self.root, "docs/i.txt"))
+        shutil.rmtree(os.path.join(self.root, "src/build"))
+        self.assertEqual(sorted(files.get()), expected())
+        self.assertTrue(len(scanned) < 6)
+
+        self._write(".gitignore", "*.py\n")
+        self.assertEqual(sorted(files.get()), expected())
+
+
+# tests for the module 'tsurf.daemon'
+# ===========================================================================
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "project")
+        os.makedirs(os.path.join(self.root, "src"))
+        for name in ("getTagName", "sendMessage", "get_buffer"):
+            open(os.path.join(self.root, "src", name + ".py"), "w").close()
+        # A fake ctags program that outputs a tag for every file it reads
+        # from the standard input, named after the file.
+        self.ctags = os.path.join(self.tmp, "ctags")
+        with open(self.ctags, "w") as f:
+            f.write('#!/bin/sh\nwhile read f; do n=$(basename "$f" .py); '
+                    'printf \'%s\\t%s\\t/^def %s$/;"\\tf\\tline:1\\n\' '
+                    '"$n" "$f" "$n"; done\n')
+        os.chmod(self.ctags, 0o755)
+        self.socket = os.path.join(self.tmp, "daemon.sock")
+        self.server = daemon.Server(self.socket)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _search(self, query, max_results=15, **settings):
+        req = {"root": self.root, "query": query, "smart_case": 1,
+               "max_results": max_results,
+               "settings": {"ctags_bin": self.ctags, "ctags_args": "",
+                            "ctags_custom_args": "", "custom_languages": {},
+                            "ctags_jobs": 1, "index_dir": self.tmp,
+                            "wildignore": "", "use_git": False}}
+        req["settings"].update(settings)
+        resp = daemon.request(self.socket, req)
+        while resp.get("generating"):
+            time.sleep(0.01)
+            resp = daemon.request(self.socket, req)
+        return resp
+
+    def test__search(self):
+        resp = self._search("gtn")
+        self.assertEqual(len(resp["tags"]), 1)
+        name, file, excmd, kind, extras, similarity, positions = resp["tags"][0]
+        self.assertEqual(file, os.path.join(self.root, "src", "getTagName.py"))
+        self.assertEqual((name, excmd, kind), ("getTagName", "/^def getTagName$/", "f"))
+        self.assertEqual((similarity, positions), (3.0, [0, 3, 6]))
+        self.assertEqual(extras, "\tf\tline:1")
+        with tagfile.TagFile(resp["tagfile"]) as tags:
+            self.assertEqual(tags.sorted, tagfile.SORTED)
+            self.assertEqual(len(list(tags.lines())), 3)
+
+        # The best match comes last
+        resp = self._search("se")
+        self.assertEqual(resp["tags"][-1][0], "sendMessage")
+
+        # With no query, tags are sorted by name
+        resp = self._search("", 2)
+        self.assertEqual([t[0] for t in resp["tags"]], ["getTagName", "get_buffer"])
+
+    def test__shared_index(self):
+        # Settings as vim gives them and as the tag server decodes them
+        conf = {"ctags_bin": self.ctags, "ctags_args": "-f -",
+                "ctags_custom_args": "", "ctags_jobs": 1, "index_dir": self.tmp,
+                "custom_languages": {"go": {"bin": "gotags", "args": ""}},
+                "wildignore": "", "use_git": False}
+        json_conf = json.loads(json.dumps(conf))
+        config = ctags.fingerprint(conf)
+        self.assertEqual(ctags.fingerprint(json_conf), config)
+        path = index.path_for(self.tmp, self.root, config)
+        f = os.path.join(self.root, "src", "getTagName.py")
+        sig = index.signature(f)
+
+        # The index saved by vim is loaded by the tag server
+        tindex = index.TagIndex.load(self.root, path, config)
+        tindex.merge({f: sig}, ["getTagName\t{}\t1;\"\tf".format(f)])
+        tindex.save()
+        project = daemon.Project(unicode(self.root), json_conf)
+        project.refresh()
+        project.refresher.join()
+        self.assertEqual(project.tindex.path, path)
+        self.assertEqual(project.tindex.lines(f), tindex.lines(f))
+
+        # and the other way round
+        project.tindex.merge({f: sig}, ["get\t{}\t2;\"\tf".format(f)])
+        project.tindex.save()
+        tindex = index.TagIndex.load(self.root, path, config)
+        self.assertEqual(tindex.lines(f), ["get\t{}\t2;\"\tf".format(f)])
+
+    def test__settings(self):
+        self._search("gt")
+        self._search("gt", ctags_args="--fields=+n")
+        projects = dict(self.server.projects)
+        self.assertEqual(len(projects), 2)
+        # Vim instances with different settings don't replace each other's
+        # project, while settings that don't change tags are updated
+        self._search("gt", wildignore="*.pyc")
+        self._search("gt", ctags_args="--fields=+n")
+        self.assertEqual(self.server.projects, projects)
+        self.assertEqual(len(set(p.path for p in projects.values())), 2)
+        self.assertTrue(any(p.conf["wildignore"] == "*.pyc" for p in projects.values()))
+        key = (self.root, ctags.fingerprint(projects.values()[0].conf), self.tmp)
+        self.assertTrue(key in projects)
+
+    def test__error(self):
+        os.remove(self.ctags)
+        self.assertTrue("does not exists" in self._search("gt")["error"])
+
+    def test__no_server(self):
+        self.assertEqual(daemon.request(os.path.join(self.tmp, "none"), {}), None)
+
+
+# tests for the module 'tsurf.utils.tagfile'
+# ===========================================================================
+
+class TestTagFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _tagfile(self, names, sorted=None):
+        path = os.path.join(self.tmp, "tags")
+        with open(path, "w") as f:
+            f.write("!_TAG_FILE_FORMAT\t2\t/extended format/\n")
+            if sorted is not None:
+                f.write("!_TAG_FILE_SORTED\t{}\t/0=unsorted, 1=sorted, "
+                        "2=foldcase/\n".format(sorted))
+            for name in names:
+                f.write("{0}\ta.py\t/^def {0}$/;\"\tf\n".format(name))
+        return tagfile.TagFile(path)
+
+    def _names(self, lines):
+        return [l.split("\t")[0] for l in lines]
+
+    def test__lines(self):
+        with self._tagfile(["b", "a", "c"]) as tags:
+            self.assertEqual(tags.sorted, tagfile.UNSORTED)
+            self.assertEqual(self._names(tags.lines()), ["b", "a", "c"])
+            self.assertEqual(list(tags.lines())[0], "b\ta.py\t/^def b$/;\"\tf")
+
+    def test__empty(self):
+        path = os.path.join(self.tmp, "tags")
+        open(path, "w").close()
+        with tagfile.TagFile(path) as tags:
+            self.assertEqual(list(tags.lines()), [])
+        with self._tagfile([], tagfile.SORTED) as tags:
+            self.assertEqual(tags.sorted, tagfile.SORTED)
+            self.assertEqual(list(tags.lines()), [])
+
+    def test__write(self):
+        path = os.path.join(self.tmp, "tags")
+        open(path, "w").close()
+        lines = ["{0}\ta.py\t/^def {0}$/;\"\tf".format(n)
+                 for n in ["send", "get_buffer", "getTagName", "Zeta"]]
+        tagfile.write(path, lines)
+        self.assertEqual(os.listdir(self.tmp), ["tags"])
+        with tagfile.TagFile(path) as tags:
+            self.assertEqual(tags.sorted, tagfile.SORTED)
+            self.assertEqual(self._names(tags.lines()),
+                             ["Zeta", "getTagName", "get_buffer", "send"])
+        # A failed write leaves the file as it was and no temporary file
+        self.assertRaises(TypeError, tagfile.write, path, ["a", None])
+        self.assertEqual(os.listdir(self.tmp), ["tags"])
+        with tagfile.TagFile(path) as tags:
+            self.assertEqual(len(list(tags.lines())), 4)
+
+
+# tests for the module 'tsurf.services'
+# ===========================================================================
+
+class TestServices(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sub = os.path.join(self.root, "src", "sub")
+        os.makedirs(self.sub)
+        self.project = services.CurrentProjectService()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _root(self):
+        return self.project._find_project_root(self.sub, [".git"])
+
+    def test__find_project_root(self):
+        self.assertEqual(self._root(), "")
+        os.mkdir(os.path.join(self.root, ".git"))
+        # Directories without a root are remembered until they are forgotten
+        self.assertEqual(self._root(), "")
+        self.project.forget_roots(found=False)
+        self.assertEqual(self._root(), self.root)
+        self.assertEqual(self.project.roots_cache[os.path.dirname(self.sub)],
+                         (self.root, ".git"))
+        # Roots are remembered, only the marker found is checked again
+        self.project.forget_roots(found=False)
+        checked = []
+        exists = os.path.exists
+        os.path.exists = lambda path: checked.append(path) or exists(path)
+        try:
+            self.assertEqual(self._root(), self.root)
+        finally:
+            os.path.exists = exists
+        self.assertEqual(checked, [os.path.join(self.root, ".git")])
+        # A root that is no longer a root is noticed right away
+        os.rmdir(os.path.join(self.root, ".git"))
+        self.assertEqual(self._root(), "")
+        os.mkdir(os.path.join(self.sub, ".git"))
+        self.project.set_root("")
+        self.assertEqual(self._root(), self.sub)
+
+
+# tests for the module 'tsurf.finder'
+# ===========================================================================
+
+class Plugin:
+    pass
+
+
+class TestFinder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp, "project")
+        os.makedirs(os.path.join(self.root, ".git"))
+        for name in ("getTagName", "sendMessage", "get_buffer"):
+            open(os.path.join(self.root, name + ".py"), "w").close()
+        # The same fake ctags program used for the tag server tests
+        ctags_bin = os.path.join(self.tmp, "ctags")
+        with open(ctags_bin, "w") as f:
+            f.write('#!/bin/sh\nwhile read f; do n=$(basename "$f" .py); '
+                    'printf \'%s\\t%s\\t/^def %s$/;"\\tf\\tline:1\\n\' '
+                    '"$n" "$f" "$n"; done\n')
+        os.chmod(ctags_bin, 0o755)
+        self.variables, self.cwd = vim.variables, vim.cwd
+        vim.variables = dict(vimstub.DEFAULTS, ctags_bin=ctags_bin,
+                             ctags_args="", index_dir=self.tmp, use_git="0",
+                             use_tagfiles="0")
+        vim.cwd = self.root
+        settings.load()
+        plug = Plugin()
+        plug.services = services.Services(plug)
+        self.finder = finder.Finder(plug)
+        # Count searches
+        self.searches = []
+        self.search_batch = finder.search.search_batch
+        def search_batch(query, *args):
+            self.searches.append(query)
+            return self.search_batch(query, *args)
+        finder.search.search_batch = search_batch
+
+    def tearDown(self):
+        finder.search.search_batch = self.search_batch
+        self.finder.close()
+        vim.variables, vim.cwd = self.variables, self.cwd
+        settings.load()
+        shutil.rmtree(self.tmp)
+
+    def _type(self, query):
+        """To type `query` one key at a time, as the user interface does,
+        and return the names of the tags found."""
+        f = self.finder
+        for i in range(1, len(query) + 1):
+            f.refind_tags = True
+            f.rebuild_tags = f.rebuild_tags or i == 1
+            buf = vimstub.Buffer()
+            buf.cursor = (1, 0)
+            results = f.find_tags(query[:i], 15, buf)
+            f.rebuild_tags = False
+            while f.generating():
+                time.sleep(0.01)
+                f.refind_tags = True
+                results = f.find_tags(query[:i], 15, buf)
+        return [m.name for m in results]
+
+    def test__results_cache(self):
+        self.assertEqual(self._type("#gt"), ["getTagName", "get_buffer"])
+        self.assertEqual(self.searches, ["g", "gt"])
+        # Typing the query again doesn't search again, even if tags are
+        # regenerated on the first key
+        self.assertEqual(self._type("#gt"), ["getTagName", "get_buffer"])
+        self.assertEqual(self.searches, ["g", "gt"])
+        # Searches are done again once the tags change
+        open(os.path.join(self.root, "getTitle.py"), "w").close()
+        self.assertEqual(self._type("#gt"), ["getTagName", "get_buffer", "getTitle"])
+        self.assertEqual(self.searches, ["g", "gt", "g", "gt"])
+
+    def test__results_cache_memory(self):
+        self._type("#gt")
+        tags = weakref.ref(self.finder.tags_cache)
+        self._type("#get")
+        # Remembered results don't keep tags generated earlier in memory
+        gc.collect()
+        self.assertIsNone(tags())
+        # Each search is remembered with its own tags, which are counted
+        cache = self.finder.results_cache
+        self.assertEqual(len(cache), 5)
+        for results, size in cache.entries.values():
+            self.assertEqual(len(results[0].store), len(results))
+            self.assertEqual(size, misc.deep_size(results))
+
+    def test__remote_failure(self):
+        # A tag server that doesn't answer
+        path = os.path.join(self.tmp, "daemon.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(5)
+        vim.variables["daemon_socket"] = path
+        settings.load()
+        try:
+            start = time.time()
+            self.assertEqual(self._type("#gt"), ["getTagName", "get_buffer"])
+            self.assertTrue(time.time() - start < 2 * daemon.SEARCH_TIMEOUT)
+            # The server is not asked again
+            start = time.time()
+            self.assertEqual(self._type("#get"), ["getTagName", "get_buffer"])
+            self.assertTrue(time.time() - start < daemon.SEARCH_TIMEOUT)
+        finally:
+            sock.close()
+
+    def test__use_tagfile(self):
+        path = os.path.join(self.tmp, u"d\xe9j\xe0 vu,1.tags")
+        escaped = os.path.join(self.tmp, "d\xc3\xa9j\xc3\xa0") + r"\\\ vu\\,1.tags"
+        v.flush()
+        self.finder._use_tagfile(path)
+        self.finder._use_tagfile("")
+        self.assertEqual(v.pending, ["set tags+=" + escaped, "set tags-=" + escaped])
+        v.flush()
+
+    def _narrowing_finder(self, tags):
+        """To return a finder that searches the given `tags` in the current
+        buffer and doesn't remember any search."""
+        plug = Plugin()
+        plug.services = services.Services(plug)
+        f = finder.Finder(plug)
+        f._get_search_scope = lambda query, name: (query, "buffer", [])
+        f.results_cache = misc.LRUCache(0)
+        f.rebuild_tags = False
+        for tag in tags:
+            f.tags_cache.append(*tag)
+        return f
+
+    def _search(self, f, query):
+        f.refind_tags = True
+        buf = vimstub.Buffer()
+        buf.cursor = (1, 0)
+        return [(f.tags_cache.names[m.index], m.similarity, m.match_positions)
+                for m in f.find_tags(query, 5, buf)]
+
+    def _check(self, f, query):
+        """To check that searching `query` with `f` finds the same tags a
+        new finder finds. Returns the queries searched by `f`."""
+        del self.searches[:]
+        results = self._search(f, query)
+        searched = list(self.searches)
+        tags = [(f.tags_cache.names[i], "a.py", "/^x$/", "f", "")
+                for i in xrange(len(f.tags_cache))]
+        self.assertEqual(results, self._search(self._narrowing_finder(tags), query))
+        return searched
+
+    def test__narrowing(self):
+        random.seed(0)
+        tags = [("".join(random.choice("abcAB_") for _ in xrange(8)),
+                 "a.py", "/^x$/", "f", "") for _ in xrange(2000)]
+        f = self._narrowing_finder(tags[:1000])
+        # The query grows
+        for query in ("a", "ab", "abc", "abcB"):
+            self.assertEqual(self._check(f, query), [query])
+        # The user deletes some characters: matches are already known
+        for query in ("abc", "ab"):
+            self.assertEqual(self._check(f, query), [])
+        # New tags are generated between keystrokes
+        for i, query in enumerate(("ab_", "ab", "a", "aA")):
+            f.job = job.Job(t for t in tags[1000 + i * 250:1250 + i * 250])
+            f.job.start()
+            f.job.join()
+            self.assertEqual(self._check(f, query), [query])
+        self.assertEqual(len(f.tags_cache), 2000)
+
+
+# tests for the module 'tsurf.ui'
+# ===========================================================================
+
+class TestUserInterface(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        settings.load()
+        plug = Plugin()
+        plug.services = services.Services(plug)
+        plug.finder = finder.Finder(plug)
+        self.ui = ui.UserInterface(plug)
+        self.ui.tagstack = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test__jump_to_tag(self):
+        path = os.path.join(self.tmp, u"m\xf3dulo.py".encode("utf-8"))
+        with open(path, "w") as f:
+            f.write("def f():\n")
+        tags = store.TagStore()
+        tags.append(u"f", path, u"/^def f():$/", u"f", "\tf\tline:1")
+        v.flush()
+        self.assertTrue(self.ui._jump_to_tag(tags[0]))
+        self.assertIn("exe 'edit' fnameescape('{}')".format(path), v.pending)
+        v.flush()
+
+    def test__update(self):
+        tags = store.TagStore()
+        for i in range(15):
+            tags.append(u"tag{}".format(i), os.path.join(self.tmp, "f{}.py".format(i)),
+                        u"/^x$/", u"f", "")
+        matches = [store.Match(tags, i, 1.0, (0, 1)) for i in range(15)]
+        self.ui.plug.finder.find_tags = lambda *args: matches
+        self.ui.input_so_far = u"#tg"
+        self.ui.finder_win = 1
+        v.flush()
+        del vim.calls[:]
+        self.ui._update()
+        # The project root is found once for the whole frame
+        self.assertEqual(vim.calls.count("getcwd()"), 1)
+        self.assertEqual(len(self.ui.mapper), 15)
+
+
 def run():
     unittest.main(module=__name__)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+vimstub.py
+~~~~~~~~~~
+
+A stand-in for the vim module, so that the modules that depend on vim (the
+finder, services, user interface, ...) can be imported and benchmarked
+outside vim. Calls to vim are recorded but nothing is executed.
+"""
+
+import os
+import sys
+import types
+
+
+# Default values of all `g:tsurf_*` variables (see plugin/tagsurfer.vim),
+# as returned by `vim.eval`.
+DEFAULTS = {
+    "debug": "0",
+    "ctags_bin": "ctags",
+    "ctags_args": "-f - --format=2 --excmd=pattern --sort=yes --fields=nKzmafilmsSt",
+    "ctags_custom_args": "",
+    "ctags_jobs": "0",
+    "index_dir": os.path.expanduser("~/.cache/tsurf"),
+    "daemon_socket": "",
+    "use_tagfiles": "0",
+    "smart_case": "1",
+    "parallel_search_threshold": "500000",
+    "buffer_search_modifier": "%",
+    "project_search_modifier": "#",
+    "root_markers": [".git", ".svn", ".hg", ".bzr", "_darcs"],
+    "use_git": "1",
+    "custom_languages": {},
+    "max_results": "15",
+    "prompt": " @ ",
+    "prompt_color": "",
+    "current_line_indicator": " > ",
+    "line_format": ["{file}", " | {kind}"],
+    "tag_file_full_path": "0",
+    "tag_file_custom_depth": "-1",
+    "tag_file_relative_to_project_root": "1",
+    "no_results_msg": " nothing found...",
+    "shade_color": "Comment",
+    "shade_color_darkbg": "Comment",
+    "matches_color": "WarningMsg",
+    "matches_color_darkbg": "WarningMsg",
+}
+
+
+class error(Exception):
+    pass
+
+
+class Buffer(list):
+
+    def __init__(self, name=""):
+        list.__init__(self, [""])
+        self.name = name
+
+
+class Window:
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.cursor = (1, 0)
+        self.height = 1
+
+
+class Current:
+
+    def __init__(self):
+        self.buffer = Buffer()
+        self.window = Window(self.buffer)
+
+
+class Vim(types.ModuleType):
+    """To fake the vim module.
+
+    `variables` overrides the default value of `g:tsurf_*` variables (names
+    are given without the prefix), `functions` are the names of the vim
+    functions that exist and `cwd` is the current working directory.
+    """
+
+    error = error
+
+    def __init__(self, variables=None, functions=("matchaddpos",), cwd=None):
+        types.ModuleType.__init__(self, "vim")
+        self.variables = dict(DEFAULTS, **(variables or {}))
+        self.functions = functions
+        self.cwd = cwd or os.getcwd()
+        self.current = Current()
+        self.buffers = [self.current.buffer]
+        self.windows = [self.current.window]
+        # `self.calls` records every command and expression sent to vim
+        self.calls = []
+
+    def command(self, cmd):
+        self.calls.append(cmd)
+
+    def eval(self, expr):
+        self.calls.append(expr)
+        if expr.startswith("filter(copy(g:)"):
+            return dict(("tsurf_" + name, val)
+                        for name, val in self.variables.items())
+        elif expr.startswith("g:tsurf_"):
+            return self.variables[expr[len("g:tsurf_"):]]
+        elif expr.startswith("exists('*"):
+            return "1" if expr[len("exists('*"):-2] in self.functions else "0"
+        elif expr == "getcwd()":
+            return self.cwd
+        elif expr == "&bg":
+            return "dark"
+        elif expr.startswith(("winnr(", "bufwinnr(")):
+            return "1"
+        return ""
+
+
+def install(**kwargs):
+    """To make `import vim` return a new `Vim` instance (created with
+    `kwargs`). If the real vim module is available, it's returned instead and
+    nothing is installed."""
+    try:
+        import vim
+        return vim
+    except ImportError:
+        vim = sys.modules["vim"] = Vim(**kwargs)
+        return vim
@@ -10,6 +10,7 @@ all matching tags for the given search query.
 
 import os
 import vim
+import time
 from operator import itemgetter
 from collections import namedtuple
 from itertools import imap, groupby
@@ -20,6 +21,15 @@ from tsurf.utils import settings
 from tsurf import exceptions as ex
 
 
+# Milliseconds between two checks for keys pressed by the user while tags
+# are generated in the background
+POLL_INTERVAL = 20
+
+# Minimum number of seconds between two updates of the search results while
+# tags are generated in the background
+PROGRESS_INTERVAL = 0.1
+
+
 class UserInterface:
 
     def __init__(self, plug):
@@ -37,6 +47,10 @@ class UserInterface:
         # in the finder window
         self.renderer = Renderer(plug)
 
+        # `self.tagstack` tells whether tags can be pushed onto the tag stack
+        # with `settagstack` (the 't' action is needed)
+        self.tagstack = v.eval("has('patch-8.2.0077') || has('nvim-0.5')") == "1"
+
         self.renderer.setup_colors()
         self._reset()
 
@@ -48,7 +62,14 @@ class UserInterface:
         # repository, it seems that Tag Surfer cannot append anything to the
         # `tag` option. I haven't still figured out why this happens but this
         # seems to fix the issue.
-        vim.command("exe 'set tags=' . &tags")
+        v.command("exe 'set tags=' . &tags")
+
+        # Take a fresh snapshot of all `g:tsurf_*` variables: from now on
+        # settings are read without calling vim.
+        settings.load()
+        # Directories may have become part of a project since the last time
+        # (roots that are no longer roots are noticed anyway)
+        self.plug.services.curr_project.forget_roots(found=False)
 
         # Save some info about the current buffer
         self.curr_buf = self.CurrBuffer(
@@ -56,7 +77,7 @@ class UserInterface:
             vim.current.buffer.name,
             vim.current.window.cursor,
             v.winnr(),
-            vim.eval("&ft"))
+            v.eval("&ft"))
 
         # Populate the search results window with tags from the current buffer
         # even though the user haven't searched anything yet (this will show
@@ -68,17 +89,22 @@ class UserInterface:
         while True:
 
             # Display the prompt and the current query string
-            prompt = settings.get("prompt")
-            color = settings.get("prompt_color")
-            vim.command("echohl {} | echon \"{}\" | echohl None".format(color, prompt))
-            query = self.input_so_far.replace("\\", "\\\\").replace('"', '\\"')
-            vim.command("echon \"{}\"".format(query.encode('utf-8')))
+            self._show_prompt()
 
             # Wait for the next key
-            key.get()
+            self._wait_key(key)
+
+            opens = key.RETURN or key.CTRL and key.CHAR in ('g', 'o', 'p', 's')
+            moves_up = key.UP or key.TAB or key.CTRL and key.CHAR == 'k'
+            moves_down = key.DOWN or key.CTRL and key.CHAR == 'j'
+
+            # The search for the keys typed ahead has been skipped, but these
+            # keys act on the search results: they must be up to date
+            if self.plug.finder.coalesced_keys and (opens or moves_up or moves_down):
+                self._update()
 
             # Go to the tag on the current line
-            if (key.RETURN or key.CTRL and key.CHAR in ('g', 'o', 'p', 's')):
+            if opens:
                 prefix = key.CHAR if key.CHAR in ('s', 'p') else ''
                 if self._open_selected_tag(prefix):
                     break
@@ -100,7 +126,7 @@ class UserInterface:
                 break
 
             # Move up the cursor
-            elif key.UP or key.TAB or key.CTRL and key.CHAR == 'k':
+            elif moves_up:
                 last_index = len(vim.current.buffer) - 1
                 if self.curr_line_idx == 0:
                     self.curr_line_idx = last_index
@@ -108,7 +134,7 @@ class UserInterface:
                     self.curr_line_idx -= 1
 
             # Move down the cursor
-            elif key.DOWN or key.CTRL and key.CHAR == 'j':
+            elif moves_down:
                 last_index = len(vim.current.buffer) - 1
                 if self.curr_line_idx == last_index:
                     self.curr_line_idx = 0
@@ -136,17 +162,53 @@ class UserInterface:
                 v.redraw()
                 continue
 
+            # When the user types (or pastes) faster than we can search, keys
+            # pile up: the search is skipped until all of them have been read,
+            # so that a single search is done for the final query.
+            if self.plug.finder.refind_tags and key.pending():
+                self.plug.finder.coalesced_keys += 1
+                continue
+
             self._update()
 
+        # Run the commands left by the last key (e.g. the jump to a tag)
+        v.flush()
+
     def close(self):
         """To close the Tag Surfer user interface."""
+        self.plug.finder.cancel()
         self._restore_options()
-        vim.command('q')
+        v.command('q')
         if self.curr_buf.winnr:
             v.focus_win(self.curr_buf.winnr)
         self._reset()
         v.redraw()  # Clean the command line
 
+    def _show_prompt(self):
+        """To display the prompt and the current query string."""
+        prompt = settings.get("prompt")
+        color = settings.get("prompt_color")
+        v.command("echohl {} | echon \"{}\" | echohl None".format(color, prompt))
+        query = self.input_so_far.replace("\\", "\\\\").replace('"', '\\"')
+        v.command("echon \"{}\"".format(query.encode('utf-8')))
+
+    def _wait_key(self, key):
+        """To wait for the next key pressed by the user.
+
+        While tags are generated in the background, keys are polled so that
+        the search results can be updated as new tags arrive.
+        """
+        last_update = time.time()
+        while self.plug.finder.generating():
+            if key.get(wait=False):
+                return
+            v.command("sleep {}m".format(POLL_INTERVAL))
+            if time.time() - last_update > PROGRESS_INTERVAL:
+                self._update()
+                self._show_prompt()
+                last_update = time.time()
+        key.get()
+
     def _reset(self):
         """To reset the Tag Surfer user interface state."""
         self.curr_buf = None
@@ -162,15 +224,17 @@ class UserInterface:
         """To set sane options for the search results buffer."""
         # save options that affect all windows and thus cannot be safely set
         # using 'selocal' and we need to manually restore their old values
+        search, laststatus, guicursor, statusline = v.eval_all(
+            "@/", "&laststatus", "&guicursor", "&statusline")
         self.orig_settings = {
             # It seems that somethimes in gVim `vim.eval('@/')` returns `None`
-            "@/": "" if vim.eval("@/") is None else vim.eval("@/"),
-            "laststatus": vim.eval("&laststatus"),
-            "guicursor": vim.eval("&guicursor"),
-            "statusline": vim.eval("&statusline").replace(" ", "\ ")
+            "@/": "" if search is None else search,
+            "laststatus": laststatus,
+            "guicursor": guicursor,
+            "statusline": statusline.replace(" ", "\ ")
         }
 
-        vim.command('let @/ = ""')  # clear the last search
+        v.command('let @/ = ""')  # clear the last search
 
         options = [
             "buftype=nofile", "bufhidden=wipe", "encoding=utf-8",
@@ -186,37 +250,42 @@ class UserInterface:
             options.append("laststatus=2")
 
         for opt in options:
-            vim.command("try|setl {}|catch|endtry".format(opt))
+            v.command("try|setl {}|catch|endtry".format(opt))
 
     def _restore_options(self):
         """To restore original options."""
         for sett, val in self.orig_settings.items():
             if sett in ("@/",):
-                vim.command("let {}=\"{}\" ".format(
+                v.command("let {}=\"{}\" ".format(
                     sett, val.replace('"', '\\"')))
             else:
-                vim.command('set {}={}'.format(sett, val))
+                v.command('set {}={}'.format(sett, val))
 
     def _update(self):
         """To update search results."""
         if not self.finder_win:
             # Open the finder window if not already visible
-            vim.command('silent! botright split {}'.format(self.name))
+            v.command('silent! botright split {}'.format(self.name))
             self._setup_buffer()
             self.finder_win = v.bufwinnr(self.name)
 
         tags = []
         error = None
+        # The root is used to render every line, find it once
+        root = self.plug.services.curr_project.get_root()
         try:
             max_results = settings.get('max_results', int)
-            tags = self.plug.finder.find_tags(self.input_so_far, max_results, self.curr_buf)
+            tags = self.plug.finder.find_tags(self.input_so_far, max_results,
+                self.curr_buf)
             self.plug.finder.rebuild_tags = False
             self.plug.finder.refind_tags = False
+            self.plug.finder.coalesced_keys = 0
         except ex.TagSurferException as e:
             error = e
 
         self.mapper, self.curr_line_idx = self.renderer.render(
-                self.finder_win, self.curr_line_idx, self.input_so_far, tags, error)
+                self.finder_win, self.curr_line_idx, self.input_so_far, tags,
+                root, error)
 
         v.redraw()
 
@@ -230,16 +299,10 @@ class UserInterface:
         """
 
         def extract_kind(line):
-            last_idx = line.find(tag["name"]) - 1
+            last_idx = line.find(tag.name) - 1
             first_idx = line[:last_idx+1].rfind(" ") + 1
             return line[first_idx:last_idx]
 
-        def get_tag_line(tag):
-            if tag["exts"].get("line") or tag["excmd"].isdigit():
-                return tag["exts"].get("line", tag["excmd"])
-            else:
-                return ""
-
         candidates = {}
         curr_candidate = -1
 
@@ -248,16 +311,16 @@ class UserInterface:
             if line.startswith("#"):
                 continue
 
-            if line and line[0].isdigit() and tag["name"] in line:
+            if line and line[0].isdigit() and tag.name in line:
                 # The line starts with a number, this is the tag count,
                 # that is, the number that with can use in conjunction with
                 # the `:tag` command to get a specific tag (e.g. `:2tag <tag>`)
                 curr_candidate = line[0]
                 candidates[curr_candidate] = 0
 
-                if line.split()[-1] == tag["file"]:
+                if line.split()[-1] == tag.file:
                     candidates[curr_candidate] += 1
-                if extract_kind(line) == tag["exts"].get("kind"):
+                if extract_kind(line) == tag.kind:
                     candidates[curr_candidate] += 1
 
             else:
@@ -265,11 +328,11 @@ class UserInterface:
                     found = False
                     for f in line.split():
                         if f.startswith("line:"):
-                            if line[6:] == get_tag_line(tag):
+                            if line[6:] == tag.line:
                                 found = True
                                 candidates[curr_candidate] += 1
                     if not found:
-                        if line == tag["excmd"][2:-2]:
+                        if line == tag.excmd[2:-2]:
                             candidates[curr_candidate] += 1
 
         return candidates
@@ -280,12 +343,12 @@ class UserInterface:
         We do this parsing the output of the `:tselect <tag>`
         vim command.
         """
-        tempf = vim.eval("tempname()")
-        vim.command("""
+        tempf = v.eval("tempname()")
+        v.command("""
             redir > {} |
             try | silent! ts {} | catch | endtry |
-            redir END""".format(tempf, tag["name"]))
-        lines = vim.eval("readfile('{}')".format(tempf))
+            redir END""".format(tempf, tag.name))
+        lines = v.eval("readfile('{}')".format(tempf))
         scores = self._compute_tag_candidates_scores(lines, tag)
         try:
             os.remove(tempf)
@@ -295,24 +358,64 @@ class UserInterface:
         if scores:
             return max(scores.items(), key=itemgetter(1))[0]
 
+    def _jump_to_tag(self, tag, prefix=""):
+        """To jump to `tag` using the file and the position stored with it.
+
+        Unlike the `:tag` command, vim doesn't have to look up the tag in
+        the tag files again. The jump is pushed onto the tag stack of the
+        window, so that `CTRL-T` still brings the user back. False is
+        returned if the jump can't be done this way.
+        """
+        file = tag.file.encode("utf-8")
+        if not self.tagstack or not os.path.isfile(file):
+            return False
+
+        name = v.quote(tag.name.encode("utf-8"))
+        edit = {"s": "split", "p": "pedit"}.get(prefix, "edit")
+        v.command("let g:_tsurf_from = getpos('.')")
+        v.command("let g:_tsurf_from[0] = bufnr('%')")
+        v.command("exe '{}' fnameescape({})".format(edit, v.quote(file)))
+        if prefix == "p":
+            v.command("wincmd P")
+
+        excmd = tag.excmd
+        if excmd.isdigit():
+            v.command("call cursor({}, 1)".format(excmd))
+        else:
+            v.command("call cursor(1, 1)")
+            v.command("if !search({}, 'cW') | call cursor({}, 1) | endif".format(
+                v.quote(vim_pattern(excmd).encode("utf-8")), tag.line or 1))
+
+        if prefix == "p":
+            v.command("normal! zz")
+            v.command("wincmd p")
+        else:
+            # The window created by `:split` has a copy of the tag stack
+            v.command("call settagstack(win_getid(), {{'items': [{{'bufnr': "
+                      "g:_tsurf_from[0], 'from': g:_tsurf_from, 'tagname': "
+                      "{}}}]}}, 't')".format(name))
+        v.command("unlet g:_tsurf_from")
+        return True
+
     def _open_selected_tag(self, prefix=""):
         """To open the tag on the current line."""
         tag = self.mapper.get(self.curr_line_idx)
         if tag:
             self.close()
 
-            # There may be more tags with the same name, so we
-            # have to pick the best candidate
-            count = self._get_best_tag_candidate(tag)
-            if count:
-                vim.command("silent {}{}tag {}".format(count, prefix, tag["name"]))
-            else:
-                # An error occurred, probably no tag file has been found
-                v.echohl("No tag file found. be sure that the `tags` option "
-                         "is not changed while Tag Surfer is working",
-                         "WarningMsg")
+            if not self._jump_to_tag(tag, prefix):
+                # There may be more tags with the same name, so we
+                # have to pick the best candidate
+                count = self._get_best_tag_candidate(tag)
+                if count:
+                    v.command("silent {}{}tag {}".format(count, prefix, tag.name))
+                else:
+                    # An error occurred, probably no tag file has been found
+                    v.echohl("No tag file found. be sure that the `tags` option "
+                             "is not changed while Tag Surfer is working",
+                             "WarningMsg")
 
-            vim.command("normal! zz")  # Center the screen
+            v.command("normal! zz")  # Center the screen
             return True
 
 
@@ -321,10 +424,13 @@ class Renderer:
     def __init__(self, plug):
         self.plug = plug
         self.last_matches = []
+        # With no `matchaddpos` (vim < 7.4.330) matching characters are
+        # highlighted with one syntax pattern per line
+        self.matchaddpos = v.has_function("matchaddpos")
 
     def setup_colors(self):
         """To setup Tag Surfer highlight groups."""
-        postfix = "" if vim.eval("&bg") == "light" else "_darkbg"
+        postfix = "" if v.eval("&bg") == "light" else "_darkbg"
         colors = {
             "TagSurferShade": settings.get("shade_color{}".format(postfix)),
             "TagSurferMatches": settings.get("matches_color{}".format(postfix)),
@@ -332,12 +438,17 @@ class Renderer:
         }
         for group, color in colors.items():
             link = "" if "=" in color else "link"
-            vim.command("hi {} {} {}".format(link, group, color))
+            v.command("hi {} {} {}".format(link, group, color))
+        v.flush()
 
-    def render(self, target_win, curr_line_idx, query, tags, error=None):
-        """To render all search results."""
+    def render(self, target_win, curr_line_idx, query, tags, root, error=None):
+        """To render all search results. `root` is the root of the current
+        project, if any."""
         v.focus_win(target_win)
-        vim.command('syntax clear')
+        if self.matchaddpos:
+            v.command('syntax clear | call clearmatches()')
+        else:
+            v.command('syntax clear')
         self.last_matches = []
         mapper = {}
 
@@ -352,15 +463,15 @@ class Renderer:
 
             # Find duplicates file names
             dups = {}
-            for _, g in groupby(tags, key=lambda t: os.path.basename(t["file"])):
+            for _, g in groupby(tags, key=lambda t: os.path.basename(t.file)):
                 # s is a set of unique paths but with the same basename
-                s = set(t["file"] for t in g)
+                s = set(t.file for t in g)
                 if len(s) > 1:
                     dups.update((file, True) for file in s)
 
             mapper = dict(enumerate(t for t in tags))
-            self.last_matches = [t["match_positions"] for t in tags]
-            v.set_buffer([self._render_line(t, query, dups) for t in tags])
+            self.last_matches = [t.match_positions for t in tags]
+            v.set_buffer([self._render_line(t, query, dups, root) for t in tags])
             curr_line_idx = self._render_curr_line(curr_line_idx)
             self._highlight()
             v.set_win_height(len(tags))
@@ -372,11 +483,11 @@ class Renderer:
             curr_line_idx = 0
 
         v.set_win_cursor(curr_line_idx + 1, 0)
-        vim.command("normal! 0")
+        v.command("normal! 0")
 
         return mapper, curr_line_idx
 
-    def _render_line(self, tag, query, dups_fnames):
+    def _render_line(self, tag, query, dups_fnames, root):
         """To format a single line with the tag information."""
 
         def fmt_file(tag):
@@ -384,8 +495,7 @@ class Renderer:
             pmod = settings.get("project_search_modifier")
             bmod = settings.get("buffer_search_modifier")
 
-            file = tag["file"].encode('utf-8')
-            root = self.plug.services.curr_project.get_root()
+            file = tag.file.encode('utf-8')
 
             if settings.get("tag_file_full_path", bool):
                 if query.startswith(pmod) and root:
@@ -425,40 +535,33 @@ class Renderer:
             """Format debug information."""
             if settings.get("debug", bool):
                 return  " | debug: ({:.4f}|{})".format(
-                    tag["similarity"], tag["match_positions"])
+                    tag.similarity, tag.match_positions)
             return ""
 
-        def get_linenr(tag):
-            """Get line number if available."""
-            if tag["exts"].get("line") or tag["excmd"].isdigit():
-                return tag["exts"].get("line", tag["excmd"])
-            else:
-                return ""
-
         def fmt(fmtstr):
             """Replace the attribute in `fmtdtr` with its value."""
             if "{name}" in fmtstr:
-                return fmtstr.replace("{name}", tag["name"])
+                return fmtstr.replace("{name}", tag.name)
             if "{excmd}" in fmtstr:
-                return fmtstr.replace("{excmd}", tag["excmd"])
+                return fmtstr.replace("{excmd}", tag.excmd)
             if "{file}" in fmtstr:
                 return fmtstr.replace("{file}", fmt_file(tag))
             if "{context}" in fmtstr:
-                return fmtstr.replace("{context}", tag["context"])
+                return fmtstr.replace("{context}", tag.context)
             if "{line}" in fmtstr:
-                ln = get_linenr(tag)
+                ln = tag.line
                 if ln:
                     return fmtstr.replace("{line}", ln)
                 else:
                     return ""
             try:
-                return fmtstr.format(**tag["exts"])
+                return fmtstr.format(**tag.exts)
             except KeyError:
                 return ""
 
         return "{}{} @ {}{}".format(
             " "*len(settings.get("current_line_indicator")),
-            tag["name"].encode('utf-8'),
+            tag.name.encode('utf-8'),
             "".join(fmt(fmtstr) for fmtstr in settings.get("line_format")),
             fmt_debug(tag))
 
@@ -474,14 +577,37 @@ class Renderer:
         return curr_line_idx
 
     def _highlight(self, error=False):
-        """To color the Tag Surfer user interface."""
-        vim.command("syntax clear")
+        """To color the Tag Surfer user interface. Highlights must have been
+        cleared already."""
         if error:
             v.highlight("TagSurferError", ".*")
         else:
             v.highlight("TagSurferShade", "@.*")
-            indic_len = len(settings.get("current_line_indicator"))
-            for i, match_positions in enumerate(self.last_matches):
-                for pos in match_positions:
-                    patt = "\c\%{}l\%{}c.".format(i+1, pos+indic_len+1)
-                    v.highlight("TagSurferMatches", patt)
+            offset = len(settings.get("current_line_indicator")) + 1
+            if self.matchaddpos:
+                v.highlight_positions("TagSurferMatches",
+                    [(i+1, pos+offset)
+                     for i, match_positions in enumerate(self.last_matches)
+                     for pos in match_positions])
+            else:
+                for i, match_positions in enumerate(self.last_matches):
+                    if match_positions:
+                        cols = "\|".join("\%{}c".format(pos+offset)
+                                          for pos in match_positions)
+                        patt = "\c\%{}l\%({}\).".format(i+1, cols)
+                        v.highlight("TagSurferMatches", patt)
+
+
+def vim_pattern(excmd):
+    """To convert the search pattern `excmd` of a tag (e.g. `/^def f$/`) into
+    a very nomagic vim pattern. Only the anchors are special in tag patterns,
+    while `/` and backslashes are escaped by ctags as they are in `\V`
+    patterns."""
+    patt = excmd[1:-1] if excmd[-1:] == excmd[:1] else excmd[1:]
+    start, end = "", ""
+    if patt.startswith("^"):
+        patt, start = patt[1:], "\\^"
+    if patt.endswith("$") and not patt.endswith("\\$"):
+        patt, end = patt[:-1], "\\$"
+    return "\\V" + start + patt + end
+
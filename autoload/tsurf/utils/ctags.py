@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.utils.ctags
+~~~~~~~~~~~~~~~~~
+
+This module defines utility functions for executing ctags-compatible
+programs.
+"""
+
+import os
+import json
+import Queue
+import shlex
+import tempfile
+import threading
+import subprocess
+
+from collections import defaultdict
+
+from tsurf.utils import misc
+from tsurf import exceptions as ex
+
+
+# Maximum number of files given to a single ctags process
+CHUNK_SIZE = 1000
+
+# Seconds between two checks for cancellation while waiting for output
+CANCEL_CHECK_INTERVAL = 0.05
+
+# Settings that tell how tags are generated (see `group_options`)
+SETTINGS = ("ctags_bin", "ctags_args", "ctags_custom_args", "custom_languages")
+
+
+def command(bin, args, custom_args, sanitize=lambda s: s):
+    """To return the command line (as a list) for the given ctags
+    program and arguments."""
+    return shlex.split("{} {} {}".format(
+        sanitize(bin), sanitize(args), sanitize(custom_args)))
+
+
+def fingerprint(conf):
+    """To return a string that changes whenever the settings in `conf`
+    (see `SETTINGS`) change the way tags are generated. Settings decoded
+    from JSON (as the tag server gets them) have the same fingerprint as
+    settings taken from vim."""
+    return json.dumps([conf[name] for name in SETTINGS], sort_keys=True)
+
+
+def group_files(files, custom_languages):
+    """To group files according to their filetype.
+
+    The filetype "*" groups all files that will be parsed by Exuberant
+    Ctags.  Note that filetype groups different from "*" are generated
+    only for filetypes found in `custom_languages`.
+    """
+    # Create a map where each file extension points to
+    # a specific filetype.
+    extensions_map = {}
+    for ft, options in custom_languages.items():
+        for ext in options.get("extensions", []):
+            extensions_map[ext] = ft
+
+    groups = defaultdict(list)
+    for f in files:
+        ext = os.path.splitext(f)[1]
+        groups[extensions_map.get(ext, "*")].append(f)
+
+    return groups
+
+
+def group_options(ft, conf):
+    """To return the ctags program and options for the filetype `ft`,
+    according to the settings in `conf` (see `SETTINGS`)."""
+    if ft == "*":
+        # use the official ctags
+        return {
+            "bin": conf["ctags_bin"],
+            "args": conf["ctags_args"],
+            "custom_args": conf["ctags_custom_args"],
+            "kinds": {},
+            "exclude_kinds": {}
+        }
+    else:
+        lang = conf["custom_languages"][ft]
+        return {
+            "bin": lang.get("bin", ""),
+            "args": lang.get("args", ""),
+            "custom_args": "",
+            "kinds": lang.get("kinds_map", {}),
+            "exclude_kinds": dict((k, True) for k in lang.get("exclude_kinds", []))
+        }
+
+
+def chunks(files, jobs):
+    """To split `files` into chunks so that each one of the `jobs` workers
+    gets at least a chunk (if there are enough files) and no chunk has more
+    than `CHUNK_SIZE` files."""
+    if not files:
+        return []
+    n = max(jobs, (len(files) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    size = (len(files) + n - 1) // n
+    return [files[i:i+size] for i in range(0, len(files), size)]
+
+
+def workers(n):
+    """To return the number of concurrent ctags workers. If `n` is not
+    a positive number, one worker for each CPU is used."""
+    if n > 0:
+        return n
+    return misc.cpus()
+
+
+def stream(cmd, files, jobs=1, file_list=True, startupinfo=None, cancelled=None):
+    """To run `cmd` over `files` and yield its output line by line as soon
+    as it's available.
+
+    Files are split into chunks and each chunk is handled by a different
+    ctags process, with at most `jobs` processes running at the same time.
+    When `file_list` is True, files are fed to ctags through its standard
+    input (`-L -`) instead of the command line.
+
+    Lines are yielded in the same order as `files`, no matter which
+    process finishes first: the output of the first chunk is yielded while
+    it's produced, whereas the output of the other chunks is held back
+    until all previous chunks are done. If the generator is closed before
+    the end, all running processes are killed. The same happens as soon as
+    the event `cancelled` (if given) is set, even when no output is
+    available.
+    """
+    parts = chunks(files, jobs)
+    queues = [Queue.Queue() for _ in parts]
+    todo = Queue.Queue()
+    for i in range(len(parts)):
+        todo.put(i)
+
+    procs = {}
+    state = {"cancelled": False}
+    lock = threading.Lock()
+
+    def run_chunk(i):
+        chunk = parts[i]
+        if file_list:
+            argv = cmd + ["-L", "-"]
+        else:
+            argv = cmd + chunk
+        err = tempfile.TemporaryFile()
+        try:
+            with lock:
+                if state["cancelled"]:
+                    return
+                proc = subprocess.Popen(argv, universal_newlines=True,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        stderr=err, startupinfo=startupinfo)
+                procs[i] = proc
+            if file_list:
+                # Feed files from another thread, otherwise we may wait
+                # forever for ctags to read them while ctags waits for us
+                # to read its output.
+                feeder = threading.Thread(target=feed, args=(proc.stdin, chunk))
+                feeder.daemon = True
+                feeder.start()
+            else:
+                proc.stdin.close()
+            for line in iter(proc.stdout.readline, ""):
+                queues[i].put(line.rstrip("\n"))
+            proc.wait()
+            err.seek(0)
+            if err.read() and not state["cancelled"]:
+                raise ex.TagSurferException("Error: '{}' failed to generate "
+                    "tags.\nCheck that it's an Exuberant Ctags "
+                    "compatible program or that the arguments provided "
+                    "are valid".format(cmd[0]))
+        finally:
+            err.close()
+
+    def worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                run_chunk(i)
+                queues[i].put(None)
+            except ex.TagSurferException as e:
+                queues[i].put(e)
+            except Exception as e:
+                queues[i].put(ex.TagSurferException("Unexpected error: " + str(e)))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(jobs, len(parts)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for q in queues:
+            while True:
+                try:
+                    line = q.get(timeout=CANCEL_CHECK_INTERVAL)
+                except Queue.Empty:
+                    if cancelled is not None and cancelled.is_set():
+                        return
+                    continue
+                if line is None:
+                    break
+                if isinstance(line, Exception):
+                    raise line
+                yield line
+    finally:
+        with lock:
+            state["cancelled"] = True
+            for proc in procs.values():
+                if proc.poll() is None:
+                    try:
+                        proc.kill()
+                    except OSError:
+                        pass
+
+
+def feed(pipe, files):
+    """To write the given `files` into `pipe`, one per line."""
+    try:
+        for f in files:
+            pipe.write(f + "\n")
+    except (IOError, OSError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
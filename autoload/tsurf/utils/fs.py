@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.utils.fs
+~~~~~~~~~~~~~~
+
+This module defines utility functions for listing all files of a project.
+Files are listed with `git ls-files` when the project is a git repository,
+otherwise the project tree is walked. Either way, files matching any of
+the `.gitignore` or `wildignore` patterns are left out.
+
+It also defines the ProjectFiles class, which keeps the list of all files
+of a project up to date watching for changes in the project tree.
+"""
+
+import os
+import re
+import time
+import stat
+import fnmatch
+import subprocess
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def project_files(root, wildignore="", use_git=True):
+    """To return all regular files of the project `root`.
+
+    `wildignore` is a comma-separated list of patterns in the same format as
+    the vim option `wildignore`. If `use_git` is True and `root` is a git
+    repository, files are listed with `git ls-files`.
+    """
+    rules = WildIgnore(wildignore)
+    if use_git and os.path.exists(os.path.join(root, ".git")):
+        files = _filtered_git_files(root, rules)
+        if files is not None:
+            return files
+    return walk(root, rules)
+
+
+def _filtered_git_files(root, rules):
+    """To return the files listed by `git_files` that are not hidden and
+    do not match the `wildignore` rules."""
+    files = git_files(root)
+    if files is None:
+        return
+    # As when walking the project tree, hidden files and files inside
+    # hidden or ignored directories are ignored too
+    memo = {}
+
+    def dir_ignored(folder):
+        if len(folder) <= len(root):
+            return False
+        if folder not in memo:
+            memo[folder] = (os.path.basename(folder).startswith(".") or
+                            rules.ignored(folder, True) or
+                            dir_ignored(os.path.dirname(folder)))
+        return memo[folder]
+
+    sep = os.path.sep
+    return [f for f in files
+            if f[f.rfind(sep)+1] != "." and not dir_ignored(f[:f.rfind(sep)])
+            and not (rules and rules.ignored(f))]
+
+
+def git_files(root):
+    """To return all regular files of the git repository `root` that are
+    either tracked or untracked but not ignored. None is returned if git
+    fails."""
+    # Both commands need to look at every file, run them at the same time
+    procs = [_git(root, "-s", "--cached", "--others", "--exclude-standard"),
+             _git(root, "--deleted")]
+    if None in procs:
+        return
+    out, deleted = [proc.communicate()[0] for proc in procs]
+    if any(proc.returncode != 0 for proc in procs):
+        return
+    deleted = set(deleted.split("\0"))
+    seen = set()
+    files = []
+    prefix = os.path.join(root, "")
+    for entry in out.split("\0"):
+        # Tracked files are listed as "<mode> <object> <stage>\t<file>",
+        # untracked files are listed alone
+        mode, tab, f = entry.partition("\t")
+        if not tab:
+            mode, f = "", entry
+        if not f or f in seen or f in deleted:
+            continue
+        # Files with unresolved conflicts are listed more than once
+        seen.add(f)
+        path = prefix + f
+        if mode.startswith("100") or (mode[:3] in ("", "120") and os.path.isfile(path)):
+            files.append(path)
+    return files
+
+
+def _git(root, *args):
+    """To start `git ls-files` for the repository `root`, with file names
+    separated by NUL characters. None is returned if git can't be found."""
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.Popen(["git", "ls-files", "-z"] + list(args),
+                                    cwd=root, stdout=subprocess.PIPE, stderr=devnull)
+    except OSError:
+        return
+
+
+def walk(root, wildignore=None):
+    """To return all regular files found under `root`.
+
+    Hidden files and directories are skipped, as well as anything matching
+    the patterns of the `.gitignore` files found along the way or the
+    `wildignore` rules. Symbolic links to directories are not followed.
+    """
+    files = []
+    stack = [(root, [])]
+    while stack:
+        folder, rules = stack.pop()
+        scan = _scan(folder, rules, wildignore)
+        if scan:
+            rules, folder_files, folders, _ = scan
+            files.extend(folder_files)
+            stack.extend((f, rules) for f in folders)
+    return files
+
+
+def _scan(folder, rules, wildignore):
+    """To list the content of a single `folder`.
+
+    `rules` are the `.gitignore` rules of the parent folders. Returns a tuple
+    (rules, files, subfolders, has .gitignore) where rules also include the
+    `.gitignore` of `folder`, if any. None is returned if `folder` can't be
+    listed.
+    """
+    try:
+        entries = list(_entries(folder))
+    except OSError:
+        return
+    has_gitignore = any(name == ".gitignore" for name, _, _, _ in entries)
+    if has_gitignore:
+        gitignore = GitIgnore.load(os.path.join(folder, ".gitignore"), folder)
+        if gitignore:
+            rules = rules + [gitignore]
+    files = []
+    folders = []
+    for name, path, is_dir, is_file in entries:
+        if name.startswith("."):
+            continue
+        if wildignore and wildignore.ignored(path, is_dir):
+            continue
+        if any(r.ignored(path, is_dir) for r in rules):
+            continue
+        if is_dir:
+            folders.append(path)
+        elif is_file:
+            files.append(path)
+    return rules, files, folders, has_gitignore
+
+
+def _entries(folder):
+    """To yield a tuple (name, path, is directory, is file) for each entry
+    in `folder`. Symbolic links to files count as files, symbolic links to
+    directories count as neither."""
+    if scandir is not None:
+        for entry in scandir(folder):
+            yield (entry.name, entry.path, entry.is_dir(follow_symlinks=False),
+                   entry.is_file())
+        return
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith(".") and name != ".gitignore":
+            yield name, path, False, False
+            continue
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            continue
+        if stat.S_ISLNK(mode):
+            yield name, path, False, os.path.isfile(path)
+        else:
+            yield name, path, stat.S_ISDIR(mode), stat.S_ISREG(mode)
+
+
+class WildIgnore:
+    """Patterns in the format of the vim option `wildignore`. Patterns are
+    matched against both the full path and the file name."""
+
+    def __init__(self, patterns):
+        regexes = [fnmatch.translate(p.strip().replace("\\,", ","))
+                   for p in re.split(r"(?<!\\),", patterns) if p.strip()]
+        self.regex = re.compile("|".join(regexes)) if regexes else None
+
+    def __nonzero__(self):
+        return self.regex is not None
+
+    def ignored(self, path, is_dir=False):
+        """To check whether `path` matches any pattern. A trailing path
+        separator is added to directories so that patterns such as
+        `*/build/*` match the `build` directory itself."""
+        if self.regex is None:
+            return False
+        if is_dir:
+            path += os.path.sep
+        return bool(self.regex.match(path) or
+                    self.regex.match(os.path.basename(path.rstrip(os.path.sep))))
+
+
+class GitIgnore:
+    """The patterns of a `.gitignore` file. Patterns are relative to the
+    directory `base` where the file is found."""
+
+    def __init__(self, lines, base):
+        self.base = base.rstrip(os.path.sep) + os.path.sep
+        # `self.rules` is a list of tuples (regex, negated, only directories)
+        self.rules = []
+        for line in lines:
+            rule = self._parse(line)
+            if rule:
+                self.rules.append(rule)
+
+    @classmethod
+    def load(cls, path, base):
+        """To load the `.gitignore` file at `path`."""
+        try:
+            with open(path) as f:
+                return cls(f.read().splitlines(), base)
+        except IOError:
+            return
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def ignored(self, path, is_dir=False):
+        """To check whether `path` is ignored. As in git, the last matching
+        pattern wins."""
+        if not path.startswith(self.base):
+            return False
+        relpath = path[len(self.base):]
+        if os.path.sep != "/":
+            relpath = relpath.replace(os.path.sep, "/")
+        ignored = False
+        for regex, negated, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                ignored = not negated
+        return ignored
+
+    def _parse(self, line):
+        """To turn a `.gitignore` line into a rule."""
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            return
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return
+        # Patterns without a slash match at any depth, the other ones are
+        # relative to the `.gitignore` directory.
+        if "/" in line:
+            regex = _translate(line.lstrip("/"))
+        else:
+            regex = "(?:.*/)?" + _translate(line)
+        return re.compile(regex + r"\Z"), negated, dir_only
+
+
+def _translate(pattern):
+    """To translate a `.gitignore` pattern into a regular expression.
+    Unlike `fnmatch.translate`, wildcards do not match slashes but `**`
+    matches any number of directories."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            out.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            j = pattern.find("]", i + 2)
+            if j < 0:
+                out.append(re.escape("["))
+                i += 1
+            else:
+                chars = pattern[i+1:j]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                out.append("[" + chars.replace("\\", "\\\\") + "]")
+                i = j + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(out)
+
+
+# The state of a folder of a project. `mtime` and `gitignore_mtime` are the
+# modification times of the folder and of its `.gitignore` file (None if
+# there is no such file). `inherited` are the `.gitignore` rules of the
+# parent folders, while `rules` also include the folder `.gitignore`.
+Folder = namedtuple("Folder", "mtime gitignore_mtime inherited rules files folders")
+
+
+class ProjectFiles:
+    """The list of all regular files of a project (see `project_files`).
+
+    The list is built once and then kept up to date by checking the
+    modification time of every folder of the project, which changes only
+    when files are added, removed or renamed in the folder. Only the
+    folders that changed are listed again.
+
+    When files are listed with git, any change causes files to be listed
+    again with git.
+    """
+
+    def __init__(self, root, wildignore="", use_git=True):
+        self.root = root
+        self.wildignore = wildignore
+        self.use_git = use_git
+        self.rules = WildIgnore(wildignore)
+        # `self.folders` has the form {folder: Folder(..), ...}
+        self.folders = {}
+        # `self.git_mtimes` has the form {path: modification time, ...} and
+        # holds the git index along with every folder with at least a file
+        # when files are listed with git. It's None otherwise.
+        self.git_mtimes = None
+        self.files = None
+
+    def get(self):
+        """To return all files of the project."""
+        if self.files is None:
+            self._list()
+        elif self.git_mtimes is not None:
+            if any(_mtime(path) != mtime or _recent(mtime)
+                   for path, mtime in self.git_mtimes.iteritems()):
+                self._list()
+        elif self._refresh():
+            self._collect()
+        return self.files
+
+    def _list(self):
+        """To list all files of the project from scratch."""
+        self.folders = {}
+        self.git_mtimes = None
+        if self.use_git and os.path.exists(os.path.join(self.root, ".git")):
+            # Modification times are taken before listing files so that
+            # changes made in the meantime won't go unnoticed
+            mtimes = {os.path.join(self.root, ".git", "index"): None}
+            mtimes[self.root] = None
+            for path in mtimes:
+                mtimes[path] = _mtime(path)
+            files = _filtered_git_files(self.root, self.rules)
+            if files is not None:
+                for f in files:
+                    folder = os.path.dirname(f)
+                    while folder not in mtimes and len(folder) > len(self.root):
+                        mtimes[folder] = _mtime(folder)
+                        folder = os.path.dirname(folder)
+                self.git_mtimes = mtimes
+                self.files = files
+                return
+        self._walk(self.root, [])
+        self._collect()
+
+    def _walk(self, folder, rules):
+        """To list `folder` and all its subfolders."""
+        stack = [(folder, rules)]
+        while stack:
+            folder, rules = stack.pop()
+            state = self._scan(folder, rules)
+            if state:
+                stack.extend((f, state.rules) for f in state.folders)
+
+    def _scan(self, folder, inherited):
+        """To list `folder` (but not its subfolders) and remember its
+        state."""
+        mtime = _mtime(folder)
+        scan = _scan(folder, inherited, self.rules)
+        if scan is None:
+            self._drop(folder)
+            return
+        rules, files, folders, has_gitignore = scan
+        gitignore_mtime = None
+        if has_gitignore:
+            gitignore_mtime = _mtime(os.path.join(folder, ".gitignore"))
+        state = Folder(mtime, gitignore_mtime, inherited, rules, files, folders)
+        self.folders[folder] = state
+        return state
+
+    def _refresh(self):
+        """To list again all folders that changed since the last time.
+        Returns True if any folder changed."""
+        changed = False
+        for folder in list(self.folders):
+            old = self.folders.get(folder)
+            if old is None:
+                # The folder has been removed along with its parent
+                continue
+            gitignore = os.path.join(folder, ".gitignore")
+            if (_mtime(folder) == old.mtime and not _recent(old.mtime) and
+                    (old.gitignore_mtime is None or
+                     _mtime(gitignore) == old.gitignore_mtime and
+                     not _recent(old.gitignore_mtime))):
+                continue
+            changed = True
+            new = self._scan(folder, old.inherited)
+            if new is None:
+                continue
+            if new.gitignore_mtime != old.gitignore_mtime:
+                # Ignore rules changed for all subfolders
+                for f in old.folders:
+                    self._drop(f)
+                for f in new.folders:
+                    self._walk(f, new.rules)
+            else:
+                for f in set(old.folders) - set(new.folders):
+                    self._drop(f)
+                for f in new.folders:
+                    if f not in self.folders:
+                        self._walk(f, new.rules)
+        return changed
+
+    def _drop(self, folder):
+        """To forget `folder` and all its subfolders."""
+        stack = [folder]
+        while stack:
+            state = self.folders.pop(stack.pop(), None)
+            if state:
+                stack.extend(state.folders)
+
+    def _collect(self):
+        """To collect files from all folders."""
+        self.files = [f for folder in sorted(self.folders)
+                      for f in self.folders[folder].files]
+
+
+def _mtime(path):
+    """To return the modification time of `path` or None if it does not
+    exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return
+
+
+def _recent(mtime):
+    """To check whether `mtime` is so recent that the path may have been
+    changed again within the same second without its modification time
+    changing."""
+    return mtime is not None and time.time() - mtime < 2
@@ -7,7 +7,7 @@ This module defines the Input class that is responsible for handling
 the input coming from the user via the command line.
 """
 
-import vim
+from tsurf.utils import v
 
 
 class Input:
@@ -23,39 +23,56 @@ class Input:
         self.CHAR = ""
         self.F1 = self.F2 = self.F3 = self.F4 = self.F5 = self.F6 = None
         self.F7 = self.F8 = self.F9 = self.F10 = self.F11 = self.F12 = None
-        vim.command("let g:_tsurf_char = ''")
-        vim.command("let g:_tsurf_interrupt = 0")
 
-    def get(self):
-        """To read a key pressed by the user."""
+    def pending(self):
+        """To check whether a key is waiting to be read. The key is not
+        consumed."""
+        return v.eval("getchar(1)") != "0"
+
+    def get(self, wait=True):
+        """To read a key pressed by the user.
+
+        If `wait` is False and no key is available, False is returned right
+        away. Otherwise True is returned.
+        """
         self._reset()
 
-        vim.command("""
+        v.command("""
+            let g:_tsurf_char = '' |
+            let g:_tsurf_interrupt = 0 |
             try |
-             let g:_tsurf_char = strtrans(getchar()) |
+             let g:_tsurf_char = strtrans(getchar({})) |
             catch |
              let g:_tsurf_interrupt = 1 |
             endtry
-        """)
+        """.format("" if wait else "0"))
 
-        if vim.eval('g:_tsurf_interrupt') == '1':  # Ctrl + c
+        # Everything we may need to know about the key is fetched at once
+        interrupt, raw_char, nr, char = v.eval_all(
+            "g:_tsurf_interrupt", "g:_tsurf_char",
+            "str2nr(g:_tsurf_char)", "nr2char(str2nr(g:_tsurf_char))")
+
+        if interrupt == '1':  # Ctrl + c
             self.CTRL = True
             self.CHAR = unicode("c", "utf-8")
             self.INTERRUPT = True
-            return
+            return True
 
-        raw_char = vim.eval('g:_tsurf_char')
+        # `getchar(0)` returns 0 if no key is available
+        if raw_char == "0":
+            return False
 
         # only with mac os
         # 'cmd' key has been pressed
         if raw_char.startswith("<80><fc><80>"):
             self.MAC_CMD = True
             char = raw_char.replace("<80><fc><80>", "")
-            nr = vim.eval("char2nr('{}')".format(char))
+            nr = v.eval("char2nr('{}')".format(char))
+            char = v.eval("nr2char({})".format(nr))
         else:
             # we use str2nr in order to get a negative number as a result if
             # the user press a special key such as backspace
-            nr = int(vim.eval("str2nr('{}')".format(raw_char)))
+            nr = int(nr)
 
         if nr != 0:
 
@@ -67,9 +84,9 @@ class Input:
                 self.TAB = True
             elif 1 <= nr <= 26:
                 self.CTRL = True
-                self.CHAR = vim.eval("nr2char({})".format(nr + 96)).decode('utf-8')
+                self.CHAR = unichr(nr + 96)
             else:
-                self.CHAR = vim.eval("nr2char({})".format(nr)).decode('utf-8')
+                self.CHAR = char.decode('utf-8')
 
         else:
 
@@ -111,3 +128,5 @@ class Input:
             else:
                 # mouse clicks or scrolls
                 self.MOUSE = True
+
+        return True
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.utils.job
+~~~~~~~~~~~~~~~
+
+This module defines the Job class, used to run long tasks (such as tag
+generation) in a background thread while the user interface keeps
+accepting input.
+"""
+
+import threading
+from collections import deque
+
+from tsurf import exceptions as ex
+
+
+class Job(threading.Thread):
+    """To consume a generator in a background thread.
+
+    Items yielded by the generator are buffered until they are taken with
+    the `take` method. The generator must not use the vim module.
+    """
+
+    def __init__(self, gen, cancelled=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.gen = gen
+        # `self.cancelled` is set when the job is cancelled. It can be
+        # shared with the generator so that it can stop waiting for
+        # whatever it's waiting for.
+        self.cancelled = cancelled or threading.Event()
+        self.items = deque()
+        self.error = None
+
+    def run(self):
+        try:
+            for item in self.gen:
+                if self.cancelled.is_set():
+                    break
+                self.items.append(item)
+        except ex.TagSurferException as e:
+            self.error = e
+        except Exception as e:
+            self.error = ex.TagSurferException("Unexpected error: " + str(e))
+        finally:
+            # Closing the generator gives it a chance to clean up (e.g. to
+            # kill running processes)
+            self.gen.close()
+
+    def take(self):
+        """To return all items produced since the last call. If the job
+        failed, the exception is raised once all items have been taken."""
+        items = []
+        try:
+            while True:
+                items.append(self.items.popleft())
+        except IndexError:
+            pass
+        if not items and not self.items and self.error and not self.is_alive():
+            error, self.error = self.error, None
+            raise error
+        return items
+
+    def done(self):
+        """To check whether the job is over and all items (and the error,
+        if any) have been taken."""
+        return not self.is_alive() and not self.items and self.error is None
+
+    def cancel(self):
+        """To cancel the job and wait for it to stop. Items not yet taken are
+        discarded."""
+        self.cancelled.set()
+        if self.is_alive():
+            self.join()
+        self.items.clear()
@@ -6,7 +6,105 @@ tsurf.utils.misc
 This module defines various utilities.
 """
 
+import sys
+import heapq
+import multiprocessing
+from itertools import count, izip
+from collections import OrderedDict
+
+
+def cpus():
+    """To return the number of CPUs."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
 
 def millis(td):
     """To return the total milliseconds of a timedelta object."""
     return (td.days * 86400 + td.seconds) / 0.001  + (td.microseconds) * 0.001
+
+
+def best(items, n, key):
+    """To return the `n` items with the lowest `key` value.
+
+    Items are returned exactly as `sorted(items, key=key, reverse=True)[-n:]`
+    would return them (ties included) but only the best `n` items are kept
+    while scanning `items`.
+    """
+    if n <= 0:
+        return []
+    keyf = lambda pair: (key(pair[1]), -pair[0])
+    winners = heapq.nsmallest(n, izip(count(), items), key=keyf)
+    winners.reverse()
+    return [item for _, item in winners]
+
+
+def deep_size(obj, seen=None):
+    """To return the size in bytes of `obj` and all objects it refers to.
+    Objects shared between containers are counted only once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_size(obj.__dict__, seen)
+        for cls in getattr(type(obj), "__mro__", ()):
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(obj, name):
+                    size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+class LRUCache:
+    """To remember values up to a total size (e.g. in bytes).
+
+    Each value is stored with its size. When the total size exceeds
+    `max_size`, the least recently used values are evicted. Values bigger
+    than `max_size` are not stored at all.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # `self.entries` has the form {key: (value, size), ..}, ordered from
+        # the least to the most recently used key
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """To return the value for `key`, which becomes the most recently
+        used one."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, size):
+        """To store `value` for `key`, evicting the least recently used
+        values if needed."""
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if size > self.max_size:
+            return
+        while self.entries and self.size + size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+        self.entries[key] = (value, size)
+        self.size += size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
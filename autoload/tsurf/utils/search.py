@@ -9,6 +9,48 @@ for searching tags that match the user search query.
 
 from __future__ import division
 
+import heapq
+from array import array
+
+
+# Number of bits of a character mask (see `charmask`). Masks are stored in
+# arrays of unsigned longs.
+MASK_BITS = 8 * array("L").itemsize
+
+
+def _char_mask(code):
+    """To return the bit of the character with the given (lowercase) code
+    point in a character mask. Letters and digits have a bit of their own,
+    other ASCII characters share the remaining bits but the last one, used
+    for all other characters."""
+    if 97 <= code <= 122:
+        bit = code - 97
+    elif 48 <= code <= 57:
+        bit = code - 48 + 26
+    elif code < 128:
+        bit = 36 + code % 27
+    else:
+        bit = 63
+    return 1 << (bit % MASK_BITS)
+
+
+_CHAR_MASKS = dict((unichr(code), _char_mask(code)) for code in xrange(128))
+_OTHER_MASK = _char_mask(128)
+
+
+def charmask(s):
+    """To return the mask of the characters of `s` (case-insensitive).
+
+    If `needle` matches `haystack`, all the bits of the mask of `needle`
+    are set in the mask of `haystack`. Hence haystacks that can't match are
+    rejected without even searching them.
+    """
+    mask = 0
+    get = _CHAR_MASKS.get
+    for c in set(s.lower()):
+        mask |= get(c, _OTHER_MASK)
+    return mask
+
 
 def search(needle, haystack, smart_case):
     """To search for `needle` in `haystack`.
@@ -19,80 +61,196 @@ def search(needle, haystack, smart_case):
     `haystack`.
 
     If there are multiple matches, the one with the highest similarity
-    (lowest value) is returned.
+    (lowest value) is returned. If more matches share the same similarity,
+    the leftmost one is returned.
+
+    The best match is found with dynamic programming. The similarity
+    of a match (see the `similarity` function) depends on the sum of the
+    distances between all its positions, on the number of gaps between
+    them and on the number of word boundaries matched. The sum of all
+    distances can be computed position by position since, for sorted
+    positions p[0] < p[1] < .. < p[n-1]:
+
+        sum(p[j] - p[i] for i < j) == sum((2*j - n + 1) * p[j] for all j)
+
+    Hence, for each position of each needle character we keep only the
+    lowest distances sum for every (gaps, boundaries) pair reachable
+    there. The cost is bounded by O(len(needle) * len(haystack)) for each
+    of those pairs, whereas exploring all matches grows exponentially
+    with repeated characters.
     """
     if not needle:
         return -1, tuple()
 
+    needle_len = len(needle)
+    haystack_len = len(haystack)
+
+    columns = _columns(needle, haystack, smart_case)
+    if not columns:
+        return -1, tuple()
+
     # If `haystack` has only uppercase characters then it makes no sense
     # to treat an uppercase letter as a word-boundary character
     uppercase_is_word_boundary = True
     if haystack.isupper():
         uppercase_is_word_boundary = False
 
-    # `matchers` keep track of all possible matches of `needle`
-    # along `haystack`
-    matchers = [{
-        "needle_idx": 0,
-        # the following list (or strings) have the same length (always)
-        "positions": [],  # e.g. [1,2,3,4,..]
-        "consumed": "",
-        "boundaries": [],  # e.g. [True,False,False,True,...]
-    }]
+    def is_boundary(i):
+        return int(i == 0 or (uppercase_is_word_boundary and haystack[i].isupper())
+                   or haystack[i-1] in ('-', '_'))
 
-    best_positions = tuple()
-    best_similarity = -1
+    # `steps[j]` holds all the partial matches of `needle[:j+1]` and has
+    # the form:
+    #   {position: {(gaps, boundaries): (distances sum, prev position, prev key)}}
+    # where `prev position` and `prev key` allow to walk the match backward.
+    weight = 1 - needle_len
+    prev = dict((i, {(0, is_boundary(i)): (weight * i, None, None)})
+                for i in columns[0])
+    steps = [prev]
 
-    needle_len = len(needle)
-    haystack_len = len(haystack)
+    for j in range(1, needle_len):
+
+        weight = 2 * j - needle_len + 1
+        prev_column = columns[j-1]
+        curr = {}
 
-    for i, c in enumerate(haystack):
+        # `best` holds, for each (gaps, boundaries) pair, the best partial
+        # match of `needle[:j]` ending before `i - 1` (matching `needle[j]`
+        # at `i` after them adds a gap).
+        best = {}
+        k = 0
 
-        forks = []
-        for matcher in matchers:
-            idx = matcher["consumed"].find(c.lower())
-            if idx >= 0 and len(needle[idx:]) <= haystack_len - i:
-                forks.append({
-                    "needle_idx": idx,
-                    "consumed": matcher["consumed"][:idx],
-                    "positions": matcher["positions"][:idx],
-                    "boundaries": matcher["boundaries"][:idx],
-                })
+        for i in columns[j]:
 
-        matchers.extend(forks)
+            while k < len(prev_column) and prev_column[k] < i - 1:
+                p = prev_column[k]
+                for key, state in prev[p].items():
+                    b = best.get(key)
+                    if b is None or state[0] < b[0]:
+                        best[key] = (state[0], p)
+                k += 1
 
-        for matcher in matchers:
+            boundary = is_boundary(i)
+            states = {}
 
-            if matcher["needle_idx"] == needle_len:
-                continue
+            for (gaps, boundaries), (dsum, p) in best.items():
+                key = (gaps + 1, boundaries + boundary)
+                dsum += weight * i
+                s = states.get(key)
+                if s is None or dsum < s[0]:
+                    states[key] = (dsum, p, (gaps, boundaries))
 
-            if smart_case and needle[matcher["needle_idx"]].isupper():
-                cond = c == needle[matcher["needle_idx"]]
+            # The previous needle character matched right before `i`
+            for (gaps, boundaries), state in prev.get(i - 1, {}).items():
+                key = (gaps, boundaries + boundary)
+                dsum = state[0] + weight * i
+                s = states.get(key)
+                if s is None or dsum < s[0]:
+                    states[key] = (dsum, i - 1, (gaps, boundaries))
+
+            curr[i] = states
+
+        prev = curr
+        steps.append(curr)
+
+    def positions(i, key):
+        positions = [i]
+        for j in range(needle_len - 1, 0, -1):
+            _, i, key = steps[j][i][key]
+            positions.append(i)
+        return tuple(reversed(positions))
+
+    # Pick the best complete match. Note that this must give the same value
+    # as the `similarity` function.
+    n = needle_len * (needle_len - 1) // 2
+    best_similarity = -1
+    best_positions = tuple()
+    for i in sorted(prev):
+        for key, (dsum, _, _) in prev[i].items():
+            gaps, boundaries = key
+            if n > 0:
+                s = dsum/n * (gaps + 1) / (boundaries + 1)
             else:
-                cond = c.lower() == needle[matcher["needle_idx"]].lower()
+                s = i / (boundaries + 1)
+            if best_similarity < 0 or s < best_similarity:
+                best_similarity = s
+                best_positions = positions(i, key)
+            elif s == best_similarity:
+                best_positions = min(best_positions, positions(i, key))
 
-            if cond:
+    return best_similarity, best_positions
 
-                if (i == 0 or (uppercase_is_word_boundary and c.isupper()) or
-                    (i > 0 and haystack[i-1] in ('-', '_'))):
-                    matcher["boundaries"].append(True)
-                else:
-                    matcher["boundaries"].append(False)
 
-                matcher["consumed"] += needle[matcher["needle_idx"]].lower()
-                matcher["positions"].append(i)
-                matcher["needle_idx"] += 1
+def search_batch(needle, haystacks, smart_case, max_results=-1, indices=None,
+                 masks=None):
+    """To search for `needle` in each string of the sequence `haystacks`
+    (or only in those at the given `indices`). If the character masks of
+    all haystacks are given with `masks` (see `charmask`), haystacks that
+    lack some character of `needle` are skipped.
 
-                if matcher["needle_idx"] == needle_len:
+    Returns a tuple of two lists. The first one contains the indices of all
+    matching haystacks, whereas the second one contains at most
+    `max_results` tuples (index, similarity, positions) for the best matches,
+    ordered from the best to the worst. Among matches with the same
+    similarity, later haystacks come first.
+    """
+    if indices is None:
+        indices = xrange(len(haystacks))
+    if masks is not None:
+        mask = charmask(needle)
+        indices = [i for i in indices if masks[i] & mask == mask]
 
-                    s = similarity(haystack_len, matcher["positions"],
-                            len(filter(None, matcher["boundaries"])))
+    matched = []
+    matches = []
+    for i in indices:
+        similarity, positions = search(needle, haystacks[i], smart_case)
+        if positions:
+            matched.append(i)
+            matches.append((i, similarity, positions))
 
-                    if best_similarity < 0 or s < best_similarity:
-                        best_similarity = s
-                        best_positions = tuple(matcher["positions"])
+    if max_results < 0:
+        max_results = len(matches)
+    best = heapq.nsmallest(max_results, matches, key=lambda m: (m[1], -m[0]))
 
-    return best_similarity, best_positions
+    return matched, best
+
+
+def _columns(needle, haystack, smart_case):
+    """To return, for each character of `needle`, the sorted list of
+    positions where it can be matched in `haystack` as part of a complete
+    match. An empty list is returned if `needle` does not match."""
+    if len(needle) > len(haystack):
+        return []
+
+    haystack_lower = haystack.lower()
+
+    # Only positions after the leftmost match of the previous characters
+    # are considered
+    columns = []
+    start = 0
+    for c in needle:
+        if smart_case and c.isupper():
+            s = haystack
+        else:
+            s, c = haystack_lower, c.lower()
+        column = []
+        i = s.find(c, start)
+        while i >= 0:
+            column.append(i)
+            i = s.find(c, i + 1)
+        if not column:
+            return []
+        columns.append(column)
+        start = column[0] + 1
+
+    # Only positions before the rightmost match of the next characters
+    # are considered
+    end = len(haystack)
+    for j in range(len(needle) - 1, -1, -1):
+        columns[j] = [i for i in columns[j] if i < end]
+        end = columns[j][-1]
+
+    return columns
 
 
 def similarity(haystack_len, positions, boundaries_count):
@@ -4,13 +4,38 @@ tsurf.utils.settings
 ~~~~~~~~~~~~~~~~~~~~
 
 This module defines various utility functions for dealing with vim variables.
+
+All `g:tsurf_*` variables are read from vim at once with the `load`
+function and kept in a snapshot, so that `get` never has to go through
+`vim.eval`. The snapshot is reloaded every time the user interface is opened
+and whenever the user runs the `TsurfReloadSettings` command.
 """
 
 import vim
 
+from tsurf.utils import v
+
 
 prefix = 'g:tsurf_'
 
+# `snapshot` has the form {name: raw value, ...}, where `name` is the name
+# of a `g:tsurf_*` variable without the prefix. It's None until settings
+# are loaded for the first time.
+snapshot = None
+
+# `converted` has the form {(name, type): value, ...} and avoids converting
+# the same raw value again and again.
+converted = {}
+
+
+def load():
+    """To load all Tag Surfer variables with a single call to vim."""
+    global snapshot
+    raw = v.eval("filter(copy(g:), 'v:key =~# \"^tsurf_\"')")
+    snapshot = dict((name[len('tsurf_'):], value)
+                    for name, value in raw.items())
+    converted.clear()
+
 
 def set(name, value):
     """To set a vim variable to a given value."""
@@ -21,17 +46,34 @@ def set(name, value):
     else:
         val = value
 
-    vim.command("let {} = {}".format(prefix + name, val))
+    v.command("let {} = {}".format(prefix + name, val))
+    if snapshot is not None:
+        snapshot[name] = str(val) if isinstance(val, (int, long)) else value
+        for key in [k for k in converted if k[0] == name]:
+            del converted[key]
 
 
 def get(name, type=None):
     """To get the value of a vim variable."""
-    rawval = vim.eval(prefix + name)
+    if snapshot is None:
+        load()
+    try:
+        return converted[(name, type)]
+    except KeyError:
+        pass
+
+    try:
+        rawval = snapshot[name]
+    except KeyError:
+        raise vim.error("Undefined variable: {}".format(prefix + name))
+
     if type is bool:
-        return False if rawval == '0' else True
+        val = False if rawval == '0' else True
     elif type is int:
-        return int(rawval)
+        val = int(rawval)
     elif type is float:
-        return float(rawval)
+        val = float(rawval)
     else:
-        return rawval
+        val = rawval
+    converted[(name, type)] = val
+    return val
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.utils.shards
+~~~~~~~~~~~~~~~~~~
+
+This module defines the function used to search very large sets of tags on
+all CPUs. Tags are split into shards that are searched at the same time by
+different threads. The C search extension doesn't hold the GIL while
+matching, so threads actually run in parallel and, unlike processes, share
+the tags without copying them.
+"""
+
+import heapq
+import threading
+
+
+def search_batch(search, needle, haystacks, smart_case, max_results=-1,
+                 indices=None, masks=None, workers=2):
+    """To do the same as `search.search_batch`, where `search` is one of
+    the search modules, with the haystacks split into `workers` shards.
+
+    Each shard is searched in its own thread and returns its own best
+    matches, which are then merged. Results are the same as those of a
+    single search.
+    """
+    if indices is None:
+        indices = xrange(len(haystacks))
+    shards = _split(indices, workers)
+    results = [None] * len(shards)
+    errors = []
+
+    def run(k):
+        try:
+            results[k] = search.search_batch(needle, haystacks, smart_case,
+                                             max_results, shards[k], masks)
+        except Exception as e:
+            errors.append(e)
+
+    # The first shard is searched by the calling thread
+    threads = [threading.Thread(target=run, args=(k,))
+               for k in range(1, len(shards))]
+    for t in threads:
+        t.start()
+    run(0)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    matched, best = [], []
+    for shard_matched, shard_best in results:
+        matched.extend(shard_matched)
+        best.extend(shard_best)
+    if max_results < 0:
+        max_results = len(best)
+    best = heapq.nsmallest(max_results, best, key=lambda m: (m[1], -m[0]))
+
+    return matched, best
+
+
+def _split(indices, n):
+    """To split `indices` into at most `n` shards of about the same size.
+
+    An xrange object (of consecutive indices) is split into xrange objects,
+    any other sequence is sliced.
+    """
+    size = max(1, -(-len(indices) // n))
+    if isinstance(indices, xrange):
+        # xrange objects can't be sliced
+        start = indices[0] if indices else 0
+        return [xrange(start + i, start + min(i + size, len(indices)))
+                for i in xrange(0, len(indices), size)] or [indices]
+    return [indices[i:i+size] for i in xrange(0, len(indices), size)] or [indices]
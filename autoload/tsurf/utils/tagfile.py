@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+tsurf.utils.tagfile
+~~~~~~~~~~~~~~~~~~~
+
+This module defines the TagFile class, used to read existing tags files
+(such as the ones generated by a build) without loading them into memory,
+and the function used to write the tags files generated by Tag Surfer.
+"""
+
+import os
+import mmap
+import tempfile
+
+
+# Values of the `!_TAG_FILE_SORTED` header
+UNSORTED, SORTED, FOLDCASE = 0, 1, 2
+
+HEADERS = ("!_TAG_FILE_FORMAT\t2\t/extended format/\n"
+           "!_TAG_FILE_SORTED\t1\t/0=unsorted, 1=sorted, 2=foldcase/\n")
+
+
+def write(path, lines):
+    """To write the tag lines `lines` to the tags file `path`.
+
+    Lines are sorted so that vim can look up tags with a binary search. The
+    file is written in one go to a temporary file that then replaces `path`,
+    hence vim never reads a partially written file.
+    """
+    # The tag server and vim may be writing the same file right now: each
+    # one writes its own temporary file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADERS)
+            if lines:
+                f.write("\n".join(sorted(lines)))
+                f.write("\n")
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+        tmp = None
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+class TagFile:
+    """To read a tags file through a memory map.
+
+    Lines are sliced out of the map one at a time, so the file is never
+    copied as a whole into Python strings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sorted = UNSORTED
+        # `self.start` is the offset of the first line after the headers
+        self.start = 0
+        self.map = None
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map is not None:
+            self._read_headers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def lines(self):
+        """To yield all tag lines (headers excluded)."""
+        m = self.map
+        if m is None:
+            return
+        pos, size = self.start, len(m)
+        while pos < size:
+            end = m.find("\n", pos)
+            if end < 0:
+                end = size
+            if end > pos:
+                yield m[pos:end].rstrip("\r")
+            pos = end + 1
+
+    def _read_headers(self):
+        m = self.map
+        pos = 0
+        while m[pos:pos+6] == "!_TAG_":
+            end = m.find("\n", pos)
+            if end < 0:
+                end = len(m)
+            fields = m[pos:end].split("\t")
+            if fields[0] == "!_TAG_FILE_SORTED" and len(fields) > 1:
+                try:
+                    self.sorted = int(fields[1])
+                except ValueError:
+                    pass
+            pos = end + 1
+        self.start = pos
@@ -4,64 +4,155 @@ tsurf.utils.v
 ~~~~~~~~~~~~~
 
 This module defines thin wrappers around vim commands and functions.
+
+Commands are not sent to vim right away: they are queued with `command` and
+sent all at once by `flush`, so that a whole frame costs a single call to
+vim. Everything that needs vim to be up to date (evaluating an expression,
+changing a buffer or a window) flushes the queue first.
 """
 
 import os
+import re
 import vim
 
 
+# Maximum number of positions accepted by a single call to `matchaddpos`
+# (older versions of vim refuse more than 8)
+MATCHADDPOS_MAX = 8
+
+# Commands queued with `command` and not yet sent to vim
+pending = []
+
+
+def command(cmd):
+    """To queue a vim command. It will be run by the next `flush`."""
+    if isinstance(cmd, unicode):
+        cmd = cmd.encode('utf-8')
+    pending.append(cmd)
+
+
+def flush():
+    """To run all queued commands with a single call to vim.
+
+    Commands are run in order and the first one that fails stops the others,
+    just like when they are run one at a time.
+    """
+    if not pending:
+        return
+    cmds = pending[:]
+    del pending[:]
+    if len(cmds) == 1:
+        vim.command(cmds[0])
+    else:
+        vim.command("for g:_tsurf_cmd in [{}] | exe g:_tsurf_cmd | endfor | "
+                    "unlet g:_tsurf_cmd".format(",".join(map(quote, cmds))))
+
+
+def quote(s):
+    """To return `s` as a vim string literal (on a single line)."""
+    return "'{}'".format(" ".join(s.splitlines()).replace("'", "''"))
+
+
+def eval(expr):
+    """To evaluate `expr` once all queued commands have been run."""
+    flush()
+    return vim.eval(expr)
+
+
+def eval_all(*exprs):
+    """To evaluate all the given expressions with a single call to vim.
+    A list with their values is returned."""
+    flush()
+    return vim.eval("[{}]".format(",".join(exprs)))
+
+
 def echom(msg):
     """To display a message to the user via the command line."""
-    vim.command('echom "[tsurf] {0}"'.format(msg.replace('"', '\"')))
+    command('echom "[tsurf] {0}"'.format(msg.replace('"', '\"')))
 
 
 def echohl(msg, hlgroup):
     """To display a colored message to the user via the command line."""
-    vim.command("echohl {}".format(hlgroup))
+    command("echohl {}".format(hlgroup))
     echom(msg)
-    vim.command("echohl None")
+    command("echohl None")
+
+
+def escape_tagfile(path):
+    """To escape the tag file `path` for the `:set tags+=` (or `tags-=`)
+    command. Spaces and commas separate files in the option value, and
+    `:set` itself drops a level of backslashes."""
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    path = re.sub(r"([ ,])", r"\\\1", path)
+    special = ' |"' if os.name == "nt" else ' |"\\'
+    return re.sub("([{}])".format(re.escape(special)), r"\\\1", path)
 
 
 def cwd():
     """To return the current working directory."""
-    return vim.eval('getcwd()')
+    return eval('getcwd()')
 
 
 def highlight(hlgroup, patt):
     """To highlight with `hlgroup` every occurrence of `patt`."""
-    vim.command("syn match {} /{}/".format(hlgroup, patt))
+    command("syn match {} /{}/".format(hlgroup, patt))
+
+
+def highlight_positions(hlgroup, positions):
+    """To highlight with `hlgroup` the characters at the given `positions`
+    in the current window. `positions` is a list of (line, column) pairs,
+    where both numbers start from 1 and the column is a byte index.
+
+    Positions are split into chunks of `MATCHADDPOS_MAX` and all calls to
+    `matchaddpos` are sent to vim with a single command."""
+    calls = []
+    for i in xrange(0, len(positions), MATCHADDPOS_MAX):
+        chunk = positions[i:i+MATCHADDPOS_MAX]
+        calls.append("call matchaddpos('{}', [{}])".format(hlgroup,
+            ",".join("[{},{}]".format(l, c) for l, c in chunk)))
+    if calls:
+        command(" | ".join(calls))
+
+
+def has_function(name):
+    """To check whether the vim function `name` exists."""
+    return eval("exists('*{}')".format(name)) == '1'
 
 
 def redraw():
-    """Little wrapper around the redraw command."""
-    vim.command('redraw')
+    """Little wrapper around the redraw command. Since a redraw ends a frame,
+    all queued commands are run."""
+    command('redraw')
+    flush()
 
 
 def focus_win(winnr):
     """To go to the window with the given number."""
-    vim.command('{0}wincmd w'.format(winnr))
+    command('{0}wincmd w'.format(winnr))
 
 
 def bufwinnr(expr):
     """To return the number of the window whose buffer is named or numbered
     'expr'."""
     if isinstance(expr, (int, long)):
-        return int(vim.eval("bufwinnr({})".format(expr)))
+        return int(eval("bufwinnr({})".format(expr)))
     else:
-        return int(vim.eval("bufwinnr('{}')".format(expr)))
+        return int(eval("bufwinnr('{}')".format(expr)))
 
 
 def winnr(expr=None):
     """To return the current window number or the number of the window
     `expr` (where `expr` can be '#' or '%')."""
     if expr is None:
-        return int(vim.eval("winnr()"))
+        return int(eval("winnr()"))
     else:
-        return int(vim.eval("winnr('{}')".format(expr)))
+        return int(eval("winnr('{}')".format(expr)))
 
 
 def set_buffer(content):
     """To set the whole content of the current buffer at once."""
+    flush()
     if isinstance(content, list):
         vim.current.buffer[:] = content
     elif isinstance(content, basestring):
@@ -70,28 +161,32 @@ def set_buffer(content):
 
 def set_buffer_line(linenr, content):
     """To set a specific line of the current buffer."""
+    flush()
     vim.current.buffer[linenr] = content
 
 
 def set_win_height(height):
     """To set the height of the current window."""
+    flush()
     vim.current.window.height = height
 
 
 def set_win_cursor(line, col):
     """To set the cursor position in the current window."""
+    flush()
     vim.current.window.cursor = (line, col)
 
 
 def bufloaded(expr):
     """To check if a buffer is loaded."""
     if isinstance(expr, (int, long)):
-        return int(vim.eval("bufloaded({})".format(expr)))
+        return int(eval("bufloaded({})".format(expr)))
     else:
-        return int(vim.eval("bufloaded('{}')".format(expr)))
+        return int(eval("bufloaded('{}')".format(expr)))
 
 
 def buffers():
     """To return a list of all loaded buffers."""
+    flush()
     fn = lambda p: os.path.exists(p) and bufloaded(p)
     return filter(fn, (b.name for b in vim.buffers))
@@ -90,11 +90,26 @@ let g:tsurf_ctags_args =
 let g:tsurf_ctags_custom_args =
     \ get(g:, "tsurf_ctags_custom_args", "")
 
+let g:tsurf_ctags_jobs =
+    \ get(g:, "tsurf_ctags_jobs", 0)
+
+let g:tsurf_index_dir =
+    \ get(g:, "tsurf_index_dir", expand("~/.cache/tsurf"))
+
+let g:tsurf_daemon_socket =
+    \ get(g:, "tsurf_daemon_socket", expand("~/.cache/tsurf/daemon.sock"))
+
+let g:tsurf_use_tagfiles =
+    \ get(g:, "tsurf_use_tagfiles", 0)
+
 " Search type and scope
 
 let g:tsurf_smart_case =
     \ get(g:, "tsurf_smart_case", 1)
 
+let g:tsurf_parallel_search_threshold =
+    \ get(g:, "tsurf_parallel_search_threshold", 500000)
+
 let g:tsurf_buffer_search_modifier =
     \ get(g:, "tsurf_buffer_search_modifier", "%")
 
@@ -104,6 +119,9 @@ let g:tsurf_project_search_modifier =
 let g:tsurf_root_markers =
     \ extend(get(g:, 'tsurf_root_markers', []), ['.git', '.svn', '.hg', '.bzr', '_darcs'])
 
+let g:tsurf_use_git =
+    \ get(g:, "tsurf_use_git", 1)
+
 " Custom languages support
 
 let g:tsurf_custom_languages =
@@ -157,3 +175,4 @@ let g:tsurf_matches_color_darkbg =
 command! Tsurf call tsurf#Open()
 command! -nargs=? -complete=file TsurfSetRoot call tsurf#SetProjectRoot(<q-args>)
 command! TsurfUnsetRoot call tsurf#UnsetProjectRoot()
+command! TsurfReloadSettings call tsurf#ReloadSettings()